@@ -3,43 +3,102 @@ from flask import Flask
 from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
 
-from sqlalchemy import exc
-from sqlalchemy import event
-from sqlalchemy.pool import Pool
-
 from flask_cors import CORS
 
-app = Flask(__name__)
-app.config.from_object('chartingperformance.default_settings')
-app.config.from_envvar('HOMEPERFORMANCE_SETTINGS')
+from chartingperformance.encoding import JSONEncoder
+from chartingperformance.pool import engine_options, pool_monitor
 
-engine = create_engine(app.config['DATABASE_URI'])
+# Created by init_engine, once per process.
+engine = None
 db_session = scoped_session(sessionmaker(autocommit=False,
-                                         autoflush=False,
-                                         bind=engine))
-
-@event.listens_for(Pool, "checkout")
-def ping_connection(dbapi_connection, connection_record, connection_proxy):
-    cursor = dbapi_connection.cursor()
-    try:
-        cursor.execute("SELECT 1")
-    except:
-        # optional - dispose the whole pool
-        # instead of invalidating one at a time
-        # connection_proxy._pool.dispose()
-
-        # raise DisconnectionError - pool will try
-        # connecting again up to three times before raising.
-        raise exc.DisconnectionError()
-    cursor.close()
-
-CORS(app, resources=r'/api/*', allow_headers='Content-Type')
-
-import chartingperformance.routes
-
-@app.teardown_appcontext
-def shutdown_session(exception=None):
+                                         autoflush=False))
+
+from chartingperformance.watermark import watermarks
+from chartingperformance.cache import response_cache, shared_cache
+from chartingperformance.executor import query_executor
+from chartingperformance.singleflight import single_flight
+from chartingperformance.revalidator import revalidator
+from chartingperformance.store import column_store
+from chartingperformance.registry import circuit_registry
+from chartingperformance.metadata import metadata
+from chartingperformance.warmer import cache_warmer
+from chartingperformance import rollup
+from chartingperformance import extremes
+
+watermarks.subscribe(response_cache.invalidate)
+watermarks.subscribe(shared_cache.invalidate)
+watermarks.subscribe(circuit_registry.invalidate)
+watermarks.subscribe(metadata.invalidate)
+watermarks.subscribe(cache_warmer.on_watermark)
+
+# Refreshed in the background, before the warmer recomputes views from them.
+cache_warmer.subscribe(rollup.on_watermark)
+cache_warmer.subscribe(extremes.on_watermark)
+cache_warmer.subscribe(column_store.on_watermark)
+
+def create_app(settings=None):
+    """ Return app configured from default_settings, then the file named by
+    HOMEPERFORMANCE_SETTINGS, then the settings dict if given. """
+
+    app = Flask(__name__)
+    app.json_encoder = JSONEncoder
+    app.config.from_object('chartingperformance.default_settings')
+    app.config.from_envvar('HOMEPERFORMANCE_SETTINGS')
+    if settings is not None:
+        app.config.update(settings)
+
+    CORS(app, resources=r'/api/*', allow_headers='Content-Type')
+
+    init_engine(app)
+
+    watermarks.init_app(app)
+    response_cache.init_app(app)
+    shared_cache.init_app(app)
+    query_executor.init_app(app)
+    single_flight.init_app(app)
+    revalidator.init_app(app)
+    column_store.init_app(app)
+    circuit_registry.init_app(app)
+    metadata.init_app(app)
+    cache_warmer.init_app(app)
+
+    from chartingperformance.routes import api
+    from chartingperformance.commands import commands
+    app.register_blueprint(api)
+    app.register_blueprint(commands)
+
+    @app.teardown_appcontext
+    def shutdown_session(exception=None): # pylint: disable=unused-variable,unused-argument
+        db_session.remove()
+
+    return app
+
+def init_engine(app):
+    """ Create the engine, bind db_session to it and open its pool. """
+
+    global engine # pylint: disable=global-statement
+
+    engine = create_engine(app.config['DATABASE_URI'], **engine_options(app.config))
     db_session.remove()
+    db_session.configure(bind=engine)
+    pool_monitor.init_app(app, engine)
+
+def dispose_engine():
+    """ Close the pool's connections, so none are open when the process forks. """
+
+    if engine is not None:
+        engine.dispose()
+
+def init_worker(app):
+    """ Give a forked worker process its own engine, query threads and cache warmer.
+    Metadata, circuits, cached responses and column store maps loaded before the fork
+    are kept. """
+
+    init_engine(app)
+    query_executor.init_app(app)
+    cache_warmer.start()
 
 if __name__ == '__main__':
-    app.run(host=app.config['HOST'], port=app.config['PORT'], debug=app.config['DEBUG'])
+    application = create_app()
+    application.run(host=application.config['HOST'], port=application.config['PORT'],
+                    debug=application.config['DEBUG'])
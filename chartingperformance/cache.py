@@ -0,0 +1,278 @@
+""" In-process and shared response caches """
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from collections import OrderedDict, namedtuple
+
+from flask import current_app
+
+CacheEntry = namedtuple('CacheEntry', ['house_id', 'watermark', 'body', 'mimetype', 'stale_since'])
+
+class ResponseCache(object):
+    """ LRU cache of encoded view responses, bounded by total body size.
+    Keys start with (view name, house_id). Entries are only fresh for the
+    data watermark they were computed against. When a house's watermark advances
+    its entries are kept as stale for keep_stale seconds, to be served by get_stale. """
+
+    def __init__(self, max_bytes=0, keep_stale=0):
+        self.max_bytes = max_bytes
+        self.keep_stale = keep_stale
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        """ Read settings from app config. """
+
+        self.max_bytes = app.config['RESPONSE_CACHE_BYTES']
+        self.keep_stale = max(app.config['STALE_WHILE_REVALIDATE'], app.config['STALE_IF_ERROR'])
+
+    def get(self, key, watermark):
+        """ Return entry for key computed against watermark, or None. """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.watermark != watermark:
+                if entry.stale_since is None:
+                    self.remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def get_stale(self, key, max_age):
+        """ Return entry for key that went stale at most max_age seconds ago, or None. """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.stale_since is None or \
+               time.monotonic() - entry.stale_since > max_age:
+                return None
+            self.stale_hits += 1
+            return entry
+
+    def set(self, key, watermark, body, mimetype):
+        """ Store body for key, evicting least recently used entries to fit. """
+
+        if len(body) > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = CacheEntry(key[1], watermark, body, mimetype, None)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key):
+        """ Drop key. Caller holds the lock. """
+
+        entry = self.entries.pop(key)
+        self.size -= len(entry.body)
+
+    def invalidate(self, house_id, watermark=None):
+        """ Mark entries of house X from other watermarks stale, dropping those stale
+        longer than keep_stale. Used as a watermark listener. """
+
+        now = time.monotonic()
+
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if entry.house_id != str(house_id) or entry.watermark == watermark:
+                    continue
+                if entry.stale_since is None and self.keep_stale:
+                    self.entries[key] = entry._replace(stale_since=now)
+                elif entry.stale_since is None or now - entry.stale_since > self.keep_stale:
+                    self.remove(key)
+
+    def clear(self):
+        """ Drop all entries and reset counters. """
+
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.hits = self.misses = self.stale_hits = self.evictions = 0
+
+    def stats(self):
+        """ Return counters as dict. """
+
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'bytes': self.size,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'stale_hits': self.stale_hits,
+                    'evictions': self.evictions}
+
+class SharedCache(object):
+    """ Encoded view responses in a SQLite file, shared by the worker processes of
+    one host behind each worker's ResponseCache. Rows are keyed by a hash of the cache
+    key and hold the watermark they were computed against. Bodies of compress_bytes
+    or more are stored zlib compressed. Oldest rows are dropped past max_bytes. """
+
+    def __init__(self, path=None, max_bytes=0, compress_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compress_bytes = compress_bytes
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        """ Read settings from app config and create the table. """
+
+        self.path = app.config['SHARED_CACHE_PATH']
+        self.max_bytes = app.config['SHARED_CACHE_BYTES']
+        self.compress_bytes = app.config['SHARED_CACHE_COMPRESS_BYTES']
+        self.local = threading.local()
+
+        if self.path is not None:
+            self.create_table()
+
+    def create_table(self):
+        """ Create the responses table if it does not exist yet. """
+
+        with self.connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS responses '
+                               '(key TEXT PRIMARY KEY, house_id TEXT, watermark TEXT, '
+                               'body BLOB, compressed INTEGER, mimetype TEXT, '
+                               'size INTEGER, stored REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS responses_house '
+                               'ON responses (house_id)')
+            connection.execute('CREATE INDEX IF NOT EXISTS responses_stored '
+                               'ON responses (stored)')
+
+    def connect(self):
+        """ Return this thread's connection, opening it first in a new thread or
+        process. Connections are never carried across a fork. """
+
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+
+        return connection
+
+    @staticmethod
+    def hash_key(key):
+        """ Return row key of cache key. """
+
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def get(self, key, watermark):
+        """ Return entry for key computed against watermark, or None. """
+
+        if self.path is None:
+            return None
+
+        try:
+            row = self.connect().execute('SELECT body, compressed, mimetype FROM responses '
+                                         'WHERE key = ? AND watermark = ?',
+                                         (self.hash_key(key), repr(watermark))).fetchone()
+        except sqlite3.Error:
+            current_app.logger.exception('Shared cache not read')
+            row = None
+
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        body, compressed, mimetype = row
+        if compressed:
+            body = zlib.decompress(body)
+
+        return CacheEntry(key[1], watermark, bytes(body), mimetype, None)
+
+    def set(self, key, watermark, body, mimetype):
+        """ Store body for key, dropping oldest rows to fit. """
+
+        if self.path is None or len(body) > self.max_bytes:
+            return
+
+        compressed = self.compress_bytes is not None and len(body) >= self.compress_bytes
+        if compressed:
+            body = zlib.compress(body)
+
+        try:
+            connection = self.connect()
+            connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (self.hash_key(key), key[1], repr(watermark), body,
+                                int(compressed), mimetype, len(body), time.time()))
+            size = connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+            if size > self.max_bytes:
+                self.evict(connection, size)
+        except sqlite3.Error:
+            current_app.logger.exception('Shared cache not written')
+
+    def evict(self, connection, size):
+        """ Drop oldest rows until size fits max_bytes. """
+
+        drop = []
+        for row_key, row_size in connection.execute('SELECT key, size FROM responses '
+                                                    'ORDER BY stored'):
+            if size <= self.max_bytes:
+                break
+            drop.append((row_key,))
+            size -= row_size
+
+        connection.executemany('DELETE FROM responses WHERE key = ?', drop)
+
+    def invalidate(self, house_id, watermark=None):
+        """ Drop rows of house X computed against another watermark. Used as a watermark
+        listener by every worker, so rows already computed at watermark are kept. """
+
+        if self.path is None:
+            return
+
+        try:
+            self.connect().execute('DELETE FROM responses WHERE house_id = ? AND watermark != ?',
+                                   (str(house_id), repr(watermark)))
+        except sqlite3.Error:
+            current_app.logger.exception('Shared cache of house %s not invalidated', house_id)
+
+    def clear(self):
+        """ Drop all rows and reset counters. """
+
+        if self.path is not None:
+            self.connect().execute('DELETE FROM responses')
+
+        with self.lock:
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """ Return counters as dict. """
+
+        entries, size = 0, 0
+        if self.path is not None:
+            entries, size = self.connect().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) '
+                                                   'FROM responses').fetchone()
+
+        with self.lock:
+            return {'entries': entries,
+                    'bytes': size,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+response_cache = ResponseCache()
+shared_cache = SharedCache()
@@ -0,0 +1,150 @@
+""" Flask CLI commands for data maintenance """
+# pylint: disable=no-member
+import click
+
+from chartingperformance import db_session
+
+from chartingperformance.models import Houses
+from chartingperformance.models import EnergyHourly
+from chartingperformance.models import EnergyDaily
+from chartingperformance.models import EnergyMonthly
+from chartingperformance.models import HDDMonthly
+from chartingperformance.models import TemperatureHourly
+from chartingperformance.models import CircuitDaily
+from chartingperformance.models import CircuitMonthly
+from chartingperformance.models import WaterDaily
+from chartingperformance.models import Base
+
+from chartingperformance.views.view import View
+
+from chartingperformance import rollup
+from chartingperformance import extremes
+from chartingperformance.store import column_store
+
+from sqlalchemy import func
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from sqlalchemy.sql import text
+
+from flask import Blueprint, current_app
+
+# Registered without a group, so commands run as `flask build-rollups`.
+commands = Blueprint('commands', __name__, cli_group=None)
+
+# Tables grouped by View.group_query_by_interval
+BUCKET_TABLES = [EnergyHourly, EnergyDaily, EnergyMonthly, HDDMonthly,
+                 TemperatureHourly, CircuitDaily, CircuitMonthly]
+
+def get_house_ids(house_ids):
+    """ Return house ids given on the command line, or all houses. """
+
+    if house_ids:
+        return house_ids
+
+    return [house.house_id for house in db_session.query(Houses).all()]
+
+def explain(query):
+    """ Return EXPLAIN rows for query. """
+
+    compiled = query.statement.compile(dialect=db_session.get_bind().dialect)
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+
+    return db_session.connection().exec_driver_sql('EXPLAIN %s' % compiled, params)
+
+@commands.cli.command('build-rollups')
+@click.option('--house', 'house_ids', type=int, multiple=True,
+              help='House id to refresh. Defaults to all houses.')
+@click.option('--full', is_flag=True,
+              help='Rebuild all history instead of the latest month onward.')
+def build_rollups(house_ids, full):
+    """ Create and refresh daily and monthly circuit rollups. """
+
+    rollup.create_tables()
+
+    for house_id in get_house_ids(house_ids):
+        rollup.build_rollups(house_id, full)
+        click.echo('Rollups refreshed for house %s' % house_id)
+
+@commands.cli.command('build-extremes')
+@click.option('--house', 'house_ids', type=int, multiple=True,
+              help='House id to refresh. Defaults to all houses.')
+@click.option('--full', is_flag=True,
+              help='Rebuild all history instead of the latest month onward.')
+def build_extremes(house_ids, full):
+    """ Create and refresh the monthly and yearly extremes index. """
+
+    extremes.create_tables()
+
+    for house_id in get_house_ids(house_ids):
+        extremes.build_extremes(house_id, full)
+        click.echo('Extremes refreshed for house %s' % house_id)
+
+@commands.cli.command('build-store')
+@click.option('--house', 'house_ids', type=int, multiple=True,
+              help='House id to refresh. Defaults to all houses.')
+@click.option('--full', is_flag=True,
+              help='Rebuild all history instead of appending hours after the last stored one.')
+def build_store(house_ids, full):
+    """ Create and append the memory-mapped hourly column store. """
+
+    if column_store.directory is None:
+        raise click.ClickException('COLUMN_STORE_DIR is not set or numpy is not installed')
+
+    for house_id in get_house_ids(house_ids):
+        hours = column_store.sync(house_id, full)
+        click.echo('Column store of house %s appended with %s hours' % (house_id, hours))
+
+@commands.cli.command('add-buckets')
+def add_buckets():
+    """ Add stored interval bucket columns and the indexes declared on history tables.
+    Also creates the rollup tables and water_daily, read by the water view's day interval. """
+
+    rollup.create_tables()
+    Base.metadata.create_all(db_session.get_bind(), tables=[WaterDaily.__table__])
+
+    with db_session.get_bind().begin() as connection:
+        for model in BUCKET_TABLES:
+            table = model.__table__
+            for column in table.columns:
+                if column.name.startswith('bucket_'):
+                    ddl = CreateColumn(column).compile(dialect=connection.dialect)
+                    connection.execute(text('ALTER TABLE %s ADD COLUMN IF NOT EXISTS %s' %
+                                            (table.name, ddl)))
+            for index in table.indexes:
+                connection.execute(CreateIndex(index, if_not_exists=True))
+            click.echo('Buckets added to %s' % table.name)
+
+@commands.cli.command('explain-buckets')
+@click.option('--house', 'house_id', type=int, default=0)
+@click.option('--start', default='2013-01-01')
+@click.option('--duration', default='1year')
+def explain_buckets(house_id, start, duration):
+    """ EXPLAIN grouped queries. Fails if any needs a temporary table or filesort. """
+
+    if not current_app.config['INTERVAL_BUCKETS']:
+        raise click.ClickException('INTERVAL_BUCKETS is not set')
+
+    failures = 0
+    for model in BUCKET_TABLES:
+        view = View({'interval': model.grain, 'start': start, 'duration': duration})
+        grains = view.valid_intervals
+        for interval in grains[grains.index(model.grain):]:
+            view.args['interval'] = interval
+            view.base_query = db_session.query(func.min(model.date),
+                                               func.count(model.date)).\
+                filter(model.house_id == house_id)
+            view.filter_query_by_date_range(model)
+            query = view.group_query_by_interval(model)
+
+            for row in explain(query):
+                extra = row._mapping['Extra'] or ''
+                ok = 'Using temporary' not in extra and 'Using filesort' not in extra
+                if not ok:
+                    failures += 1
+                click.echo('%-4s %-18s %-6s key=%s %s' % ('ok' if ok else 'FAIL',
+                                                          model.__tablename__, interval,
+                                                          row._mapping['key'], extra))
+
+    if failures:
+        raise click.ClickException('%s grouped queries need a temporary table' % failures)
@@ -12,3 +12,92 @@ PORT = 5000
 SECRET_KEY = 'secretsecretsecret'
 DATABASE_URI = 'mariadb+mariadbconnector://%s:%s@%s/%s' % (config['user'],\
     config['password'], config['host'], config['database'])
+
+# Read Usage from circuit_daily/circuit_monthly. Run `flask build-rollups` once before turning
+# it on; the cache warmer then refreshes them as the watermark advances, and ranges past their
+# end date read energy_hourly until they catch up.
+CIRCUIT_ROLLUPS = False
+
+# Group by the stored bucket_day/bucket_month/bucket_year columns. Run `flask add-buckets`
+# before turning it on.
+INTERVAL_BUCKETS = False
+
+# Seconds between checks of limits_hourly.end_date for new data.
+WATERMARK_TTL = 60
+
+# Seconds circuit names and descriptions are kept before rereading the circuits table.
+CIRCUIT_TTL = 300
+
+# Load houses, devices, data years, limits and circuits when the app starts.
+METADATA_WARMUP = True
+
+# Byte budget of the in-process view response cache. 0 disables it.
+RESPONSE_CACHE_BYTES = 64 * 1024 * 1024
+
+# Seconds a cached view response may still be served after the watermark moves past it, while
+# one of REVALIDATE_WORKERS threads recomputes it. 0 workers always computes in the request.
+STALE_WHILE_REVALIDATE = 60 * 60
+REVALIDATE_WORKERS = 2
+# Seconds a stale response may stand in for a view whose queries fail.
+STALE_IF_ERROR = 24 * 60 * 60
+
+# SQLite file of view responses shared by all workers on this host, read on a miss in the
+# in-process cache. None disables it. Bodies of SHARED_CACHE_COMPRESS_BYTES or more are
+# stored zlib compressed; None stores them as is.
+SHARED_CACHE_PATH = None
+SHARED_CACHE_BYTES = 256 * 1024 * 1024
+SHARED_CACHE_COMPRESS_BYTES = 4096
+
+# Compute concurrent identical view requests once per worker, the others waiting for its response.
+SINGLE_FLIGHT = True
+
+# Threads recomputing a house's dashboard views after its watermark advances, started in each
+# serving process. 0 disables warming. Watermarks are polled every WARMER_INTERVAL seconds, and
+# warming pauses WARMER_PAUSE seconds between views at nice value WARMER_NICE.
+WARMER_WORKERS = 1
+WARMER_INTERVAL = 60
+WARMER_PAUSE = 0.05
+WARMER_NICE = 10
+
+# Cache-Control max-age for view responses whose range ends before the data watermark.
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Rows fetched per server-side cursor batch, and items per chunk, for stream=true.
+STREAM_BATCH_ROWS = 1000
+
+# Rows per Parquet row group in exports. Batches are buffered until a group is full.
+PARQUET_ROW_GROUP_ROWS = 128 * 1024
+
+# Connection pool. Keep POOL_SIZE above QUERY_WORKERS plus the number of request threads.
+# Connections are replaced after POOL_RECYCLE seconds, and checked with SELECT 1 only
+# after sitting idle POOL_LIVENESS_IDLE seconds or after another connection was invalidated.
+POOL_SIZE = 10
+POOL_MAX_OVERFLOW = 10
+POOL_TIMEOUT = 30
+POOL_RECYCLE = 3600
+POOL_LIVENESS_IDLE = 300
+# Connections opened when the app starts.
+POOL_WARM = 4
+
+# Serve connection pool, cache, single-flight, revalidation and warmer statistics at /internal/stats/.
+INTERNAL_STATS = True
+
+# Threads running a view's independent queries concurrently, shared by all requests.
+# Each holds its own pooled connection. 0 or 1 runs queries in the request thread.
+QUERY_WORKERS = 4
+
+# Read view totals from the GROUP BY ... WITH ROLLUP row of the interval query. Rows are grouped
+# by the stored bucket columns with INTERVAL_BUCKETS, else by the expressions they store.
+ROLLUP_TOTALS = True
+
+# Directory of memory-mapped hourly column files per house, read by summary, usage, temperature
+# and chart. Build with `flask build-store`; the cache warmer appends new hours as the watermark
+# advances. None reads everything from the database. Needs numpy.
+COLUMN_STORE_DIR = None
+
+# Worker processes and threads per process when served by gunicorn (gunicorn.conf.py).
+# 0 workers runs two per core plus one. Each worker has its own connection pool of POOL_SIZE.
+WORKERS = 0
+WORKER_THREADS = 4
+# Seconds a request may run before its worker is restarted.
+WORKER_TIMEOUT = 60
@@ -0,0 +1,46 @@
+""" Concurrent view query execution """
+from concurrent.futures import ThreadPoolExecutor
+
+from chartingperformance import db_session
+
+from flask import current_app
+
+class QueryExecutor(object):
+    """ Bounded thread pool shared by all requests. Runs a view's independent
+    queries at once, each thread with its own session from the engine. """
+
+    def __init__(self, max_workers=0):
+        self.max_workers = max_workers
+        self.pool = None
+
+    def init_app(self, app):
+        """ Read settings from app config. """
+
+        self.max_workers = app.config['QUERY_WORKERS']
+        if self.max_workers > 1:
+            self.pool = ThreadPoolExecutor(max_workers=self.max_workers,
+                                           thread_name_prefix='query')
+
+    def run(self, *calls):
+        """ Call each function and return their results in order.
+        Runs in the calling thread when the pool is disabled. """
+
+        if self.pool is None or len(calls) < 2:
+            return [call() for call in calls]
+
+        app = current_app._get_current_object() # pylint: disable=protected-access
+        futures = [self.pool.submit(self.call, app, call) for call in calls]
+
+        return [future.result() for future in futures]
+
+    @staticmethod
+    def call(app, call):
+        """ Run call in an app context, releasing the thread's session afterwards. """
+
+        with app.app_context():
+            try:
+                return call()
+            finally:
+                db_session.remove()
+
+query_executor = QueryExecutor()
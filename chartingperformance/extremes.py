@@ -0,0 +1,279 @@
+""" Extremes index maintenance and lookup """
+# pylint: disable=no-member
+import datetime
+
+from collections import namedtuple
+from decimal import Decimal
+
+from chartingperformance import db_session
+
+from chartingperformance.models import Base
+from chartingperformance.models import EnergyHourly
+from chartingperformance.models import EnergyDaily
+from chartingperformance.models import HDDDaily
+from chartingperformance.models import TemperatureHourly
+from chartingperformance.models import Extremes
+
+from sqlalchemy import func, select, literal
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.sql import label, or_, literal_column
+
+Metric = namedtuple('Metric', ['table', 'column', 'direction', 'filters'])
+Record = namedtuple('Record', ['date', 'value'])
+
+# Solar is recorded as negative generation, so the peak is the minimum.
+METRICS = {'solar_hour': Metric(EnergyHourly, 'solar', 'min', lambda table: []),
+           'solar_day': Metric(EnergyDaily, 'solar', 'min', lambda table: []),
+           'used_hour': Metric(EnergyHourly, 'used', 'max',
+                               lambda table: [or_(table.device_id == 5,
+                                                  table.device_id == 10)]),
+           'used_day': Metric(EnergyDaily, 'used', 'max', lambda table: []),
+           'temperature_hour': Metric(TemperatureHourly, 'temperature', 'min',
+                                      lambda table: [table.device_id == 0]), # outdoor
+           'hdd_day': Metric(HDDDaily, 'hdd', 'max', lambda table: [])}
+
+def create_tables():
+    """ Create extremes table if it does not exist yet. """
+
+    Base.metadata.create_all(db_session.get_bind(), tables=[Extremes.__table__])
+
+def on_watermark(house_id, watermark): # pylint: disable=unused-argument
+    """ Refresh the index of house X from its latest month, if it has been built, so
+    months after the latest indexed one are not left to be scanned. Run by the cache
+    warmer before it warms views. """
+
+    built = db_session.query(Extremes.house_id).\
+        filter(Extremes.house_id == house_id).first()
+
+    if built is not None:
+        build_extremes(house_id)
+
+def build_extremes(house_id, full=False):
+    """ Refresh monthly and yearly records of every metric for house X.
+
+    Only the latest stored month onward is rebuilt, unless full is set.
+    """
+
+    for name, metric in METRICS.items():
+        since = None
+        if not full:
+            since = db_session.query(func.max(Extremes.start_date)).\
+                filter(Extremes.house_id == house_id).\
+                filter(Extremes.metric == name).\
+                filter(Extremes.period == 'month').scalar()
+
+        build_months(house_id, name, metric, since)
+        build_years(house_id, name, metric, since)
+
+    db_session.commit()
+
+def build_months(house_id, name, metric, since):
+    """ Store record row of each month from the source table. """
+
+    table = metric.table
+    column = getattr(table, metric.column)
+    month = func.subdate(func.date(table.date),
+                         func.dayofmonth(table.date) - literal_column('1'))
+
+    ranked = select([label('start_date', month),
+                     label('date', table.date),
+                     label('value', column),
+                     label('position', func.row_number().over(
+                         partition_by=month,
+                         order_by=[ordered(column, metric.direction), table.date]))]).\
+        where(table.house_id == house_id).\
+        where(column != None).\
+        where(*metric.filters(table))
+
+    if since is not None:
+        ranked = ranked.where(table.date >= since)
+
+    ranked = ranked.subquery()
+
+    upsert(select([literal(house_id), literal(name), literal('month'),
+                   ranked.c.start_date, ranked.c.date, ranked.c.value]).
+           where(ranked.c.position == 1))
+
+def build_years(house_id, name, metric, since):
+    """ Store record row of each year from the month rows. """
+
+    year = func.makedate(func.year(Extremes.start_date), 1)
+
+    ranked = select([label('start_date', year),
+                     Extremes.date,
+                     Extremes.value,
+                     label('position', func.row_number().over(
+                         partition_by=year,
+                         order_by=[ordered(Extremes.value, metric.direction),
+                                   Extremes.date]))]).\
+        where(Extremes.house_id == house_id).\
+        where(Extremes.metric == name).\
+        where(Extremes.period == 'month')
+
+    if since is not None:
+        ranked = ranked.where(Extremes.start_date >= datetime.date(since.year, 1, 1))
+
+    ranked = ranked.subquery()
+
+    upsert(select([literal(house_id), literal(name), literal('year'),
+                   ranked.c.start_date, ranked.c.date, ranked.c.value]).
+           where(ranked.c.position == 1))
+
+def upsert(query):
+    """ Insert record rows from query, replacing rows with the same key. """
+
+    stmt = insert(Extremes.__table__).\
+        from_select(['house_id', 'metric', 'period', 'start_date', 'date', 'value'], query)
+    stmt = stmt.on_duplicate_key_update(date=stmt.inserted.date, value=stmt.inserted.value)
+
+    db_session.execute(stmt)
+
+def ordered(column, direction):
+    """ Return column ordered so that the record comes first. """
+
+    return column.asc() if direction == 'min' else column.desc()
+
+def find(name, house_id, start=None, end=None, end_inclusive=False):
+    """ Return record of metric for house X in date range, or None without data.
+
+    Whole months and years are read from the index. The partial months at the
+    edges, the latest indexed month and any month missing from the index are
+    scanned in the source table.
+    """
+
+    metric = METRICS[name]
+
+    first = None
+    if start is not None:
+        first = month_start(start)
+        if as_datetime(first) < start:
+            first = next_month(first)
+
+    last = month_start(end) if end is not None else None
+
+    # the latest month may still be receiving data
+    latest = db_session.query(func.max(Extremes.start_date)).\
+        filter(Extremes.house_id == house_id).\
+        filter(Extremes.metric == name).\
+        filter(Extremes.period == 'month').scalar()
+
+    if latest is not None:
+        last = latest if last is None else min(last, latest)
+
+    if latest is None or (first is not None and first >= last):
+        return best(metric, [scan(metric, house_id, start, end, end_inclusive)])
+
+    rows = db_session.query(Extremes).\
+        filter(Extremes.house_id == house_id).\
+        filter(Extremes.metric == name).\
+        filter(Extremes.start_date < last)
+
+    if first is not None:
+        rows = rows.filter(Extremes.start_date >= first)
+
+    rows = rows.all()
+    if first is None:
+        first = min([row.start_date for row in rows] + [last])
+
+    years = set(row.start_date.year for row in rows if row.period == 'year'
+                and row.start_date >= first and next_year(row.start_date) <= last)
+    months = dict((row.start_date, row) for row in rows if row.period == 'month')
+
+    candidates = [Record(row.date, row.value) for row in rows
+                  if row.period == 'year' and row.start_date.year in years]
+
+    # months not covered by a year row, read from the index or scanned when missing
+    gap = None
+    month = first
+    while month < last:
+        if month.year in years or month in months:
+            if gap is not None:
+                candidates.append(scan(metric, house_id, gap, month))
+                gap = None
+        if month.year in years:
+            month = next_year(month)
+            continue
+        if month in months:
+            candidates.append(Record(months[month].date, months[month].value))
+        elif gap is None:
+            gap = month
+        month = next_month(month)
+
+    if gap is not None:
+        candidates.append(scan(metric, house_id, gap, last))
+
+    if start is not None and start < as_datetime(first):
+        candidates.append(scan(metric, house_id, start, first))
+
+    candidates.append(scan(metric, house_id, last, end, end_inclusive))
+
+    return best(metric, candidates)
+
+def scan(metric, house_id, start, end, end_inclusive=False):
+    """ Return record in source table rows between start and end, or None. """
+
+    table = metric.table
+    column = getattr(table, metric.column)
+
+    query = db_session.query(table.date, column).\
+        filter(table.house_id == house_id).\
+        filter(column != None).\
+        filter(*metric.filters(table))
+
+    if start is not None:
+        query = query.filter(table.date >= start)
+    if end is not None and end_inclusive:
+        query = query.filter(table.date <= end)
+    elif end is not None:
+        query = query.filter(table.date < end)
+
+    row = query.order_by(ordered(column, metric.direction), table.date).first()
+    if row is None:
+        return None
+
+    return Record(row[0], row[1])
+
+def best(metric, candidates):
+    """ Return the record among candidates, earliest first on ties. Dates and values
+    are returned with the source column's types. """
+
+    candidates = [record for record in candidates if record is not None]
+    if not candidates:
+        return None
+
+    if metric.direction == 'min':
+        record = min(candidates, key=lambda record: (record.value, record.date))
+    else:
+        record = min(candidates, key=lambda record: (-record.value, record.date))
+
+    date = record.date
+    if metric.table.grain != 'hour' and isinstance(date, datetime.datetime):
+        date = date.date()
+
+    scale = getattr(metric.table, metric.column).type.scale
+    value = record.value.quantize(Decimal(1).scaleb(-scale))
+
+    return Record(date, value)
+
+def as_datetime(date):
+    """ Return date as datetime at midnight. """
+
+    return datetime.datetime.combine(date, datetime.time())
+
+def month_start(date):
+    """ Return first day of month of date. """
+
+    return datetime.date(date.year, date.month, 1)
+
+def next_month(date):
+    """ Return first day of month after date. """
+
+    if date.month == 12:
+        return datetime.date(date.year + 1, 1, 1)
+
+    return datetime.date(date.year, date.month + 1, 1)
+
+def next_year(date):
+    """ Return first day of year after date. """
+
+    return datetime.date(date.year + 1, 1, 1)
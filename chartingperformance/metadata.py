@@ -0,0 +1,131 @@
+""" In-memory house metadata """
+# pylint: disable=no-member
+import threading
+
+from collections import namedtuple
+
+from chartingperformance import db_session
+from chartingperformance.registry import circuit_registry
+
+from chartingperformance.models import Houses
+from chartingperformance.models import MonitorDevices
+from chartingperformance.models import EnergyMonthly
+from chartingperformance.models import LimitsHourly
+
+from sqlalchemy import func
+from sqlalchemy.exc import SQLAlchemyError
+
+House = namedtuple('House', ['house_id', 'name', 'sname', 'iga', 'ciga', 'ega',
+                             'devices', 'years', 'limits'])
+Device = namedtuple('Device', ['device_id', 'name'])
+Limits = namedtuple('Limits', ['used_max', 'solar_min', 'outdoor_deg_min', 'outdoor_deg_max',
+                               'hdd_max', 'start_date', 'end_date'])
+
+class Metadata(object):
+    """ Houses with their devices, years of energy data and limits, read in one pass
+    and served from memory. A house is reread after its watermark advances. """
+
+    def __init__(self):
+        self.houses = {}
+        self.house_ids = None
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        """ Load every house now if METADATA_WARMUP is set. If the database is not
+        up yet, the first request loads them instead. """
+
+        if not app.config['METADATA_WARMUP']:
+            return
+
+        with app.app_context():
+            try:
+                self.load()
+            except SQLAlchemyError:
+                app.logger.warning('House metadata not loaded at startup', exc_info=True)
+
+    def get_houses(self):
+        """ Return list of House of every house. """
+
+        with self.lock:
+            house_ids = self.house_ids
+        if house_ids is None:
+            return self.load()
+
+        houses = [self.get(house_id) for house_id in house_ids]
+
+        return [house for house in houses if house is not None]
+
+    def get(self, house_id):
+        """ Return House of house X, None if there is no such house. """
+
+        house_id = str(house_id)
+
+        with self.lock:
+            house = self.houses.get(house_id)
+        if house is not None:
+            return house
+
+        houses = self.load([house_id])
+
+        return houses[0] if houses else None
+
+    def load(self, house_ids=None):
+        """ Read the listed houses, or all houses, and warm their circuits.
+        Returns list of House. """
+
+        houses = db_session.query(Houses)
+        devices = db_session.query(MonitorDevices.house_id, MonitorDevices.device_id,
+                                   MonitorDevices.name)
+        years = db_session.query(EnergyMonthly.house_id, func.year(EnergyMonthly.date)).\
+            group_by(EnergyMonthly.house_id, func.year(EnergyMonthly.date)).\
+            order_by(EnergyMonthly.house_id, func.year(EnergyMonthly.date))
+        limits = db_session.query(LimitsHourly)
+
+        if house_ids is not None:
+            houses = houses.filter(Houses.house_id.in_(house_ids))
+            devices = devices.filter(MonitorDevices.house_id.in_(house_ids))
+            years = years.filter(EnergyMonthly.house_id.in_(house_ids))
+            limits = limits.filter(LimitsHourly.house_id.in_(house_ids))
+
+        house_devices = {}
+        for house_id, device_id, name in devices:
+            house_devices.setdefault(house_id, []).append(Device(device_id, name))
+
+        house_years = {}
+        for house_id, year in years:
+            house_years.setdefault(house_id, []).append(str(year))
+
+        house_limits = dict((row.house_id, Limits(*[getattr(row, field)
+                                                     for field in Limits._fields]))
+                            for row in limits)
+
+        loaded = [House(house.house_id, house.name, house.sname,
+                        house.iga, house.ciga, house.ega,
+                        house_devices.get(house.house_id, []),
+                        house_years.get(house.house_id, []),
+                        house_limits.get(house.house_id))
+                  for house in houses]
+
+        with self.lock:
+            for house in loaded:
+                self.houses[str(house.house_id)] = house
+            if house_ids is None:
+                self.house_ids = [str(house.house_id) for house in loaded]
+
+        for house in loaded:
+            circuit_registry.refresh(house.house_id)
+
+        return loaded
+
+    def invalidate(self, house_id=None, watermark=None): # pylint: disable=unused-argument
+        """ Drop house X, or every house, to be reread on next use. Also a watermark
+        listener. The house list is reread too, to pick up new houses. """
+
+        with self.lock:
+            self.house_ids = None
+            if house_id is None:
+                self.houses.clear()
+            else:
+                self.houses.pop(str(house_id), None)
+
+metadata = Metadata()
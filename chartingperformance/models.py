@@ -3,10 +3,25 @@
 # pylint: disable=too-few-public-methods
 # pylint: disable=missing-docstring
 from sqlalchemy import Column, Integer, Date, DateTime, Numeric, String, ForeignKey
+from sqlalchemy import Computed, Index
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import deferred
 
 Base = declarative_base()
 
+# Sub-metered circuits recorded by the eMonitor (device 5) and eGauge (device 10).
+CIRCUITS = ['water_heater', 'ashp', 'water_pump', 'dryer', 'washer',
+            'dishwasher', 'stove', 'refrigerator', 'living_room',
+            'aux_heat_bedrooms', 'aux_heat_living', 'study', 'barn',
+            'basement_west', 'basement_east', 'ventilation',
+            'ventilation_preheat', 'kitchen_recept_rt']
+
+# Stored bucket columns let interval grouping follow the (house_id, bucket, date) indexes.
+# They are deferred, so rows still load before `flask add-buckets` has added them.
+BUCKET_DAY = "CAST(date AS DATE)"
+BUCKET_MONTH = "SUBDATE(CAST(date AS DATE), DAYOFMONTH(date) - 1)"
+BUCKET_YEAR = "MAKEDATE(YEAR(date), 1)"
+
 class Houses(Base):
     __tablename__ = 'houses'
     house_id = Column(Integer, primary_key=True, autoincrement=False)
@@ -31,9 +46,18 @@ class Circuits(Base):
 
 class EnergyHourly(Base):
     __tablename__ = 'energy_hourly'
+    __table_args__ = (Index('ix_energy_hourly_bucket_day', 'house_id', 'bucket_day', 'date'),
+                      Index('ix_energy_hourly_bucket_month', 'house_id', 'bucket_month', 'date'),
+                      Index('ix_energy_hourly_bucket_year', 'house_id', 'bucket_year', 'date'),
+                      Index('ix_energy_hourly_date', 'house_id', 'date'))
+    grain = 'hour'
+    divisor = 1000
     house_id = Column(Integer, ForeignKey('houses.house_id'), primary_key=True)
     device_id = Column(Integer, ForeignKey('monitor_devices.device_id'), primary_key=True)
     date = Column(DateTime, primary_key=True)
+    bucket_day = deferred(Column(Date, Computed(BUCKET_DAY, persisted=True)))
+    bucket_month = deferred(Column(Date, Computed(BUCKET_MONTH, persisted=True)))
+    bucket_year = deferred(Column(Date, Computed(BUCKET_YEAR, persisted=True)))
     adjusted_load = Column(Numeric(precision=14, scale=6))
     solar = Column(Numeric(precision=14, scale=6))
     used = Column(Numeric(precision=14, scale=6))
@@ -58,9 +82,15 @@ class EnergyHourly(Base):
 
 class EnergyDaily(Base):
     __tablename__ = 'energy_daily'
+    __table_args__ = (Index('ix_energy_daily_bucket_month', 'house_id', 'bucket_month', 'date'),
+                      Index('ix_energy_daily_bucket_year', 'house_id', 'bucket_year', 'date'))
+    grain = 'day'
+    divisor = 1
     house_id = Column(Integer, ForeignKey('houses.house_id'), primary_key=True)
     device_id = Column(Integer, ForeignKey('monitor_devices.device_id'), primary_key=True)
     date = Column(Date, primary_key=True)
+    bucket_month = deferred(Column(Date, Computed(BUCKET_MONTH, persisted=True)))
+    bucket_year = deferred(Column(Date, Computed(BUCKET_YEAR, persisted=True)))
     adjusted_load = Column(Numeric(precision=14, scale=9))
     solar = Column(Numeric(precision=14, scale=9))
     used = Column(Numeric(precision=14, scale=9))
@@ -85,9 +115,13 @@ class EnergyDaily(Base):
 
 class EnergyMonthly(Base):
     __tablename__ = 'energy_monthly'
+    __table_args__ = (Index('ix_energy_monthly_bucket_year', 'house_id', 'bucket_year', 'date'),)
+    grain = 'month'
+    divisor = 1
     house_id = Column(Integer, ForeignKey('houses.house_id'), primary_key=True)
     device_id = Column(Integer, ForeignKey('monitor_devices.device_id'), primary_key=True)
     date = Column(Date, primary_key=True)
+    bucket_year = deferred(Column(Date, Computed(BUCKET_YEAR, persisted=True)))
     adjusted_load = Column(Numeric(precision=14, scale=9))
     solar = Column(Numeric(precision=14, scale=9))
     used = Column(Numeric(precision=14, scale=9))
@@ -112,24 +146,30 @@ class EnergyMonthly(Base):
 
 class HDDMonthly(Base):
     __tablename__ = 'hdd_monthly'
+    __table_args__ = (Index('ix_hdd_monthly_bucket_year', 'house_id', 'bucket_year', 'date'),)
+    grain = 'month'
     house_id = Column(Integer, ForeignKey('houses.house_id'), primary_key=True)
     date = Column(Date, primary_key=True)
+    bucket_year = deferred(Column(Date, Computed(BUCKET_YEAR, persisted=True)))
     hdd = Column(Numeric(precision=7, scale=3))
 
 class HDDDaily(Base):
     __tablename__ = 'hdd_daily'
+    grain = 'day'
     house_id = Column(Integer, ForeignKey('houses.house_id'), primary_key=True)
     date = Column(Date, primary_key=True)
     hdd = Column(Numeric(precision=6, scale=3))
 
 class HDDHourly(Base):
     __tablename__ = 'hdd_hourly'
+    grain = 'hour'
     house_id = Column(Integer, ForeignKey('houses.house_id'), primary_key=True)
     date = Column(DateTime, primary_key=True)
     hdd = Column(Numeric(precision=6, scale=3))
 
 class EstimatedMonthly(Base):
     __tablename__ = 'estimated_monthly'
+    grain = 'month'
     house_id = Column(Integer, ForeignKey('houses.house_id'), primary_key=True)
     date = Column(Date, primary_key=True)
     solar = Column(Numeric(precision=4))
@@ -139,6 +179,7 @@ class EstimatedMonthly(Base):
 
 class TemperatureDaily(Base):
     __tablename__ = 'temperature_daily'
+    grain = 'day'
     house_id = Column(Integer, ForeignKey('houses.house_id'), primary_key=True)
     device_id = Column(Integer, ForeignKey('monitor_devices.device_id'), primary_key=True)
     date = Column(Date, primary_key=True)
@@ -149,14 +190,30 @@ class TemperatureDaily(Base):
 
 class TemperatureHourly(Base):
     __tablename__ = 'temperature_hourly'
+    __table_args__ = (Index('ix_temperature_hourly_bucket_day', 'house_id', 'bucket_day', 'date'),
+                      Index('ix_temperature_hourly_bucket_month', 'house_id', 'bucket_month', 'date'),
+                      Index('ix_temperature_hourly_bucket_year', 'house_id', 'bucket_year', 'date'))
+    grain = 'hour'
     house_id = Column(Integer, ForeignKey('houses.house_id'), primary_key=True)
     device_id = Column(Integer, ForeignKey('monitor_devices.device_id'), primary_key=True)
     date = Column(DateTime, primary_key=True)
+    bucket_day = deferred(Column(Date, Computed(BUCKET_DAY, persisted=True)))
+    bucket_month = deferred(Column(Date, Computed(BUCKET_MONTH, persisted=True)))
+    bucket_year = deferred(Column(Date, Computed(BUCKET_YEAR, persisted=True)))
     temperature = Column(Numeric(precision=6, scale=3))
     humidity = Column(Numeric(precision=6, scale=3))
 
 class WaterMonthly(Base):
     __tablename__ = 'water_monthly'
+    grain = 'month'
+    house_id = Column(Integer, ForeignKey('houses.house_id'), primary_key=True)
+    device_id = Column(Integer, ForeignKey('monitor_devices.device_id'), primary_key=True)
+    date = Column(Date, primary_key=True)
+    gallons = Column(Numeric(precision=7, scale=1))
+
+class WaterDaily(Base):
+    __tablename__ = 'water_daily'
+    grain = 'day'
     house_id = Column(Integer, ForeignKey('houses.house_id'), primary_key=True)
     device_id = Column(Integer, ForeignKey('monitor_devices.device_id'), primary_key=True)
     date = Column(Date, primary_key=True)
@@ -172,3 +229,78 @@ class LimitsHourly(Base):
     hdd_max = Column(Numeric(precision=4, scale=3))
     start_date = Column(DateTime)
     end_date = Column(DateTime)
+
+# Rollups of energy_hourly devices 5 and 10, in kWh. Maintained by rollup.py.
+class CircuitDaily(Base):
+    __tablename__ = 'circuit_daily'
+    __table_args__ = (Index('ix_circuit_daily_bucket_month', 'house_id', 'bucket_month', 'date'),
+                      Index('ix_circuit_daily_bucket_year', 'house_id', 'bucket_year', 'date'))
+    grain = 'day'
+    divisor = 1
+    house_id = Column(Integer, ForeignKey('houses.house_id'), primary_key=True)
+    date = Column(Date, primary_key=True)
+    bucket_month = deferred(Column(Date, Computed(BUCKET_MONTH, persisted=True)))
+    bucket_year = deferred(Column(Date, Computed(BUCKET_YEAR, persisted=True)))
+    used = Column(Numeric(precision=14, scale=9))
+    water_heater = Column(Numeric(precision=14, scale=9))
+    ashp = Column(Numeric(precision=14, scale=9))
+    water_pump = Column(Numeric(precision=14, scale=9))
+    dryer = Column(Numeric(precision=14, scale=9))
+    washer = Column(Numeric(precision=14, scale=9))
+    dishwasher = Column(Numeric(precision=14, scale=9))
+    stove = Column(Numeric(precision=14, scale=9))
+    refrigerator = Column(Numeric(precision=14, scale=9))
+    living_room = Column(Numeric(precision=14, scale=9))
+    aux_heat_bedrooms = Column(Numeric(precision=14, scale=9))
+    aux_heat_living = Column(Numeric(precision=14, scale=9))
+    study = Column(Numeric(precision=14, scale=9))
+    barn = Column(Numeric(precision=14, scale=9))
+    basement_west = Column(Numeric(precision=14, scale=9))
+    basement_east = Column(Numeric(precision=14, scale=9))
+    ventilation = Column(Numeric(precision=14, scale=9))
+    ventilation_preheat = Column(Numeric(precision=14, scale=9))
+    kitchen_recept_rt = Column(Numeric(precision=14, scale=9))
+
+class CircuitMonthly(Base):
+    __tablename__ = 'circuit_monthly'
+    __table_args__ = (Index('ix_circuit_monthly_bucket_year', 'house_id', 'bucket_year', 'date'),)
+    grain = 'month'
+    divisor = 1
+    house_id = Column(Integer, ForeignKey('houses.house_id'), primary_key=True)
+    date = Column(Date, primary_key=True)
+    bucket_year = deferred(Column(Date, Computed(BUCKET_YEAR, persisted=True)))
+    used = Column(Numeric(precision=14, scale=9))
+    water_heater = Column(Numeric(precision=14, scale=9))
+    ashp = Column(Numeric(precision=14, scale=9))
+    water_pump = Column(Numeric(precision=14, scale=9))
+    dryer = Column(Numeric(precision=14, scale=9))
+    washer = Column(Numeric(precision=14, scale=9))
+    dishwasher = Column(Numeric(precision=14, scale=9))
+    stove = Column(Numeric(precision=14, scale=9))
+    refrigerator = Column(Numeric(precision=14, scale=9))
+    living_room = Column(Numeric(precision=14, scale=9))
+    aux_heat_bedrooms = Column(Numeric(precision=14, scale=9))
+    aux_heat_living = Column(Numeric(precision=14, scale=9))
+    study = Column(Numeric(precision=14, scale=9))
+    barn = Column(Numeric(precision=14, scale=9))
+    basement_west = Column(Numeric(precision=14, scale=9))
+    basement_east = Column(Numeric(precision=14, scale=9))
+    ventilation = Column(Numeric(precision=14, scale=9))
+    ventilation_preheat = Column(Numeric(precision=14, scale=9))
+    kitchen_recept_rt = Column(Numeric(precision=14, scale=9))
+
+# Latest energy_hourly hour included in each house's circuit rollups. Maintained by rollup.py.
+class RollupLimits(Base):
+    __tablename__ = 'rollup_limits'
+    house_id = Column(Integer, ForeignKey('houses.house_id'), primary_key=True)
+    end_date = Column(DateTime)
+
+# Record value and date per house, metric and calendar month or year. Maintained by extremes.py.
+class Extremes(Base):
+    __tablename__ = 'extremes'
+    house_id = Column(Integer, ForeignKey('houses.house_id'), primary_key=True)
+    metric = Column(String(32), primary_key=True)
+    period = Column(String(8), primary_key=True)
+    start_date = Column(Date, primary_key=True)
+    date = Column(DateTime)
+    value = Column(Numeric(precision=14, scale=9))
@@ -0,0 +1,176 @@
+""" Database connection pool configuration and statistics """
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+def engine_options(config):
+    """ Return create_engine pool arguments from app config. """
+
+    return {'poolclass': InstrumentedQueuePool,
+            'pool_size': config['POOL_SIZE'],
+            'max_overflow': config['POOL_MAX_OVERFLOW'],
+            'pool_timeout': config['POOL_TIMEOUT'],
+            'pool_recycle': config['POOL_RECYCLE']}
+
+class PoolStats(object):
+    """ Counters shared by a pool and the pools recreated from it. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.connects = 0
+        self.pings = 0
+        self.ping_failures = 0
+        self.invalidations = 0
+        self.invalidated_at = None
+
+    def add(self, **counts):
+        """ Add counts to counters. """
+
+        with self.lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def add_wait(self, wait):
+        """ Count a checkout that waited wait seconds for a connection. """
+
+        with self.lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+class InstrumentedQueuePool(QueuePool):
+    """ QueuePool that times how long checkouts wait for a connection,
+    including opening a new one. """
+
+    def __init__(self, creator, **kw):
+        super(InstrumentedQueuePool, self).__init__(creator, **kw)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        started = time.monotonic()
+        try:
+            connection = super(InstrumentedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            self.stats.add(timeouts=1)
+            raise
+        self.stats.add_wait(time.monotonic() - started)
+        return connection
+
+    def recreate(self):
+        pool = super(InstrumentedQueuePool, self).recreate()
+        pool.stats = self.stats
+        return pool
+
+class PoolMonitor(object):
+    """ Checks connections are alive only when they may not be: after sitting idle
+    longer than POOL_LIVENESS_IDLE, or when checked in before the last invalidation.
+    Other checkouts skip the round trip. """
+
+    def __init__(self):
+        self.engine = None
+        self.liveness_idle = 0
+
+    def init_app(self, app, engine):
+        """ Read settings from app config, listen to engine's pool and open
+        POOL_WARM connections. If the database is not up yet, they open on demand. """
+
+        self.engine = engine
+        self.liveness_idle = app.config['POOL_LIVENESS_IDLE']
+
+        event.listen(engine.pool, 'connect', self.on_connect)
+        event.listen(engine.pool, 'checkin', self.on_checkin)
+        event.listen(engine.pool, 'checkout', self.on_checkout)
+        event.listen(engine.pool, 'invalidate', self.on_invalidate)
+        event.listen(engine.pool, 'soft_invalidate', self.on_invalidate)
+
+        try:
+            self.warm(app.config['POOL_WARM'])
+        except exc.SQLAlchemyError:
+            app.logger.warning('Connection pool not warmed at startup', exc_info=True)
+
+    def warm(self, count):
+        """ Open count connections and return them to the pool. """
+
+        connections = []
+        try:
+            for _ in range(count):
+                connections.append(self.engine.connect())
+        finally:
+            for connection in connections:
+                connection.close()
+
+    @property
+    def stats(self):
+        """ Return counters of the engine's pool. """
+
+        return self.engine.pool.stats
+
+    def on_connect(self, dbapi_connection, connection_record): # pylint: disable=unused-argument
+        """ Count new connection. """
+
+        self.stats.add(connects=1)
+
+    @classmethod
+    def on_checkin(cls, dbapi_connection, connection_record): # pylint: disable=unused-argument
+        """ Note when connection went idle. """
+
+        connection_record.info['checkin_time'] = time.monotonic()
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy): # pylint: disable=unused-argument
+        """ Ping connection if it may have gone away. The pool retries with a new
+        connection when this raises DisconnectionError. """
+
+        checkin_time = connection_record.info.get('checkin_time')
+        if checkin_time is None:
+            return
+
+        invalidated_at = self.stats.invalidated_at
+        if time.monotonic() - checkin_time < self.liveness_idle and \
+           (invalidated_at is None or checkin_time > invalidated_at):
+            return
+
+        self.stats.add(pings=1)
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("SELECT 1")
+        except Exception:
+            self.stats.add(ping_failures=1)
+            raise exc.DisconnectionError()
+        finally:
+            cursor.close()
+
+    def on_invalidate(self, dbapi_connection, connection_record, exception): # pylint: disable=unused-argument
+        """ Count invalidation. Idle connections checked in before it get pinged. """
+
+        self.stats.add(invalidations=1)
+        self.stats.invalidated_at = time.monotonic()
+
+    def get_stats(self):
+        """ Return pool state and counters as dict. """
+
+        pool = self.engine.pool
+        stats = self.stats
+
+        with stats.lock:
+            return {'size': pool.size(),
+                    'checked_in': pool.checkedin(),
+                    'checked_out': pool.checkedout(),
+                    'overflow': max(pool.overflow(), 0),
+                    'checkouts': stats.checkouts,
+                    'wait_total': round(stats.wait_total, 6),
+                    'wait_max': round(stats.wait_max, 6),
+                    'wait_mean': round(stats.wait_total / stats.checkouts, 6)
+                                 if stats.checkouts else 0.0,
+                    'timeouts': stats.timeouts,
+                    'connects': stats.connects,
+                    'pings': stats.pings,
+                    'ping_failures': stats.ping_failures,
+                    'invalidations': stats.invalidations}
+
+pool_monitor = PoolMonitor()
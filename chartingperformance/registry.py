@@ -0,0 +1,63 @@
+""" Process-wide circuit metadata """
+# pylint: disable=no-member
+import threading
+import time
+
+from collections import OrderedDict, namedtuple
+
+from chartingperformance import db_session
+from chartingperformance.models import Circuits
+
+Circuit = namedtuple('Circuit', ['circuit_id', 'name', 'description'])
+
+class CircuitRegistry(object):
+    """ Circuits of each house keyed by circuit_id, read from the circuits table at most
+    once per TTL. Rows are copied into tuples, so they outlive the session. """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.houses = {}
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        """ Read settings from app config. """
+
+        self.ttl = app.config['CIRCUIT_TTL']
+
+    def get(self, house_id):
+        """ Return OrderedDict of circuit_id to Circuit for house X, in table order. """
+
+        house_id = str(house_id)
+        now = time.monotonic()
+
+        with self.lock:
+            cached = self.houses.get(house_id)
+        if cached is not None and now - cached[1] < self.ttl:
+            return cached[0]
+
+        return self.refresh(house_id)
+
+    def refresh(self, house_id):
+        """ Reload circuits of house X from database. """
+
+        house_id = str(house_id)
+        rows = db_session.query(Circuits).filter(Circuits.house_id == house_id).all()
+        circuits = OrderedDict((row.circuit_id, Circuit(row.circuit_id, row.name, row.description))
+                               for row in rows)
+
+        with self.lock:
+            self.houses[house_id] = (circuits, time.monotonic())
+
+        return circuits
+
+    def invalidate(self, house_id=None, watermark=None): # pylint: disable=unused-argument
+        """ Drop circuits of house X, or of every house. Also a watermark listener,
+        so circuits added by a data load show up with its data. """
+
+        with self.lock:
+            if house_id is None:
+                self.houses.clear()
+            else:
+                self.houses.pop(str(house_id), None)
+
+circuit_registry = CircuitRegistry()
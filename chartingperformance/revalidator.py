@@ -0,0 +1,75 @@
+""" Background refresh of stale view responses """
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+class Revalidator(object):
+    """ Refreshes stale cached responses on a small thread pool while the stale copy
+    is served, at most one refresh per key queued at a time. The pool is created on
+    first use in each process, so it is never carried across a fork. """
+
+    def __init__(self):
+        self.app = None
+        self.workers = 0
+        self.stale_while_revalidate = 0
+        self.stale_if_error = 0
+        self.pool = None
+        self.pid = None
+        self.pending = set()
+        self.refreshed = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        """ Read settings from app config. Without workers stale responses are
+        only served when computing fails. """
+
+        self.app = app
+        self.workers = app.config['REVALIDATE_WORKERS']
+        self.stale_while_revalidate = app.config['STALE_WHILE_REVALIDATE'] if self.workers else 0
+        self.stale_if_error = app.config['STALE_IF_ERROR']
+
+    def submit(self, key, function, *args):
+        """ Call function(*args) in the background, unless a refresh of key is already queued. """
+
+        with self.lock:
+            if self.pool is None or self.pid != os.getpid():
+                self.pool = ThreadPoolExecutor(max_workers=self.workers,
+                                               thread_name_prefix='revalidate')
+                self.pid = os.getpid()
+                self.pending = set()
+            if key in self.pending:
+                return
+            self.pending.add(key)
+            pool = self.pool
+
+        pool.submit(self.run, key, function, *args)
+
+    def run(self, key, function, *args):
+        """ Call function in an app context, logging a failure. The stale copy stays
+        cached, to be served until the next refresh succeeds. """
+
+        with self.app.app_context():
+            try:
+                function(*args)
+                with self.lock:
+                    self.refreshed += 1
+            except Exception: # pylint: disable=broad-except
+                self.app.logger.warning('Stale %s of house %s not refreshed', key[0], key[1],
+                                        exc_info=True)
+                with self.lock:
+                    self.failed += 1
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+
+    def stats(self):
+        """ Return counters as dict. """
+
+        with self.lock:
+            return {'pending': len(self.pending),
+                    'refreshed': self.refreshed,
+                    'failed': self.failed}
+
+revalidator = Revalidator()
@@ -0,0 +1,110 @@
+""" Circuit rollup maintenance """
+# pylint: disable=no-member
+from chartingperformance import db_session
+
+from chartingperformance.models import Base
+from chartingperformance.models import CIRCUITS
+from chartingperformance.models import EnergyHourly
+from chartingperformance.models import CircuitDaily
+from chartingperformance.models import CircuitMonthly
+from chartingperformance.models import LimitsHourly
+from chartingperformance.models import RollupLimits
+
+from flask import current_app
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.sql import label, or_, literal_column
+
+COLUMNS = ['used'] + CIRCUITS
+
+def create_tables():
+    """ Create rollup tables if they do not exist yet. """
+
+    Base.metadata.create_all(db_session.get_bind(), tables=[CircuitDaily.__table__,
+                                                            CircuitMonthly.__table__,
+                                                            RollupLimits.__table__])
+
+def get_end_date(house_id):
+    """ Return latest hour included in the rollups of house X, None if never built. """
+
+    return db_session.query(RollupLimits.end_date).\
+        filter(RollupLimits.house_id == house_id).scalar()
+
+def on_watermark(house_id, watermark):
+    """ Refresh rollups of house X up to watermark, if they have been built and are
+    behind it. Run by the cache warmer before it warms views. """
+
+    if not current_app.config['CIRCUIT_ROLLUPS'] or watermark is None:
+        return
+
+    end_date = get_end_date(house_id)
+    if end_date is None or end_date >= watermark:
+        return
+
+    build_rollups(house_id, until=watermark)
+
+def build_rollups(house_id, full=False, until=None):
+    """ Refresh daily and monthly circuit rollups for house X with hours up to until,
+    by default limits_hourly.end_date, and record until as their end date.
+
+    Only the latest stored month onward is rebuilt, unless full is set,
+    so this is cheap to run after every data load.
+    """
+
+    if until is None:
+        until = db_session.query(LimitsHourly.end_date).\
+            filter(LimitsHourly.house_id == house_id).scalar()
+
+    since = None
+    if not full:
+        latest = db_session.query(func.max(CircuitDaily.date)).\
+            filter(CircuitDaily.house_id == house_id).scalar()
+        if latest is not None:
+            since = latest.replace(day=1)
+
+    day = func.date(EnergyHourly.date)
+
+    daily = select([EnergyHourly.house_id, label('date', day)] +
+                   [label(circuit, func.sum(getattr(EnergyHourly, circuit)) /
+                          EnergyHourly.divisor)
+                    for circuit in COLUMNS]).\
+        where(EnergyHourly.house_id == house_id).\
+        where(or_(EnergyHourly.device_id == 5,
+                  EnergyHourly.device_id == 10)).\
+        group_by(EnergyHourly.house_id, day)
+
+    if since is not None:
+        daily = daily.where(EnergyHourly.date >= since)
+    if until is not None:
+        daily = daily.where(EnergyHourly.date <= until)
+
+    upsert(CircuitDaily, daily)
+
+    month = func.subdate(CircuitDaily.date,
+                         func.dayofmonth(CircuitDaily.date) - literal_column('1'))
+
+    monthly = select([CircuitDaily.house_id, label('date', month)] +
+                     [label(circuit, func.sum(getattr(CircuitDaily, circuit)))
+                      for circuit in COLUMNS]).\
+        where(CircuitDaily.house_id == house_id).\
+        group_by(CircuitDaily.house_id, month)
+
+    if since is not None:
+        monthly = monthly.where(CircuitDaily.date >= since)
+
+    upsert(CircuitMonthly, monthly)
+
+    stmt = insert(RollupLimits.__table__).values(house_id=house_id, end_date=until)
+    db_session.execute(stmt.on_duplicate_key_update(end_date=stmt.inserted.end_date))
+
+    db_session.commit()
+
+def upsert(table, query):
+    """ Insert rows from query into table, replacing rows with the same key. """
+
+    stmt = insert(table.__table__).from_select(['house_id', 'date'] + COLUMNS, query)
+    stmt = stmt.on_duplicate_key_update({circuit: stmt.inserted[circuit]
+                                         for circuit in COLUMNS})
+
+    db_session.execute(stmt)
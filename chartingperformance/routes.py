@@ -1,14 +1,5 @@
 """ Flask routing """
 # pylint: disable=no-member
-from chartingperformance import app
-from chartingperformance import db_session
-
-from chartingperformance.models import Houses
-from chartingperformance.models import MonitorDevices
-from chartingperformance.models import EnergyMonthly
-from chartingperformance.models import EnergyHourly
-from chartingperformance.models import LimitsHourly
-
 from chartingperformance.views.circuit import CircuitDict
 from chartingperformance.views.summary import Summary
 from chartingperformance.views.generation import Generation
@@ -17,42 +8,67 @@ from chartingperformance.views.hdd import Hdd
 from chartingperformance.views.temperature import Temperature
 from chartingperformance.views.water import Water
 from chartingperformance.views.basetemp import Basetemp
+from chartingperformance.views.balancepoint import BalancePoint
 from chartingperformance.views.heatmap import Heatmap
 from chartingperformance.views.chart import Chart
-
-from flask import request, jsonify, url_for, make_response, render_template
-
-from sqlalchemy import func
-
-@app.errorhandler(404)
+from chartingperformance.views.export import Export
+
+from chartingperformance.serving import serve_view
+from chartingperformance.serving import serve_batch
+from chartingperformance.watermark import watermarks
+from chartingperformance.metadata import metadata
+from chartingperformance.pool import pool_monitor
+from chartingperformance.cache import response_cache, shared_cache
+from chartingperformance.singleflight import single_flight
+from chartingperformance.revalidator import revalidator
+from chartingperformance.warmer import cache_warmer
+
+from flask import Blueprint, current_app
+from flask import request, jsonify, url_for, make_response, render_template, abort
+
+api = Blueprint('api', __name__)
+
+# Views that can be requested together from views/batch/
+BATCH_VIEWS = {'summary': Summary,
+               'generation': Generation,
+               'usage': Usage,
+               'hdd': Hdd,
+               'temperature': Temperature,
+               'water': Water,
+               'basetemp': Basetemp,
+               'balancepoint': BalancePoint,
+               'heatmap': Heatmap,
+               'chart': Chart}
+
+@api.app_errorhandler(404)
 def not_found(error):
     """ Return page not found error in json. """
     return make_response(jsonify({'error': 'Not found'}), 404)
 
-@app.route("/")
+@api.route("/")
 def index():
     """ Return homepage. """
     return render_template('index.html')
 
-@app.route('/api/houses/', methods=['GET'])
+@api.route('/api/houses/', methods=['GET'])
 def get_houses():
     """ Return list of houses. """
 
     return jsonify(houses=get_houses_all())
 
-@app.route('/api/houses/<house_id>/', methods=['GET'])
+@api.route('/api/houses/<house_id>/', methods=['GET'])
 def get_house(house_id):
     """ Return details for house X. """
 
     return jsonify(house=get_house_details(house_id))
 
-@app.route('/api/houses/<house_id>/devices/', methods=['GET'])
+@api.route('/api/houses/<house_id>/devices/', methods=['GET'])
 def get_devices(house_id):
     """ Return list of devices for house X. """
 
     return jsonify(devices=get_devices_all(house_id))
 
-@app.route('/api/houses/<house_id>/circuits/', methods=['GET'])
+@api.route('/api/houses/<house_id>/circuits/', methods=['GET'])
 def get_circuits(house_id):
     """ Return list of circuits for house X. """
 
@@ -60,136 +76,158 @@ def get_circuits(house_id):
 
     return circuits.get_response()
 
-@app.route('/api/houses/<house_id>/views/', methods=['GET'])
+@api.route('/api/houses/<house_id>/views/', methods=['GET'])
 def views(house_id):
     """ Return list of available views for house X. """
 
     return jsonify(views=get_views(house_id))
 
-@app.route('/api/houses/<house_id>/views/default/', methods=['GET'])
+@api.route('/api/houses/<house_id>/views/default/', methods=['GET'])
 def setup(house_id):
     """ Return default values for houses X views. """
 
-    interval = request.args.get('interval', 'months')
+    return jsonify(get_defaults(house_id, request.args))
 
-    if 'month' in interval:
-        return jsonify(years=get_years(house_id),
-                       asof=get_asof_date(house_id),
-                       house=get_house_details(house_id))
-    elif 'day' in interval:
-        return jsonify(limits=get_limits(house_id))
-    else:
-        return jsonify(error='Interval \'%s\' does not exist' % interval)
-
-@app.route('/api/houses/<house_id>/views/summary/', methods=['GET'])
+@api.route('/api/houses/<house_id>/views/summary/', methods=['GET'])
 def view_summary(house_id):
     """ Return summary view for house X. """
 
-    view = Summary(request.args, house_id)
+    return serve_view('summary', Summary, house_id)
 
-    return view.get_response()
-
-@app.route('/api/houses/<house_id>/views/generation/', methods=['GET'])
+@api.route('/api/houses/<house_id>/views/generation/', methods=['GET'])
 def view_generation(house_id):
     """ Return generation view for house X. """
 
-    view = Generation(request.args, house_id)
-
-    return view.get_response()
+    return serve_view('generation', Generation, house_id)
 
-@app.route('/api/houses/<house_id>/views/usage/', methods=['GET'])
+@api.route('/api/houses/<house_id>/views/usage/', methods=['GET'])
 def view_usage(house_id):
     """ Return usage view for house X. """
 
-    view = Usage(request.args, house_id)
+    return serve_view('usage', Usage, house_id)
 
-    return view.get_response()
-
-@app.route('/api/houses/<house_id>/views/hdd/', methods=['GET'])
+@api.route('/api/houses/<house_id>/views/hdd/', methods=['GET'])
 def view_hdd(house_id):
     """ Return hdd view for house X. """
 
-    view = Hdd(request.args, house_id)
-
-    return view.get_response()
+    return serve_view('hdd', Hdd, house_id)
 
-@app.route('/api/houses/<house_id>/views/temperature/', methods=['GET'])
+@api.route('/api/houses/<house_id>/views/temperature/', methods=['GET'])
 def view_temperature(house_id):
     """ Return temperature view for house X. """
 
-    view = Temperature(request.args, house_id)
-
-    return view.get_response()
+    return serve_view('temperature', Temperature, house_id)
 
-@app.route('/api/houses/<house_id>/views/water/', methods=['GET'])
+@api.route('/api/houses/<house_id>/views/water/', methods=['GET'])
 def view_water(house_id):
     """ Return water view for house X. """
 
-    view = Water(request.args, house_id)
+    return serve_view('water', Water, house_id)
 
-    return view.get_response()
-
-@app.route('/api/houses/<house_id>/views/basetemp/', methods=['GET'])
+@api.route('/api/houses/<house_id>/views/basetemp/', methods=['GET'])
 def view_heat(house_id):
     """ Return basetemp view for house X. """
 
-    view = Basetemp(request.args, house_id)
+    return serve_view('basetemp', Basetemp, house_id)
+
+@api.route('/api/houses/<house_id>/views/balancepoint/', methods=['GET'])
+def view_balancepoint(house_id):
+    """ Return heating balance point fits for house X. """
 
-    return view.get_response()
+    return serve_view('balancepoint', BalancePoint, house_id)
 
-@app.route('/api/houses/<house_id>/views/heatmap/', methods=['GET'])
+@api.route('/api/houses/<house_id>/views/heatmap/', methods=['GET'])
 def view_heatmap(house_id):
     """ Return heatmap daily view for house X. """
 
-    view = Heatmap(request.args, house_id)
+    return serve_view('heatmap', Heatmap, house_id)
 
-    return view.get_response()
-
-@app.route('/api/houses/<house_id>/views/chart/', methods=['GET'])
+@api.route('/api/houses/<house_id>/views/chart/', methods=['GET'])
 def view_chart(house_id):
     """ Return chart hourly view for house X. """
 
-    view = Chart(request.args, house_id)
+    return serve_view('chart', Chart, house_id)
+
+@api.route('/api/houses/<house_id>/views/batch/', methods=['GET'])
+def view_batch(house_id):
+    """ Return several views for house X in one response, keyed by view name. """
+
+    return serve_batch(house_id, BATCH_VIEWS, {'default': get_defaults})
+
+@api.route('/api/houses/<house_id>/export/', methods=['GET'])
+def export(house_id):
+    """ Return hourly history file for house X. """
 
-    return view.get_response()
+    return Export(request.args, house_id).get_response()
 
+@api.route('/internal/stats/', methods=['GET'])
+def internal_stats():
+    """ Return connection pool, cache, single-flight, revalidation and warmer
+    statistics, if INTERNAL_STATS is set. """
+
+    if not current_app.config['INTERNAL_STATS']:
+        abort(404)
+
+    return jsonify(pool=pool_monitor.get_stats(),
+                   response_cache=response_cache.stats(),
+                   shared_cache=shared_cache.stats(),
+                   single_flight=single_flight.stats(),
+                   revalidator=revalidator.stats(),
+                   warmer=cache_warmer.stats())
+
+def get_defaults(house_id, args):
+    """ Return default values for house X views as dict. """
+
+    interval = args.get('interval', 'months')
+
+    if 'month' in interval:
+        return {'years': get_years(house_id),
+                'asof': get_asof_date(house_id),
+                'house': get_house_details(house_id)}
+    elif 'day' in interval:
+        return {'limits': get_limits(house_id)}
+
+    return {'error': 'Interval \'%s\' does not exist' % interval}
 
 def get_houses_all():
     """ Return array of houses. """
 
-    houses = db_session.query(Houses).all()
-
     json_items = []
-    for house in houses:
+    for house in metadata.get_houses():
         data = {'name': house.name,
                 'sname': house.sname,
                 'house_id': house.house_id,
-                'url': url_for('get_house', house_id=house.house_id, _external=True)}
+                'url': url_for('.get_house', house_id=house.house_id, _external=True)}
         json_items.append(data)
 
     return json_items
 
+def get_house_metadata(house_id):
+    """ Return metadata of house X, or abort with 404. """
+
+    house = metadata.get(house_id)
+    if house is None:
+        abort(404)
+
+    return house
+
 def get_house_details(house_id):
     """ Return details for house X in json. """
 
-    house = db_session.query(Houses). \
-        filter(Houses.house_id == house_id).one()
+    house = get_house_metadata(house_id)
 
     return {'name': house.name,
             'sname': house.sname,
             'id': house.house_id,
-            'devices': url_for('get_devices', house_id=house.house_id, _external=True),
-            'circuits': url_for('get_circuits', house_id=house.house_id, _external=True),
-            'views': url_for('views', house_id=house.house_id, _external=True)}
+            'devices': url_for('.get_devices', house_id=house.house_id, _external=True),
+            'circuits': url_for('.get_circuits', house_id=house.house_id, _external=True),
+            'views': url_for('.views', house_id=house.house_id, _external=True)}
 
 def get_devices_all(house_id):
     """ Return array of devices for house X. """
 
-    devices = db_session.query(MonitorDevices). \
-        filter(Houses.house_id == house_id).all()
-
     json_items = []
-    for device in devices:
+    for device in get_house_metadata(house_id).devices:
         data = {'name': device.name,
                 'id': device.device_id}
         json_items.append(data)
@@ -199,30 +237,17 @@ def get_devices_all(house_id):
 def get_years(house_id):
     """ Return array of valid years of energy data for house X. """
 
-    years = db_session.query(func.year(EnergyMonthly.date)). \
-        filter(EnergyMonthly.house_id == house_id). \
-        group_by(func.year(EnergyMonthly.date)). \
-        order_by(func.year(EnergyMonthly.date))
-
-    json_items = []
-    for year in years:
-        json_items.append(str(year[0]))
-
-    return json_items
+    return list(get_house_metadata(house_id).years)
 
 def get_asof_date(house_id):
     """ Return latest date of data as string for house X. """
 
-    asof = db_session.query(LimitsHourly.end_date). \
-        filter(LimitsHourly.house_id == house_id).one()
-
-    return str(asof.end_date.strftime("%Y-%m-%d"))
+    return str(watermarks.get(house_id).strftime("%Y-%m-%d"))
 
 def get_limits(house_id):
     """ Return deails of data limits for house X. Used mainlt in chart view. """
 
-    limits = db_session.query(LimitsHourly). \
-        filter(EnergyHourly.house_id == house_id).one()
+    limits = get_house_metadata(house_id).limits
 
     return {'used_max': str(limits.used_max),
             'solar_min': str(limits.solar_min),
@@ -236,12 +261,15 @@ def get_views(house_id):
     """  Return list of endpoints """
 
     return [
-        url_for('setup', house_id=house_id, _external=True),
-        url_for('view_summary', house_id=house_id, _external=True),
-        url_for('view_generation', house_id=house_id, _external=True),
-        url_for('view_usage', house_id=house_id, _external=True),
-        url_for('view_hdd', house_id=house_id, _external=True),
-        url_for('view_water', house_id=house_id, _external=True),
-        url_for('view_heatmap', house_id=house_id, _external=True),
-        url_for('view_chart', house_id=house_id, _external=True)
+        url_for('.setup', house_id=house_id, _external=True),
+        url_for('.view_summary', house_id=house_id, _external=True),
+        url_for('.view_generation', house_id=house_id, _external=True),
+        url_for('.view_usage', house_id=house_id, _external=True),
+        url_for('.view_hdd', house_id=house_id, _external=True),
+        url_for('.view_water', house_id=house_id, _external=True),
+        url_for('.view_heatmap', house_id=house_id, _external=True),
+        url_for('.view_chart', house_id=house_id, _external=True),
+        url_for('.view_balancepoint', house_id=house_id, _external=True),
+        url_for('.view_batch', house_id=house_id, _external=True),
+        url_for('.export', house_id=house_id, _external=True)
     ]
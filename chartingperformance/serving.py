@@ -0,0 +1,223 @@
+""" Cached view serving """
+import hashlib
+
+from collections import namedtuple
+
+from chartingperformance import encoding
+from chartingperformance.cache import response_cache, shared_cache
+from chartingperformance.singleflight import single_flight
+from chartingperformance.revalidator import revalidator
+from chartingperformance.watermark import watermarks
+from chartingperformance.views.view import View
+
+from flask import request, current_app, jsonify
+
+from sqlalchemy.exc import SQLAlchemyError
+
+# Per-view arguments a batch spec may override, besides the view's own extra_args.
+# The date range is shared.
+BATCH_OVERRIDES = ['interval', 'circuit', 'base', 'location', 'format', 'numbers']
+
+Computed = namedtuple('Computed', ['body', 'status', 'mimetype', 'success', 'watermark'])
+
+def serve_view(name, view_class, house_id, stale=True):
+    """ Return response for view of house X, from the response cache when possible.
+    Conditional GETs are answered with 304 before the view class is constructed.
+    On a miss, a copy cached before the watermark advanced is served instead if stale. """
+
+    args = View(request.args)
+    if not args.success:
+        return view_class(request.args, house_id).get_response()
+
+    key = make_key(name, house_id, view_class, request.args, args)
+    watermark = watermarks.get(house_id)
+    etag = make_etag(key, watermark)
+
+    if is_not_modified(etag, watermark):
+        response = current_app.response_class(status=304)
+        return set_freshness(response, args, etag, watermark)
+
+    entry = get_cached(key, watermark)
+    if entry is not None:
+        response = current_app.response_class(entry.body, mimetype=entry.mimetype)
+        return set_freshness(response, args, etag, watermark)
+
+    if args.args['stream']:
+        view = view_class(request.args, house_id)
+        response = view.get_response()
+        if view.success and response.status_code == 200:
+            set_freshness(response, args, etag, watermark)
+        return response
+
+    computed = compute_or_stale(view_class, request.args, house_id, key, watermark, stale)
+    response = current_app.response_class(computed.body, status=computed.status,
+                                          mimetype=computed.mimetype)
+
+    if computed.success:
+        set_freshness(response, args, make_etag(key, computed.watermark), computed.watermark)
+
+    return response
+
+def serve_batch(house_id, view_classes, extras):
+    """ Return the views named in the views arg for house X as one json object.
+    Args are shared; a spec overrides them with <view>.<arg>, and each view parses
+    its own, as its endpoint would. Cached bodies are composed as is, without decoding. """
+
+    shared = View(request.args)
+    if not shared.success:
+        return jsonify(shared.error)
+    shared.args['stream'] = False
+
+    names = [name for name in request.args.get('views', '').split(',') if name]
+    for name in names:
+        if name not in view_classes and name not in extras:
+            return jsonify(error='View \'%s\' does not exist' % name)
+
+    watermark = watermarks.get(house_id)
+    specs = []
+    for name in names:
+        prefix = name + '.'
+        overrides = dict((arg[len(prefix):], value) for arg, value in request.args.items()
+                         if arg.startswith(prefix))
+        args = request.args.to_dict()
+        if name in extras:
+            args.update(overrides)
+            key = (name, str(house_id)) + tuple(sorted(args.items()))
+        else:
+            view_class = view_classes[name]
+            args.pop('stream', None)
+            args.update((arg, value) for arg, value in overrides.items()
+                        if arg in BATCH_OVERRIDES or arg in view_class.extra_args)
+            key = make_key(name, house_id, view_class, args)
+        specs.append((name, args, key))
+
+    etag = make_etag(('batch',) + tuple(key for name, args, key in specs), watermark)
+    if is_not_modified(etag, watermark):
+        response = current_app.response_class(status=304)
+        return set_freshness(response, shared, etag, watermark)
+
+    bodies = []
+    for name, args, key in specs:
+        if name in extras:
+            body = encoding.dumps(extras[name](house_id, args))
+        else:
+            body = get_body(view_classes[name], house_id, args, key, watermark)
+        bodies.append(encoding.dumps(name) + b':' + body)
+
+    response = current_app.response_class(b'{' + b','.join(bodies) + b'}',
+                                          mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+    return set_freshness(response, shared, etag, watermark)
+
+def make_key(name, house_id, view_class, args, parsed=None):
+    """ Return response cache key of view of house X for request args: the args every
+    view parses, normalized, plus the view's extra_args as given. Parsed is View(args)
+    if the caller already has it. """
+
+    if parsed is None:
+        parsed = View(args)
+
+    return (name, str(house_id)) + parsed.get_cache_key() + \
+        tuple((arg, args.get(arg)) for arg in view_class.extra_args)
+
+def get_body(view_class, house_id, args, key, watermark):
+    """ Return encoded view body from the response caches, computing it on a miss. """
+
+    entry = get_cached(key, watermark)
+    if entry is not None:
+        return entry.body
+
+    return compute_or_stale(view_class, args, house_id, key, watermark).body
+
+def compute_or_stale(view_class, args, house_id, key, watermark, stale=True):
+    """ Return Computed of view after a cache miss at watermark. If stale, a copy that
+    went stale within STALE_WHILE_REVALIDATE is returned at once and refreshed in the
+    background, and one within STALE_IF_ERROR stands in when the database fails.
+    Otherwise concurrent misses on the same key are computed once. """
+
+    flight = key + (watermark,)
+
+    entry = response_cache.get_stale(key, revalidator.stale_while_revalidate) if stale else None
+    if entry is not None:
+        revalidator.submit(flight, single_flight.run, flight, compute,
+                           view_class, args, house_id, key, watermark)
+        return Computed(entry.body, 200, entry.mimetype, True, entry.watermark)
+
+    try:
+        return single_flight.run(flight, compute, view_class, args, house_id, key, watermark)
+    except SQLAlchemyError:
+        entry = response_cache.get_stale(key, revalidator.stale_if_error) if stale else None
+        if entry is None:
+            raise
+        current_app.logger.warning('Serving stale %s of house %s', key[0], key[1], exc_info=True)
+        return Computed(entry.body, 200, entry.mimetype, True, entry.watermark)
+
+def compute(view_class, args, house_id, key, watermark):
+    """ Return Computed of view, storing a successful body in the response caches.
+    Called once per key at a time; callers waiting on the same key share the result. """
+
+    entry = get_cached(key, watermark)
+    if entry is not None:
+        return Computed(entry.body, 200, entry.mimetype, True, watermark)
+
+    view = view_class(args, house_id)
+    response = view.get_response()
+    body = response.get_data()
+    success = view.success and response.status_code == 200
+
+    if success:
+        set_cached(key, watermark, body, response.mimetype)
+
+    return Computed(body, response.status_code, response.mimetype, success, watermark)
+
+def get_cached(key, watermark):
+    """ Return entry from this worker's response cache, else from the shared cache,
+    keeping it in this worker's. Returns None on a miss in both. """
+
+    entry = response_cache.get(key, watermark)
+    if entry is not None:
+        return entry
+
+    entry = shared_cache.get(key, watermark)
+    if entry is not None:
+        response_cache.set(key, watermark, entry.body, entry.mimetype)
+
+    return entry
+
+def set_cached(key, watermark, body, mimetype):
+    """ Store body in this worker's response cache and the shared cache. """
+
+    response_cache.set(key, watermark, body, mimetype)
+    shared_cache.set(key, watermark, body, mimetype)
+
+def make_etag(key, watermark):
+    """ Return entity tag for normalized request key at data watermark. """
+
+    return hashlib.sha1(repr((key, watermark)).encode('utf-8')).hexdigest()
+
+def is_not_modified(etag, watermark):
+    """ Return True if the client already holds the current response. """
+
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+
+    if request.if_modified_since is not None and watermark is not None:
+        return request.if_modified_since >= watermark.replace(microsecond=0)
+
+    return False
+
+def set_freshness(response, args, etag, watermark):
+    """ Add validators and cache lifetime. Ranges ending before the watermark never change. """
+
+    response.set_etag(etag)
+    response.last_modified = watermark
+    response.cache_control.public = True
+
+    end = args.args['end']
+    if watermark is not None and end is not None and end.date < watermark:
+        response.cache_control.max_age = current_app.config['IMMUTABLE_MAX_AGE']
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+
+    return response
@@ -0,0 +1,70 @@
+""" Coalescing of identical concurrent computations """
+import threading
+
+class Flight(object):
+    """ One call in progress and its outcome. """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    """ Runs at most one call per key at a time in this process. Callers arriving
+    while a call with their key is in flight wait for it and share its result,
+    or its exception, instead of running it again. """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.flights = {}
+        self.leaders = 0
+        self.followers = 0
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        """ Read settings from app config. """
+
+        self.enabled = app.config['SINGLE_FLIGHT']
+
+    def run(self, key, function, *args):
+        """ Return function(*args), or the result of the call already in flight for key. """
+
+        if not self.enabled:
+            return function(*args)
+
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+                self.leaders += 1
+            else:
+                self.followers += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = function(*args)
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+        return flight.result
+
+    def stats(self):
+        """ Return counters as dict. """
+
+        with self.lock:
+            return {'in_flight': len(self.flights),
+                    'leaders': self.leaders,
+                    'followers': self.followers}
+
+single_flight = SingleFlight()
@@ -0,0 +1,481 @@
+""" Memory-mapped hourly column store """
+# pylint: disable=no-member
+import datetime
+import fcntl
+import os
+import shutil
+import threading
+
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+
+from chartingperformance import db_session
+
+from chartingperformance.models import CIRCUITS
+from chartingperformance.models import EnergyHourly
+from chartingperformance.models import TemperatureHourly
+from chartingperformance.models import HDDHourly
+from chartingperformance.models import LimitsHourly
+
+from flask import current_app
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Values are stored as fixed point integers in units of the column's scale. NULL marks
+# a missing value, and a series' rows file marks the hours it has a row for.
+NULL = -2 ** 63
+
+# Source tables snapshotted into the store. Series are named after the source, plus
+# the device id for tables that have one, e.g. energy5, temperature0, hdd.
+SOURCES = {'energy': (EnergyHourly, ['adjusted_load', 'solar', 'used'] + CIRCUITS),
+           'temperature': (TemperatureHourly, ['temperature', 'humidity']),
+           'hdd': (HDDHourly, ['hdd'])}
+
+# numpy datetime unit of each interval
+UNITS = {'hour': 'h', 'day': 'D', 'month': 'M', 'year': 'Y'}
+
+# MariaDB adds this many digits to the scale of a division result.
+DIV_PRECISION_INCREMENT = 4
+
+Field = namedtuple('Field', ['function', 'values', 'scale', 'divisor'])
+
+class ColumnStore(object):
+    """ Per house directories of memory-mapped column files, one per source column and
+    device, aligned to a sorted hourly date index. Files are only ever appended to, so
+    worker processes share their pages through the OS page cache. """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.houses = {}
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        """ Read settings from app config. The store needs numpy. """
+
+        self.directory = app.config['COLUMN_STORE_DIR']
+        if numpy is None:
+            self.directory = None
+
+    def path(self, house_id, suffix=''):
+        """ Return directory of house X. """
+
+        return os.path.join(self.directory, 'house%s%s' % (house_id, suffix))
+
+    def get(self, house_id, watermark):
+        """ Return HouseStore of house X if it holds data up to watermark, or None. """
+
+        if self.directory is None or watermark is None:
+            return None
+
+        house_id = str(house_id)
+        path = self.path(house_id)
+        try:
+            stat = os.stat(os.path.join(path, 'watermark'))
+        except OSError:
+            return None
+        version = (stat.st_ino, stat.st_mtime_ns)
+
+        with self.lock:
+            house = self.houses.get(house_id)
+        if house is None or house.version != version:
+            house = HouseStore(path, version)
+            with self.lock:
+                self.houses[house_id] = house
+
+        if house.watermark != watermark:
+            return None
+
+        return house
+
+    def on_watermark(self, house_id, watermark):
+        """ Append new hours to the store of house X, if it has been built. Run by the
+        cache warmer before it warms views, so requests never wait for it. Every worker's
+        warmer runs it, but only the first to take the lock appends. The others skip,
+        and reopen the store once its watermark file is replaced. """
+
+        if self.directory is None or not os.path.isdir(self.path(house_id)):
+            return
+
+        try:
+            self.sync(house_id, until=watermark, wait=False)
+        except OSError:
+            current_app.logger.exception('Column store of house %s not appended', house_id)
+
+    def sync(self, house_id, full=False, until=None, wait=True):
+        """ Append hourly rows of house X newer than the store, up to until (default
+        limits_hourly.end_date). Rebuilds all history if full. Returns hours appended.
+        Unless wait, returns 0 at once if another process holds the store's lock. """
+
+        if until is None:
+            until = db_session.query(LimitsHourly.end_date).\
+                filter(LimitsHourly.house_id == house_id).scalar()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        with open(self.path(house_id, '.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+
+            if not full:
+                # already appended up to until, so leave the files, and readers' maps, alone
+                if read_watermark(self.path(house_id)) == until:
+                    return 0
+                return append(self.path(house_id), house_id, until)
+
+            path = self.path(house_id, '.new')
+            shutil.rmtree(path, ignore_errors=True)
+            appended = append(path, house_id, until)
+
+            # readers keep their mappings of the old files until they reopen
+            if os.path.isdir(self.path(house_id)):
+                shutil.rmtree(self.path(house_id, '.old'), ignore_errors=True)
+                os.rename(self.path(house_id), self.path(house_id, '.old'))
+            os.rename(path, self.path(house_id))
+            shutil.rmtree(self.path(house_id, '.old'), ignore_errors=True)
+
+            return appended
+
+def append(path, house_id, until):
+    """ Append rows of every source dated after the last indexed hour, up to until.
+    Column files are written before the index and the watermark last, so readers
+    never see an index longer than its columns. Files are first aligned to the index,
+    in case an earlier append was interrupted. """
+
+    os.makedirs(path, exist_ok=True)
+
+    length = os.path.getsize(os.path.join(path, 'date.i8')) // 8 \
+        if os.path.exists(os.path.join(path, 'date.i8')) else 0
+    truncate(path, length)
+    since = None
+    if length:
+        last = numpy.fromfile(os.path.join(path, 'date.i8'), dtype='int64', offset=(length - 1) * 8)
+        since = last[0].astype('datetime64[s]').astype(datetime.datetime)
+
+    fetched = dict((source, fetch(house_id, source, since, until)) for source in SOURCES)
+
+    dates = sorted(set(row.date for rows in fetched.values() for row in rows))
+    positions = dict((date, position) for position, date in enumerate(dates))
+
+    arrays = {}
+    for source, rows in fetched.items():
+        table, columns = SOURCES[source]
+        for row in rows:
+            series = series_name(source, getattr(row, 'device_id', None))
+            if series not in arrays:
+                arrays[series] = empty_series(columns, len(dates))
+            position = positions[row.date]
+            arrays[series]['rows'][position] = 1
+            for column in columns:
+                value = getattr(row, column)
+                if value is not None:
+                    arrays[series][column][position] = \
+                        int(value.scaleb(getattr(table, column).type.scale))
+
+    # keep every series aligned to the index, including ones without new rows
+    for series in list_series(path):
+        if series not in arrays:
+            arrays[series] = empty_series(SOURCES[source_name(series)][1], len(dates))
+
+    for series, columns in arrays.items():
+        for column, values in columns.items():
+            filename = column_path(path, series, column)
+            # new series and files missed by an interrupted append start empty up to the index
+            stored = os.path.getsize(filename) // values.itemsize if os.path.exists(filename) else 0
+            with open(filename, 'ab') as output:
+                if stored < length:
+                    output.write(numpy.full(length - stored,
+                                            values.dtype.type(NULL if column != 'rows'
+                                                              else 0)).tobytes())
+                output.write(values.tobytes())
+
+    with open(os.path.join(path, 'date.i8'), 'ab') as output:
+        output.write(numpy.array(dates, dtype='datetime64[s]').astype('int64').tobytes())
+
+    with open(os.path.join(path, 'watermark.new'), 'w') as output:
+        output.write(until.isoformat() if until is not None else '')
+    os.replace(os.path.join(path, 'watermark.new'), os.path.join(path, 'watermark'))
+
+    return len(dates)
+
+def read_watermark(path):
+    """ Return the watermark directory holds data up to, None if not known. """
+
+    try:
+        with open(os.path.join(path, 'watermark')) as watermark:
+            watermark = watermark.read()
+    except FileNotFoundError:
+        return None
+
+    return datetime.datetime.fromisoformat(watermark) if watermark else None
+
+def truncate(path, length):
+    """ Cut the index and column files of directory back to length rows. Rows past it
+    were written by an append interrupted before it finished the index. Readers only
+    map rows of the index they opened, so never touch the bytes removed. """
+
+    for name in os.listdir(path):
+        if name.endswith('.i8'):
+            size = length * 8
+        elif name.endswith('.u1'):
+            size = length
+        else:
+            continue
+        filename = os.path.join(path, name)
+        if os.path.getsize(filename) > size:
+            os.truncate(filename, size)
+
+def fetch(house_id, source, since, until):
+    """ Return rows of source table for house X dated after since, up to until. """
+
+    table, columns = SOURCES[source]
+
+    keys = [table.device_id] if hasattr(table, 'device_id') else []
+    query = db_session.query(*(keys + [table.date] + [getattr(table, column)
+                                                      for column in columns])).\
+        filter(table.house_id == house_id)
+
+    if since is not None:
+        query = query.filter(table.date > since)
+    if until is not None:
+        query = query.filter(table.date <= until)
+
+    return query.order_by(table.date).all()
+
+def empty_series(columns, length):
+    """ Return dict of rows and column arrays with no values. """
+
+    arrays = {'rows': numpy.zeros(length, dtype='uint8')}
+    for column in columns:
+        arrays[column] = numpy.full(length, NULL, dtype='int64')
+
+    return arrays
+
+def series_name(source, device_id=None):
+    """ Return series name of source table rows of device. """
+
+    return source if device_id is None else '%s%s' % (source, device_id)
+
+def source_name(series):
+    """ Return source table name of series. """
+
+    return series.rstrip('0123456789')
+
+def column_path(path, series, column):
+    """ Return file of series column. """
+
+    return os.path.join(path, '%s.%s.%s' % (series, column, 'u1' if column == 'rows' else 'i8'))
+
+def list_series(path):
+    """ Return names of series stored in directory. """
+
+    return sorted(name[:-len('.rows.u1')] for name in os.listdir(path)
+                  if name.endswith('.rows.u1'))
+
+class HouseStore(object):
+    """ Read-only mappings of one house's column files. """
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self.columns = {}
+
+        self.watermark = read_watermark(path)
+
+        self.dates = self.map(os.path.join(path, 'date.i8'), 'int64')
+        self.length = len(self.dates)
+        self.series = list_series(path)
+
+    @classmethod
+    def map(cls, filename, dtype, length=None):
+        """ Return read-only memmap of file, an empty array if the file is empty. """
+
+        if os.path.getsize(filename) == 0:
+            return numpy.zeros(0, dtype=dtype)
+
+        values = numpy.memmap(filename, dtype=dtype, mode='r')
+
+        return values if length is None else values[:length]
+
+    def column(self, series, column):
+        """ Return values of series column aligned to the index, or None if not stored. """
+
+        key = (series, column)
+        if key not in self.columns:
+            filename = column_path(self.path, series, column)
+            if not os.path.exists(filename):
+                return None
+            self.columns[key] = self.map(filename, 'uint8' if column == 'rows' else 'int64',
+                                         self.length)
+
+        return self.columns[key]
+
+    def devices(self, source, device_ids=None):
+        """ Return stored series of source, limited to device_ids if given. """
+
+        return [series for series in self.series
+                if source_name(series) == source and
+                (device_ids is None or series[len(source):] in map(str, device_ids))]
+
+    def select(self, series, start=None, end=None, end_inclusive=False):
+        """ Return index positions of series rows in date range. """
+
+        low, high = 0, self.length
+        if start is not None:
+            low = numpy.searchsorted(self.dates, seconds(start), 'left')
+        if end is not None:
+            high = numpy.searchsorted(self.dates, seconds(end),
+                                      'right' if end_inclusive else 'left')
+
+        rows = self.column(series, 'rows')
+        if rows is None or high <= low:
+            return numpy.zeros(0, dtype='int64')
+
+        return low + numpy.flatnonzero(rows[low:high])
+
+    def union(self, series, start=None, end=None, end_inclusive=False):
+        """ Return index positions in date range where any of the listed series has a row. """
+
+        return numpy.unique(numpy.concatenate([self.select(name, start, end, end_inclusive)
+                                               for name in series] +
+                                              [numpy.zeros(0, dtype='int64')]))
+
+    def values(self, series, column, positions):
+        """ Return list of series column values at positions as Decimals, None if NULL. """
+
+        values = self.column(series, column)
+        if values is None:
+            return [None] * len(positions)
+
+        scale = scale_of(source_name(series), column)
+
+        return [to_decimal(value, scale) for value in values[positions].tolist()]
+
+    def rows(self, series, start=None, end=None, end_inclusive=False):
+        """ Return Rows of the listed series in date range, date ordered. """
+
+        parts = [(name, self.select(name, start, end, end_inclusive)) for name in series]
+
+        return Rows(self, parts)
+
+    def get_dates(self, positions):
+        """ Return index dates at positions as datetime64. """
+
+        return self.dates[positions].astype('datetime64[s]')
+
+class Rows(object):
+    """ Rows of one or more series of the same source in date order, like the rows of
+    a SQL query over their table. Series of other sources join on the date. """
+
+    def __init__(self, house, parts):
+        self.house = house
+        self.parts = parts
+        positions = numpy.concatenate([part for name, part in parts] +
+                                      [numpy.zeros(0, dtype='int64')])
+        self.order = numpy.argsort(positions, kind='stable')
+        self.positions = positions[self.order]
+
+    def __len__(self):
+        return len(self.positions)
+
+    def get(self, column):
+        """ Return column values of the rows. """
+
+        values = [self.house.column(name, column)[part] for name, part in self.parts]
+
+        return numpy.concatenate(values + [numpy.zeros(0, dtype='int64')])[self.order]
+
+    def join(self, series, column):
+        """ Return column values of series at the rows' dates, NULL where it has no row. """
+
+        values = self.house.column(series, column)
+        if values is None:
+            return numpy.full(len(self.positions), NULL, dtype='int64')
+
+        return values[self.positions]
+
+    def group_starts(self, interval=None):
+        """ Return offsets of the first row of each interval group, one group without interval. """
+
+        if not len(self.positions):
+            return numpy.zeros(0, dtype='int64')
+        if interval is None:
+            return numpy.zeros(1, dtype='int64')
+
+        buckets = self.house.get_dates(self.positions).astype('datetime64[%s]' % UNITS[interval])
+
+        return numpy.flatnonzero(numpy.concatenate(([True], buckets[1:] != buckets[:-1])))
+
+    def aggregate(self, fields, interval=None):
+        """ Return rows of fields grouped by interval, or one totals row without interval.
+        Fields map names to Field(function, values, scale, divisor), function being sum, min,
+        max or avg. Rows also have date, the group's first date. Aggregates of groups with
+        no values are None, and totals of no rows are a row of None, like SQL's. """
+
+        Row = namedtuple('Row', ['date'] + list(fields))
+
+        starts = self.group_starts(interval)
+        if not len(starts):
+            return [Row(*[None] * (len(fields) + 1))] if interval is None else []
+
+        dates = self.house.get_dates(self.positions[starts]).astype(datetime.datetime)
+        columns = [dates] + [reduce(field, starts) for field in fields.values()]
+
+        return [Row(*values) for values in zip(*columns)]
+
+def reduce(field, starts):
+    """ Return list of field's aggregate per group as Decimals. """
+
+    valid = field.values != NULL
+    counts = numpy.add.reduceat(valid.astype('int64'), starts)
+
+    if field.function in ('sum', 'avg'):
+        totals = numpy.add.reduceat(numpy.where(valid, field.values, 0), starts)
+    elif field.function == 'min':
+        totals = numpy.minimum.reduceat(numpy.where(valid, field.values, -(NULL + 1)), starts)
+    else:
+        totals = numpy.maximum.reduceat(numpy.where(valid, field.values, NULL), starts)
+
+    results = []
+    for total, count in zip(totals.tolist(), counts.tolist()):
+        if not count:
+            results.append(None)
+            continue
+        value = Decimal(total).scaleb(-field.scale)
+        divisor = count if field.function == 'avg' else field.divisor
+        if divisor != 1:
+            value = divide(value, divisor, field.scale)
+        results.append(value)
+
+    return results
+
+def divide(value, divisor, scale):
+    """ Return value / divisor with the scale MariaDB gives a decimal division. """
+
+    exponent = Decimal(1).scaleb(-(scale + DIV_PRECISION_INCREMENT))
+
+    return (value / divisor).quantize(exponent, rounding=ROUND_HALF_UP)
+
+def to_decimal(value, scale):
+    """ Return stored value as Decimal, None if NULL. """
+
+    if value == NULL:
+        return None
+
+    return Decimal(int(value)).scaleb(-scale)
+
+def seconds(date):
+    """ Return date as seconds since the epoch, as stored in the index. """
+
+    return numpy.datetime64(date, 's').astype('int64')
+
+def scale_of(source, column):
+    """ Return decimal scale of a source column. """
+
+    return getattr(SOURCES[source][0], column).type.scale
+
+column_store = ColumnStore()
@@ -0,0 +1,133 @@
+""" BalancePoint class """
+# pylint: disable=no-member
+from chartingperformance.views.basetemp import Basetemp
+
+from flask import jsonify
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Candidate base temperatures when bases is not given.
+DEFAULT_BASES = '55..70'
+
+class BalancePoint(Basetemp):
+    """ Heating balance point analysis. Fits ashp kWh against hdd by least squares
+    for every candidate base, from one read of the hourly rows. """
+
+    def set_args(self, args):
+        """ Return dict with parameters included in GET. Interval defaults to hour
+        and bases to DEFAULT_BASES. The response is small, so it is never streamed. """
+
+        balance_args = super(BalancePoint, self).set_args(args)
+
+        if args.get('interval') is None:
+            balance_args['interval'] = 'hour'
+
+        if balance_args['bases'] is None:
+            balance_args['bases'] = self.parse_bases(DEFAULT_BASES)
+
+        balance_args['stream'] = False
+
+        return balance_args
+
+    def get_sweep(self, house_id):
+        """ Get and store fit of every base in bases. """
+
+        rows = self.get_sweep_rows(house_id, max(self.args['bases']))
+
+        self.fits = self.fit(rows, self.args['bases'])
+
+    def fit(self, rows, bases):
+        """ Return list of dicts with points, slope, intercept, r2 and residual
+        summary per base. Fit values are None with fewer than two distinct points. """
+
+        if not rows:
+            return [self.get_fit(base, 0) for base in bases]
+
+        sums = self.aggregate(rows, bases)
+
+        # interval sums are zero outside a base's points, so they add up as is
+        used = sums.rows_in > 0
+        n = used.sum(axis=1)
+        x, y = sums.hdd, sums.ashp
+        sum_x, sum_y = x.sum(axis=1), y.sum(axis=1)
+        sum_xx, sum_xy, sum_yy = (x * x).sum(axis=1), (x * y).sum(axis=1), (y * y).sum(axis=1)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            slope = (n * sum_xy - sum_x * sum_y) / (n * sum_xx - sum_x * sum_x)
+            intercept = (sum_y - slope * sum_x) / n
+            total = sum_yy - sum_y * sum_y / n
+
+            residuals = numpy.where(used, y - (intercept[:, None] + slope[:, None] * x), 0.0)
+            squared = (residuals * residuals).sum(axis=1)
+            r2 = numpy.where(total > 0, 1.0 - squared / total, numpy.nan)
+            rmse = numpy.sqrt(squared / n)
+            mean_abs = numpy.abs(residuals).sum(axis=1) / n
+
+        max_abs = numpy.abs(residuals).max(axis=1)
+
+        fits = []
+        for position, base in enumerate(bases):
+            if n[position] < 2 or not numpy.isfinite(slope[position]):
+                fits.append(self.get_fit(base, n[position]))
+                continue
+            fits.append(self.get_fit(base, n[position],
+                                     slope[position], intercept[position], r2[position],
+                                     rmse[position], mean_abs[position], max_abs[position]))
+
+        return fits
+
+    @classmethod
+    def get_fit(cls, base, points, slope=None, intercept=None, r2=None,
+                rmse=None, mean_abs=None, max_abs=None):
+        """ Return fit of one base as dict of plain floats, None where not available. """
+
+        def value(number):
+            if number is None or not numpy.isfinite(number):
+                return None
+            return float(number)
+
+        return {'base': base,
+                'points': int(points),
+                'slope': value(slope),
+                'intercept': value(intercept),
+                'r2': value(r2),
+                'residuals': {'rmse': value(rmse),
+                              'mean_abs': value(mean_abs),
+                              'max_abs': value(max_abs)}}
+
+    def get_best(self):
+        """ Return fit with the highest r2, or None if no base could be fitted. """
+
+        fitted = [fit for fit in self.fits if fit['r2'] is not None]
+        if not fitted:
+            return None
+
+        return max(fitted, key=lambda fit: fit['r2'])
+
+    def format_fit(self, fit):
+        """ Return fit with numbers formatted for the response. """
+
+        formatted = dict((key, self.format_number(fit[key]))
+                         for key in ['base', 'points', 'slope', 'intercept', 'r2'])
+        formatted['residuals'] = dict((key, self.format_number(value))
+                                      for key, value in fit['residuals'].items())
+
+        return formatted
+
+    def get_response(self):
+        """ Return response in json format. """
+        if not self.success:
+            return jsonify(self.error)
+
+        best = self.get_best()
+        if best is not None:
+            best = dict((key, self.format_number(best[key]))
+                        for key in ['base', 'slope', 'intercept', 'r2'])
+
+        return self.jsonify(view='balancepoint',
+                            interval=self.args['interval'],
+                            best=best,
+                            fits=[self.format_fit(fit) for fit in self.fits])
@@ -1,22 +1,83 @@
 """ ViewBasetemp class """
 # pylint: disable=no-member
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+
 from chartingperformance import db_session
 from chartingperformance.views.view import View
 
+from chartingperformance.models import EnergyHourly
+from chartingperformance.models import TemperatureHourly
+
 from flask import jsonify
 
 from sqlalchemy.sql import text, column
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+Point = namedtuple('Point', ['date', 'solar', 'ashp', 'temperature', 'hdd'])
+Sweep = namedtuple('Sweep', ['dates', 'rows_in', 'first', 'solar', 'ashp', 'temperature', 'hdd'])
+
+# Most candidate base temperatures in one sweep.
+MAX_BASES = 40
+
+# MariaDB adds this many digits to the scale of a division or average.
+DIV_PRECISION_INCREMENT = 4
+
 class Basetemp(View):
     """ Basetemp analysis view query and response methods. """
 
+    extra_args = ['bases']
+
     def __init__(self, args, house_id):
 
         super(Basetemp, self).__init__(args)
 
-        if self.success:
+        if self.success and self.args.get('bases') is not None:
+            if numpy is None:
+                self.success = False
+                self.error = {'error': 'Base temperature sweep is not available.'}
+            elif not self.args['bases'] or len(self.args['bases']) > MAX_BASES:
+                self.success = False
+                self.error = {'error': 'Bases not valid. Use a range like 55..70 ' \
+                                       'or a list like 55,60,65, at most %s bases.' % MAX_BASES}
+            else:
+                self.get_sweep(house_id)
+
+        elif self.success:
             self.get_items(house_id)
 
+    def set_args(self, args):
+        """ Return dict with parameters included in GET, with candidate base temperatures. """
+
+        basetemp_args = super(Basetemp, self).set_args(args)
+
+        basetemp_args['bases'] = self.parse_bases(args.get('bases'))
+
+        return basetemp_args
+
+    @classmethod
+    def parse_bases(cls, bases):
+        """ Return sorted list of bases from 'low..high' or a comma separated list,
+        an empty list if not valid, or None if not given. """
+
+        if bases is None or bases == '':
+            return None
+
+        try:
+            if '..' in bases:
+                low, high = (int(bound) for bound in bases.split('..'))
+                # checked before the range is built, so a huge one costs nothing
+                if high < low or high - low + 1 > MAX_BASES:
+                    return []
+                return list(range(low, high + 1))
+            return sorted(set(int(base) for base in bases.split(',')))
+        except ValueError:
+            return []
+
     def get_items(self, house_id):
         """ Get and store points (primarily hdd and ashp values) from database. """
 
@@ -79,23 +140,145 @@ class Basetemp(View):
         items = items.params(house_id=house_id,
                              base=self.args['base'],
                              start=self.is_date(self.args['start']),
-                             end=self.is_date(self.args['end'])).all()
+                             end=self.is_date(self.args['end']))
+
+        self.json_items = self.get_json_items(items,
+                                              ['date', 'solar', 'ashp', 'temperature', 'hdd'],
+                                              self.format_date)
+
+    def get_sweep(self, house_id):
+        """ Get and store points for every base in bases from one read of the hourly rows. """
+
+        rows = self.get_sweep_rows(house_id, max(self.args['bases']))
+
+        self.json_series = [{'base': self.format_number(base),
+                             'points': self.get_json_items(points,
+                                                           ['date', 'solar', 'ashp',
+                                                            'temperature', 'hdd'],
+                                                           self.format_date)}
+                            for base, points in zip(self.args['bases'],
+                                                    self.sweep(rows, self.args['bases']))]
+
+    def get_sweep_rows(self, house_id, base):
+        """ Return date ordered hourly (date, solar, ashp, temperature) rows
+        with temperature at or below base. """
 
-        self.json_items = []
-        for item in items:
-            data = {'date': str(self.format_date(item.date)),
-                    'solar': str(item.solar),
-                    'ashp': str(item.ashp),
-                    'temperature': str(item.temperature),
-                    'hdd': str(item.hdd)}
-            self.json_items.append(data)
+        date_range = self.filter_query_by_date_range_sql().replace('e.date', 'date')
+
+        sql = """SELECT e.date AS 'date',
+                 e.solar/1000.0 AS 'solar',
+                 e.ashp/1000.0 AS 'ashp',
+                 t.temperature AS 'temperature'
+               FROM (SELECT date, solar, ashp
+               FROM energy_hourly
+               WHERE house_id = :house_id
+               AND solar > -500
+               AND ashp > 50 %s) e
+               JOIN
+               (SELECT date, temperature
+               FROM temperature_hourly
+               WHERE house_id = :house_id
+               AND device_id = 0
+               AND temperature <= :base %s) t ON e.date = t.date
+               ORDER BY e.date
+            """ % (date_range, date_range)
+
+        return db_session.execute(text(sql),
+                                  {'house_id': house_id,
+                                   'base': base,
+                                   'start': self.is_date(self.args['start']),
+                                   'end': self.is_date(self.args['end'])}).fetchall()
+
+    def aggregate(self, rows, bases):
+        """ Return Sweep of interval sums per base, arrays shaped (bases, groups). """
+
+        dates, solar, ashp, temperature = zip(*rows)
+        dates = numpy.array(dates, dtype='datetime64[s]')
+        solar = numpy.array(solar, dtype=float)
+        ashp = numpy.array(ashp, dtype=float)
+        temperature = numpy.array(temperature, dtype=float)
+
+        # group rows by interval; hours are their own group
+        if self.args['interval'] in ('year', 'month', 'day'):
+            unit = {'year': 'Y', 'month': 'M', 'day': 'D'}[self.args['interval']]
+            groups = numpy.unique(dates.astype('datetime64[%s]' % unit), return_inverse=True)[1]
+        elif self.args['interval'] == 'hour':
+            groups = numpy.arange(len(dates))
+        else:
+            groups = numpy.zeros(len(dates), dtype=int)
+        count = groups.max() + 1
+
+        # one row per base: included rows, their hdd, and a flat (base, group) index
+        base_values = numpy.array(bases, dtype=float)[:, None]
+        included = temperature[None, :] <= base_values
+        hdd = numpy.where(included, (base_values - temperature[None, :]) / 24.0, 0.0)
+        index = (numpy.arange(len(bases))[:, None] * count + groups[None, :])[included]
+        size = len(bases) * count
+        shape = (len(bases), count)
+
+        def total(values):
+            return numpy.bincount(index, weights=values[included], minlength=size).reshape(shape)
+
+        rows_in = numpy.bincount(index, minlength=size).reshape(shape)
+
+        # rows are date ordered, so the first included row of a group has its MIN(date)
+        first = numpy.full(size, len(dates))
+        numpy.minimum.at(first, index, numpy.broadcast_to(numpy.arange(len(dates)),
+                                                          included.shape)[included])
+
+        return Sweep(dates, rows_in, first.reshape(shape),
+                     total(numpy.broadcast_to(solar, included.shape)),
+                     total(numpy.broadcast_to(ashp, included.shape)),
+                     total(numpy.broadcast_to(temperature, included.shape)),
+                     total(hdd))
+
+    def sweep(self, rows, bases):
+        """ Return list of points per base. Rows are hourly (date, solar, ashp, temperature),
+        date ordered, with temperature at or below the highest base. """
+
+        if not rows:
+            return [[] for base in bases]
+
+        sums = self.aggregate(rows, bases)
+
+        # the scales the single base query returns: kWh is divided by 1000.0,
+        # temperature averaged unless hourly, and hdd is a double
+        energy_scale = EnergyHourly.solar.type.scale + DIV_PRECISION_INCREMENT
+        temperature_scale = TemperatureHourly.temperature.type.scale
+        if self.args['interval'] != 'hour':
+            temperature_scale = temperature_scale + DIV_PRECISION_INCREMENT
+
+        series = []
+        for base in range(len(bases)):
+            points = []
+            for group in numpy.flatnonzero(sums.rows_in[base]):
+                points.append(Point(sums.dates[sums.first[base, group]].astype(object),
+                                    to_decimal(sums.solar[base, group], energy_scale),
+                                    to_decimal(sums.ashp[base, group], energy_scale),
+                                    to_decimal(sums.temperature[base, group] /
+                                               sums.rows_in[base, group], temperature_scale),
+                                    float(sums.hdd[base, group])))
+            series.append(points)
+
+        return series
 
     def get_response(self):
         """ Return response in json format. """
         if not self.success:
             return jsonify(self.error)
 
-        return jsonify(view='heat',
-                       base=self.args['base'],
-                       interval=self.args['interval'],
-                       points=self.json_items)
+        if self.args.get('bases') is not None:
+            return self.jsonify(view='heat',
+                                bases=[self.format_number(base) for base in self.args['bases']],
+                                interval=self.args['interval'],
+                                series=self.json_series)
+
+        return self.jsonify(view='heat',
+                            base=self.args['base'],
+                            interval=self.args['interval'],
+                            points=self.json_items)
+
+def to_decimal(value, scale):
+    """ Return float value as Decimal rounded to scale, as MariaDB would return it. """
+
+    return Decimal(float(value)).quantize(Decimal(1).scaleb(-scale), rounding=ROUND_HALF_UP)
@@ -1,12 +1,25 @@
 """ ViewChart class """
 # pylint: disable=no-member
+from collections import namedtuple
+
 from chartingperformance import db_session
 from chartingperformance.views.view import View
 
+from chartingperformance.models import CIRCUITS
+
 from flask import jsonify
 
 from sqlalchemy.sql import text
 
+FIELDS = ['date', 'net', 'solar', 'used',
+          'first_floor_temp', 'second_floor_temp',
+          'basement_temp', 'outdoor_temp', 'hdd'] + CIRCUITS + ['all_other']
+
+# Devices of first_floor_temp, second_floor_temp, basement_temp and outdoor_temp
+TEMPERATURE_DEVICES = [1, 2, 3, 0]
+
+Hour = namedtuple('Hour', FIELDS)
+
 class Chart(View):
     """ Hourly chart view query and response methods. """
 
@@ -15,10 +28,17 @@ class Chart(View):
         super(Chart, self).__init__(args)
 
         if self.success:
-            self.get_items(house_id)
+            house = None
+            if self.args['start'] is not None:
+                house = self.get_store(house_id)
+
+            if house is not None:
+                self.get_items_from_store(house)
+            else:
+                self.get_items(house_id)
 
     def get_items(self, house_id):
-        """ Get and store hourly values from database. """
+        """ Get and store hourly values from database. Defaults to one day from start. """
 
         items = db_session.query("date", "net", "solar", "used",
                                  "first_floor_temp", "second_floor_temp",
@@ -32,12 +52,14 @@ class Chart(View):
                                  "ventilation_preheat", "kitchen_recept_rt",
                                  "all_other")
 
-        sql = """SELECT ti1.date AS 'date', e.adjusted_load AS 'net',
+        # One range scan of temperature_hourly, pivoted by device, joined on the native date key.
+        # Hours come from the first floor sensor (device 1), as they always have.
+        sql = """SELECT t.date AS 'date', e.adjusted_load AS 'net',
           e.solar AS 'solar', e.used AS 'used',
-          ti1.indoor1_deg AS 'first_floor_temp',
-          ti2.indoor2_deg AS 'second_floor_temp',
-          ti0.indoor0_deg AS 'basement_temp',
-          tu.outdoor_deg AS 'outdoor_temp', th.hdd AS 'hdd',
+          t.first_floor_temp AS 'first_floor_temp',
+          t.second_floor_temp AS 'second_floor_temp',
+          t.basement_temp AS 'basement_temp',
+          t.outdoor_temp AS 'outdoor_temp', th.hdd AS 'hdd',
           e.water_heater AS 'water_heater', e.ashp AS 'ashp',
           e.water_pump AS 'water_pump', e.dryer AS 'dryer',
           e.washer AS 'washer', e.dishwasher AS 'dishwasher',
@@ -54,69 +76,76 @@ class Chart(View):
           e.aux_heat_bedrooms + e.aux_heat_living + e.study + e.barn +
           e.basement_west + e.basement_east + e.ventilation +
           e.ventilation_preheat + e.kitchen_recept_rt) AS 'all_other'
-        FROM (SELECT house_id, date, temperature AS 'indoor1_deg'
+        FROM (SELECT house_id, date,
+                MAX(CASE WHEN device_id = 1 THEN temperature END) AS 'first_floor_temp',
+                MAX(CASE WHEN device_id = 2 THEN temperature END) AS 'second_floor_temp',
+                MAX(CASE WHEN device_id = 3 THEN temperature END) AS 'basement_temp',
+                MAX(CASE WHEN device_id = 0 THEN temperature END) AS 'outdoor_temp'
               FROM temperature_hourly
-              WHERE device_id = 1) ti1
-          LEFT JOIN (SELECT house_id, date, temperature AS 'indoor2_deg'
-                     FROM temperature_hourly WHERE device_id = 2) ti2
-            ON CAST(LEFT(ti2.date,13) AS DATETIME) = CAST(LEFT(ti1.date,13) AS DATETIME)
-                AND ti2.house_id = ti1.house_id
-          LEFT JOIN (SELECT house_id, date, temperature AS 'indoor0_deg'
-                     FROM temperature_hourly WHERE device_id = 3) ti0
-            ON CAST(LEFT(ti0.date,13) AS DATETIME) = CAST(LEFT(ti1.date,13) AS DATETIME)
-                AND ti0.house_id = ti1.house_id
-          LEFT JOIN (SELECT house_id, date, temperature AS 'outdoor_deg'
-                     FROM temperature_hourly WHERE device_id = 0) tu
-            ON CAST(LEFT(tu.date,13) AS DATETIME) = CAST(LEFT(ti1.date,13) AS DATETIME)
-                AND tu.house_id = ti1.house_id
-          LEFT JOIN (SELECT house_id, date, hdd
-                     FROM hdd_hourly) th
-            ON CAST(LEFT(th.date,13) AS DATETIME) = CAST(LEFT(ti1.date,13) AS DATETIME)
-                AND th.house_id = ti1.house_id
+              WHERE house_id = :house_id
+                AND device_id IN (0, 1, 2, 3)
+                AND date BETWEEN :start AND :end
+              GROUP BY house_id, date
+              HAVING COUNT(CASE WHEN device_id = 1 THEN 1 END) > 0) t
+          LEFT JOIN hdd_hourly th
+            ON th.house_id = t.house_id AND th.date = t.date
           LEFT JOIN energy_hourly e
-            ON CAST(LEFT(e.date,13) AS DATETIME) = CAST(LEFT(ti1.date,13) AS DATETIME)
-                AND e.house_id = ti1.house_id
-        WHERE CAST(ti1.date AS DATE) = DATE(:start)
-          AND ti1.house_id = :house_id
-        ORDER BY e.date
+            ON e.house_id = t.house_id AND e.date = t.date
+        ORDER BY t.date
         """
 
         items = items.from_statement(text(sql))
         items = items.params(house_id=house_id,
-                             start=self.args['start'],
-                             end=self.args['end']).all()
-
-        self.json_items = []
-        for item in items:
-            data = {'date': str(item.date),
-                    'net': str(item.net),
-                    'solar': str(item.solar),
-                    'used': str(item.used),
-                    'first_floor_temp': str(item.first_floor_temp),
-                    'second_floor_temp': str(item.second_floor_temp),
-                    'basement_temp': str(item.basement_temp),
-                    'outdoor_temp': str(item.outdoor_temp),
-                    'hdd': str(item.hdd),
-                    'water_heater': str(item.water_heater),
-                    'ashp': str(item.ashp),
-                    'water_pump': str(item.water_pump),
-                    'dryer': str(item.dryer),
-                    'washer': str(item.washer),
-                    'dishwasher': str(item.dishwasher),
-                    'stove': str(item.stove),
-                    'refrigerator': str(item.refrigerator),
-                    'living_room': str(item.living_room),
-                    'aux_heat_bedrooms': str(item.aux_heat_bedrooms),
-                    'aux_heat_living': str(item.aux_heat_living),
-                    'study': str(item.study),
-                    'barn': str(item.barn),
-                    'basement_west': str(item.basement_west),
-                    'basement_east': str(item.basement_east),
-                    'ventilation': str(item.ventilation),
-                    'ventilation_preheat': str(item.ventilation_preheat),
-                    'kitchen_recept_rt': str(item.kitchen_recept_rt),
-                    'all_other': str(item.all_other)}
-            self.json_items.append(data)
+                             start=self.is_date(self.args['start']),
+                             end=self.is_date(self.get_end()))
+
+        self.json_items = self.get_json_items(items, FIELDS)
+
+    def get_items_from_store(self, house):
+        """ Get and store hourly values from the hourly column store, a row per hour with
+        a first floor temperature row and per energy device row in that hour. """
+
+        positions = house.union(house.devices('temperature', [1]),
+                                self.args['start'].date, self.get_end().date, True)
+
+        dates = house.get_dates(positions).astype(object).tolist()
+        temperatures = [house.values('temperature%s' % device, 'temperature', positions)
+                        for device in TEMPERATURE_DEVICES]
+        hdd = house.values('hdd', 'hdd', positions)
+
+        devices = [(house.column(series, 'rows')[positions].tolist(),
+                    [house.values(series, column, positions)
+                     for column in ['adjusted_load', 'solar', 'used'] + CIRCUITS])
+                   for series in house.devices('energy')]
+
+        items = []
+        for position, date in enumerate(dates):
+            temperature = [values[position] for values in temperatures]
+            energy = [[values[position] for values in columns]
+                      for rows, columns in devices if rows[position]]
+            for values in energy or [[None] * (3 + len(CIRCUITS))]:
+                items.append(Hour(date, *values[:3], *temperature, hdd[position], *values[3:],
+                                  self.get_all_other(values[2], values[3:])))
+
+        self.json_items = self.get_json_items(items, FIELDS)
+
+    @classmethod
+    def get_all_other(cls, used, circuits):
+        """ Return used less all circuits, None if any is None. """
+
+        if used is None or None in circuits:
+            return None
+
+        return used - sum(circuits)
+
+    def get_end(self):
+        """ Return end of range, one day from start if not given. """
+
+        end = self.args['end']
+        if end is None and self.args['start'] is not None:
+            end = self.add_duration(self.args['start'], 1, 'day')
+
+        return end
 
     def get_response(self):
         """ Return response in json format. """
@@ -124,6 +153,6 @@ class Chart(View):
         if not self.success:
             return jsonify(self.error)
 
-        return jsonify(view='chart',
-                       interval=self.args['interval'],
-                       hours=self.json_items)
+        return self.jsonify(view='chart',
+                            interval=self.args['interval'],
+                            hours=self.json_items)
@@ -1,7 +1,6 @@
 """ CircuitDict class """
 # pylint: disable=no-member
-from chartingperformance import db_session
-from chartingperformance.models import Circuits
+from chartingperformance.registry import circuit_registry
 from flask import jsonify
 
 class CircuitDict(object):
@@ -12,13 +11,12 @@ class CircuitDict(object):
         self.circuits = self.get_circuits(house_id)
 
     def get_circuits(self, house_id):
-        """ Get, store and return list of circuits from database. """
+        """ Get, store and return dict of circuits by circuit_id from the registry. """
 
-        circuits = db_session.query(Circuits). \
-            filter(Circuits.house_id == house_id).all()
+        circuits = circuit_registry.get(house_id)
 
         self.json_items = []
-        for circuit in circuits:
+        for circuit in circuits.values():
             data = {'circuit_id': circuit.circuit_id,
                     'name': circuit.name,
                     'description': circuit.description}
@@ -0,0 +1,227 @@
+""" Export class """
+# pylint: disable=no-member
+import csv
+import io
+
+from chartingperformance import db_session
+from chartingperformance.views.view import View
+
+from chartingperformance.models import EnergyHourly
+from chartingperformance.models import TemperatureHourly
+from chartingperformance.models import HDDHourly
+
+from flask import jsonify, current_app, stream_with_context
+
+from sqlalchemy import Integer, Date, DateTime, Numeric
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+class Export(View):
+    """ Bulk hourly history export as csv, Arrow IPC stream or Parquet.
+    Rows are read from a server-side cursor and written a record batch at a time. """
+
+    tables = {'energy': EnergyHourly,
+              'temperature': TemperatureHourly,
+              'hdd': HDDHourly}
+
+    mimetypes = {'csv': 'text/csv',
+                 'arrow': 'application/vnd.apache.arrow.stream',
+                 'parquet': 'application/vnd.apache.parquet'}
+
+    def __init__(self, args, house_id):
+
+        super(Export, self).__init__(args)
+
+        self.house_id = house_id
+
+        if self.success:
+            if self.args['table'] not in self.tables:
+                self.success = False
+                self.error = {'error': 'Table \'%s\' does not exist' % self.args['table']}
+            elif self.args['format'] != 'csv' and pyarrow is None:
+                self.success = False
+                self.error = {'error': 'Format \'%s\' is not available, pyarrow is not installed.' %
+                                       self.args['format']}
+
+    def set_args(self, args):
+        """ Return dict with parameters included in GET, with export table and file format. """
+
+        export_args = super(Export, self).set_args(args)
+
+        export_args['table'] = args.get('table', 'energy')
+
+        export_args['format'] = args.get('format', 'csv')
+        if export_args['format'] not in self.mimetypes:
+            export_args['format'] = 'csv'
+
+        return export_args
+
+    def get_columns(self):
+        """ Return exported columns of the selected table. Stored buckets are left out. """
+
+        table = self.tables[self.args['table']].__table__
+
+        return [column for column in table.columns
+                if column.name != 'house_id' and column.computed is None]
+
+    def get_batches(self):
+        """ Yield lists of rows read from a server-side cursor. """
+
+        table = self.tables[self.args['table']]
+
+        self.base_query = db_session.query(*self.get_columns()).\
+            filter(table.house_id == self.house_id)
+
+        self.filter_query_by_date_range(table)
+
+        query = self.base_query.order_by(table.date).statement.\
+            execution_options(stream_results=True)
+
+        result = db_session.execute(query)
+
+        for rows in result.partitions(current_app.config['STREAM_BATCH_ROWS']):
+            yield rows
+
+    def get_schema(self):
+        """ Return Arrow schema built from the model column types. """
+
+        fields = []
+        for column in self.get_columns():
+            if isinstance(column.type, DateTime):
+                arrow_type = pyarrow.timestamp('s')
+            elif isinstance(column.type, Date):
+                arrow_type = pyarrow.date32()
+            elif isinstance(column.type, Numeric):
+                arrow_type = pyarrow.decimal128(column.type.precision, column.type.scale or 0)
+            elif isinstance(column.type, Integer):
+                arrow_type = pyarrow.int32()
+            else:
+                arrow_type = pyarrow.string()
+            fields.append(pyarrow.field(column.name, arrow_type))
+
+        return pyarrow.schema(fields)
+
+    def generate_csv(self):
+        """ Yield csv text, a batch of rows per chunk. """
+
+        sink = io.StringIO()
+        writer = csv.writer(sink)
+        writer.writerow([column.name for column in self.get_columns()])
+
+        for rows in self.get_batches():
+            writer.writerows(rows)
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+
+        yield sink.getvalue()
+
+    def generate_arrow(self):
+        """ Yield Arrow IPC stream bytes a record batch per chunk, or Parquet bytes
+        a row group of PARQUET_ROW_GROUP_ROWS per chunk. """
+
+        schema = self.get_schema()
+        sink = ChunkSink()
+
+        if self.args['format'] == 'parquet':
+            writer = pyarrow.parquet.ParquetWriter(sink, schema)
+            group = RowGroup(writer, current_app.config['PARQUET_ROW_GROUP_ROWS'])
+        else:
+            writer = pyarrow.ipc.new_stream(sink, schema)
+
+        for rows in self.get_batches():
+            batch = pyarrow.RecordBatch.from_arrays(
+                [pyarrow.array(column, type=field.type)
+                 for column, field in zip(zip(*rows), schema)],
+                schema=schema)
+            if self.args['format'] == 'parquet':
+                group.write(batch)
+            else:
+                writer.write_batch(batch)
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+
+        if self.args['format'] == 'parquet':
+            group.flush()
+        writer.close()
+        yield sink.drain()
+
+    def get_response(self):
+        """ Return streamed export file. """
+
+        if not self.success:
+            return jsonify(self.error)
+
+        if self.args['format'] == 'csv':
+            body = self.generate_csv()
+        else:
+            body = self.generate_arrow()
+
+        response = current_app.response_class(stream_with_context(body),
+                                              mimetype=self.mimetypes[self.args['format']])
+        response.headers['Content-Disposition'] = 'attachment; filename=house%s_%s_hourly.%s' % \
+            (self.house_id, self.args['table'], self.args['format'])
+
+        return response
+
+class RowGroup(object):
+    """ Buffer of record batches written to a Parquet writer a full row group at a time,
+    so small batches do not each become a row group. """
+
+    def __init__(self, writer, rows):
+        self.writer = writer
+        self.rows = rows
+        self.batches = []
+        self.buffered = 0
+
+    def write(self, batch):
+        """ Buffer batch, writing row groups while there are enough rows for one. """
+
+        self.batches.append(batch)
+        self.buffered += batch.num_rows
+
+        while self.buffered >= self.rows:
+            table = pyarrow.Table.from_batches(self.batches)
+            self.writer.write_table(table.slice(0, self.rows))
+            self.batches = table.slice(self.rows).to_batches()
+            self.buffered -= self.rows
+
+    def flush(self):
+        """ Write the remaining rows as the last row group. """
+
+        if self.buffered:
+            self.writer.write_table(pyarrow.Table.from_batches(self.batches))
+        self.batches = []
+        self.buffered = 0
+
+class ChunkSink(io.RawIOBase):
+    """ Write-only file that hands back what was written since the last drain. """
+
+    def __init__(self):
+        super(ChunkSink, self).__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        """ Return and forget bytes written so far. """
+
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
@@ -1,10 +1,11 @@
 """ ViewGeneration class """
 # pylint: disable=no-member
+from functools import partial
+
 from chartingperformance import db_session
 from chartingperformance.views.view import View
 
 from chartingperformance.models import EnergyHourly
-from chartingperformance.models import EnergyDaily
 from chartingperformance.models import EnergyMonthly
 from chartingperformance.models import EstimatedMonthly
 
@@ -21,91 +22,73 @@ class Generation(View):
         super(Generation, self).__init__(args)
 
         if self.success:
-            self.get_fields(house_id)
-            self.get_totals(house_id)
-            self.get_items()
-
-    def get_fields(self, house_id):
-        """ Get and store additional generation fields from database. """
-
-        tables = [EnergyHourly, EnergyDaily]
-        self.max_solar = []
-        for table in tables:
-            self.base_query = db_session.query(label('max_solar',
-                                                     func.min(table.solar))).\
-                filter(table.house_id == house_id) # nested query
+            self.max_solar = self.run_queries(partial(self.get_extreme, house_id,
+                                                      'solar_hour', 'solar'),
+                                              partial(self.get_extreme, house_id,
+                                                      'solar_day', 'solar'),
+                                              partial(self.get_totals_and_items, house_id))[:2]
 
-            sub_query = self.filter_query_by_date_range(table)
+    def get_totals_and_items(self, house_id):
+        """ Get and store totals and rows from database. """
 
-            max_solar_query = db_session.query(table.date,
-                                               label('max_solar', table.solar)).\
-                filter(table.solar == sub_query).first()
-
-            self.max_solar.append({'date': str(max_solar_query.date),
-                                   'solar': str(max_solar_query.max_solar)})
-
-    def get_totals(self, house_id):
-        """ Get and store totals from database. """
+        self.json_items = []
 
         if ('year' in self.args['interval']) or ('month' in self.args['interval']):
-            self.get_totals_year_month(house_id)
+            self.get_totals_and_items_year_month(house_id)
 
         elif ('day' in self.args['interval']) or ('hour' in self.args['interval']):
-            self.get_totals_day_hour(house_id)
+            self.get_totals_and_items_day_hour(house_id)
 
-    def get_totals_year_month(self, house_id):
-        """ Get and store yearly or monthly totals. """
+    def get_year_month_query(self, house_id):
+        """ Return actual and estimated generation query for date range. """
 
-        self.base_query = db_session.query(label('date', func.min(EnergyMonthly.date)),
-                                           label('sum_actual',
-                                                 func.sum(EnergyMonthly.solar)),
-                                           label('sum_estimated',
-                                                 func.sum(EstimatedMonthly.solar))).\
+        query = db_session.query(label('date', func.min(EnergyMonthly.date)),
+                                 label('sum_actual',
+                                       func.sum(EnergyMonthly.solar)),
+                                 label('sum_estimated',
+                                       func.sum(EstimatedMonthly.solar))).\
             outerjoin(EstimatedMonthly,
                       and_(EnergyMonthly.date == EstimatedMonthly.date,
                            EnergyMonthly.house_id == EstimatedMonthly.house_id)).\
             filter(EnergyMonthly.house_id == house_id)
 
-        self.filter_query_by_date_range(EnergyMonthly)
+        return self.filter_query_by_date_range(EnergyMonthly, query)
 
-        totals = self.base_query.one()
+    def get_totals_and_items_year_month(self, house_id):
+        """ Get and store yearly or monthly totals and rows. """
 
-        self.json_totals = {'actual': str(totals.sum_actual),
-                            'estimated': str(totals.sum_estimated)}
+        totals, items = self.query_totals_and_items(EnergyMonthly,
+                                                    self.get_year_month_query(house_id))
 
-    def get_totals_day_hour(self, house_id):
-        """ Get and store daily or hourly totals. """
+        self.json_totals = {'actual': self.format_number(totals.sum_actual),
+                            'estimated': self.format_number(totals.sum_estimated)}
 
-        self.base_query = db_session.query(label('date', func.min(EnergyHourly.date)),
-                                           label('sum_actual',
-                                                 func.sum(EnergyHourly.solar)/1000)).\
-            filter(EnergyHourly.house_id == house_id)
+        self.json_items = self.get_json_items(items,
+                                              ['date',
+                                               ('actual', 'sum_actual'),
+                                               ('estimated', 'sum_estimated')])
 
-        self.filter_query_by_date_range(EnergyHourly)
+    def get_day_hour_query(self, house_id):
+        """ Return actual generation query for date range. """
 
-        totals = self.base_query.one()
+        query = db_session.query(label('date', func.min(EnergyHourly.date)),
+                                 label('sum_actual',
+                                       func.sum(EnergyHourly.solar)/1000)).\
+            filter(EnergyHourly.house_id == house_id)
 
-        self.json_totals = {'actual': str(totals.sum_actual)}
+        return self.filter_query_by_date_range(EnergyHourly, query)
 
-    def get_items(self):
-        """ Get and store rows from database. """
+    def get_totals_and_items_day_hour(self, house_id):
+        """ Get and store daily or hourly totals and rows. """
 
-        self.json_items = []
+        totals, items = self.query_totals_and_items(EnergyHourly,
+                                                    self.get_day_hour_query(house_id))
 
-        if ('year' in self.args['interval']) or ('month' in self.args['interval']):
-            items = self.group_query_by_interval(EnergyMonthly)
-            for item in items:
-                data = {'date': str(item.date),
-                        'actual': str(item.sum_actual),
-                        'estimated': str(item.sum_estimated)}
-                self.json_items.append(data)
+        self.json_totals = {'actual': self.format_number(totals.sum_actual)}
 
-        elif ('day' in self.args['interval']) or ('hour' in self.args['interval']):
-            items = self.group_query_by_interval(EnergyHourly)
-            for item in items:
-                data = {'date': self.format_date(item.date),
-                        'actual': str(item.sum_actual)}
-                self.json_items.append(data)
+        self.json_items = self.get_json_items(items,
+                                              ['date', ('actual', 'sum_actual')],
+                                              self.format_date)
 
     def get_response(self):
         """ Return response in json format. """
@@ -113,9 +96,9 @@ class Generation(View):
         if not self.success:
             return jsonify(self.error)
 
-        return jsonify(view='generation',
-                       interval=self.args['interval'],
-                       max_solar_hour=self.max_solar[0],
-                       max_solar_day=self.max_solar[1],
-                       totals=self.json_totals,
-                       items=self.json_items)
+        return self.jsonify(view='generation',
+                            interval=self.args['interval'],
+                            max_solar_hour=self.max_solar[0],
+                            max_solar_day=self.max_solar[1],
+                            totals=self.json_totals,
+                            items=self.json_items)
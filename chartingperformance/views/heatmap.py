@@ -83,37 +83,19 @@ class Heatmap(View):
         items = items.params(house_id=house_id,
                              base=self.args['base'],
                              start=self.args['start'],
-                             end=self.args['end']).all()
-
-        self.json_items = []
-        for item in items:
-            data = {'date': str(item.date),
-                    'net': str(item.net),
-                    'solar': str(item.solar),
-                    'used': str(item.used),
-                    'outdoor_deg_min': str(item.outdoor_deg_min),
-                    'outdoor_deg_max': str(item.outdoor_deg_max),
-                    'hdd': str(item.hdd),
-                    'water_heater': str(item.water_heater),
-                    'ashp': str(item.ashp),
-                    'water_pump': str(item.water_pump),
-                    'dryer': str(item.dryer),
-                    'washer': str(item.washer),
-                    'dishwasher': str(item.dishwasher),
-                    'stove': str(item.stove),
-                    'refrigerator': str(item.refrigerator),
-                    'living_room': str(item.living_room),
-                    'aux_heat_bedrooms': str(item.aux_heat_bedrooms),
-                    'aux_heat_living': str(item.aux_heat_living),
-                    'study': str(item.study),
-                    'barn': str(item.barn),
-                    'basement_west': str(item.basement_west),
-                    'basement_east': str(item.basement_east),
-                    'ventilation': str(item.ventilation),
-                    'ventilation_preheat': str(item.ventilation_preheat),
-                    'kitchen_recept_rt': str(item.kitchen_recept_rt),
-                    'all_other': str(item.all_other)}
-            self.json_items.append(data)
+                             end=self.args['end'])
+
+        self.json_items = self.get_json_items(items,
+                                              ['date', 'net', 'solar', 'used',
+                                               'outdoor_deg_min', 'outdoor_deg_max',
+                                               'hdd', 'water_heater', 'ashp',
+                                               'water_pump', 'dryer', 'washer',
+                                               'dishwasher', 'stove', 'refrigerator',
+                                               'living_room', 'aux_heat_bedrooms',
+                                               'aux_heat_living', 'study', 'barn',
+                                               'basement_west', 'basement_east',
+                                               'ventilation', 'ventilation_preheat',
+                                               'kitchen_recept_rt', 'all_other'])
 
     def get_response(self):
         """ Return response in json format. """
@@ -121,6 +103,6 @@ class Heatmap(View):
         if not self.success:
             return jsonify(self.error)
 
-        return jsonify(view='heatmap',
-                       interval=self.args['interval'],
-                       days=self.json_items)
+        return self.jsonify(view='heatmap',
+                            interval=self.args['interval'],
+                            days=self.json_items)
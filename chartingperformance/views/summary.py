@@ -2,6 +2,8 @@
 # pylint: disable=no-member
 from chartingperformance import db_session
 from chartingperformance.views.view import View
+from chartingperformance.store import Field
+from chartingperformance.store import scale_of
 
 from chartingperformance.models import EnergyHourly
 from chartingperformance.models import EnergyMonthly
@@ -21,55 +23,72 @@ class Summary(View):
         super(Summary, self).__init__(args)
 
         if self.success:
-            # default to monthly, has more data for 2012
-            energy_table = EnergyMonthly
-            hdd_table = HDDMonthly
-            div = 1
-
-            if 'day' in self.args['interval'] or 'hour' in self.args['interval']:
-                energy_table = EnergyHourly
-                hdd_table = HDDHourly
-                div = 1000
-
-            self.base_query = db_session.\
-                              query(label('date', func.min(energy_table.date)),
-                                    label('sum_solar', func.sum(energy_table.solar)/div),
-                                    label('sum_used', func.sum(energy_table.used)/div),
-                                    label('sum_adjusted_load', func.sum(energy_table.adjusted_load)/div),
-                                    label('sum_hdd', func.sum(hdd_table.hdd))).\
-                outerjoin(hdd_table, and_(energy_table.date == hdd_table.date,
-                                          energy_table.house_id == hdd_table.house_id)).\
-                filter(energy_table.house_id == house_id)
-
-            self.get_totals(energy_table)
-            self.get_items(energy_table)
-
-    def get_totals(self, energy_table):
-        """ Get and store totals from database. """
+            house = self.get_store(house_id, ['day', 'hour'])
+            if house is not None:
+                self.get_totals_and_items_from_store(house)
+            else:
+                self.get_totals_and_items(house_id)
+
+    def get_totals_and_items(self, house_id):
+        """ Get and store totals and rows from database. """
+
+        # default to monthly, has more data for 2012
+        energy_table = EnergyMonthly
+        hdd_table = HDDMonthly
+        div = 1
+
+        if 'day' in self.args['interval'] or 'hour' in self.args['interval']:
+            energy_table = EnergyHourly
+            hdd_table = HDDHourly
+            div = 1000
+
+        self.base_query = db_session.\
+                          query(label('date', func.min(energy_table.date)),
+                                label('sum_solar', func.sum(energy_table.solar)/div),
+                                label('sum_used', func.sum(energy_table.used)/div),
+                                label('sum_adjusted_load', func.sum(energy_table.adjusted_load)/div),
+                                label('sum_hdd', func.sum(hdd_table.hdd))).\
+            outerjoin(hdd_table, and_(energy_table.date == hdd_table.date,
+                                      energy_table.house_id == hdd_table.house_id)).\
+            filter(energy_table.house_id == house_id)
 
         self.filter_query_by_date_range(energy_table)
 
-        totals = self.base_query.one()
+        self.set_totals_and_items(*self.query_totals_and_items(energy_table))
 
-        self.json_totals = {'net': str(totals.sum_adjusted_load),
-                            'solar': str(totals.sum_solar),
-                            'used': str(totals.sum_used),
-                            'hdd': str(totals.sum_hdd)
-                           }
+    def get_totals_and_items_from_store(self, house):
+        """ Get and store totals and rows from the hourly column store. """
+
+        rows = house.rows(house.devices('energy'), *self.get_store_range())
+
+        fields = {'sum_solar': Field('sum', rows.get('solar'), scale_of('energy', 'solar'),
+                                     EnergyHourly.divisor),
+                  'sum_used': Field('sum', rows.get('used'), scale_of('energy', 'used'),
+                                    EnergyHourly.divisor),
+                  'sum_adjusted_load': Field('sum', rows.get('adjusted_load'),
+                                             scale_of('energy', 'adjusted_load'),
+                                             EnergyHourly.divisor),
+                  'sum_hdd': Field('sum', rows.join('hdd', 'hdd'), scale_of('hdd', 'hdd'), 1)}
 
-    def get_items(self, energy_table):
-        """ Get and store rows from database. """
+        self.set_totals_and_items(rows.aggregate(fields)[0],
+                                  rows.aggregate(fields, self.args['interval']))
 
-        items = self.group_query_by_interval(energy_table)
+    def set_totals_and_items(self, totals, items):
+        """ Store totals and rows in json format. """
+
+        self.json_totals = {'net': self.format_number(totals.sum_adjusted_load),
+                            'solar': self.format_number(totals.sum_solar),
+                            'used': self.format_number(totals.sum_used),
+                            'hdd': self.format_number(totals.sum_hdd)
+                           }
 
-        self.json_items = []
-        for item in items:
-            data = {'date': self.format_date(item.date),
-                    'net': str(item.sum_adjusted_load),
-                    'solar': str(item.sum_solar),
-                    'used': str(item.sum_used),
-                    'hdd': str(item.sum_hdd)}
-            self.json_items.append(data)
+        self.json_items = self.get_json_items(items,
+                                              ['date',
+                                               ('net', 'sum_adjusted_load'),
+                                               ('solar', 'sum_solar'),
+                                               ('used', 'sum_used'),
+                                               ('hdd', 'sum_hdd')],
+                                              self.format_date)
 
     def get_response(self):
         """ Return response in json format. """
@@ -77,7 +96,7 @@ class Summary(View):
         if not self.success:
             return jsonify(self.error)
 
-        return jsonify(view='summary',
-                       interval=self.args['interval'],
-                       totals=self.json_totals,
-                       items=self.json_items)
+        return self.jsonify(view='summary',
+                            interval=self.args['interval'],
+                            totals=self.json_totals,
+                            items=self.json_items)
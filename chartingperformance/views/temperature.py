@@ -2,6 +2,8 @@
 # pylint: disable=no-member
 from chartingperformance import db_session
 from chartingperformance.views.view import View
+from chartingperformance.store import Field
+from chartingperformance.store import scale_of
 
 from chartingperformance.models import TemperatureHourly
 from chartingperformance.models import HDDHourly
@@ -19,11 +21,14 @@ class Temperature(View):
         super(Temperature, self).__init__(args)
 
         if self.success:
-            self.get_totals(house_id)
-            self.get_items()
+            house = self.get_store(house_id, self.valid_intervals)
+            if house is not None:
+                self.get_totals_and_items_from_store(house)
+            else:
+                self.get_totals_and_items(house_id)
 
-    def get_totals(self, house_id):
-        """ Get and store totals from database. """
+    def get_totals_and_items(self, house_id):
+        """ Get and store totals and rows from database. """
 
         self.base_query = db_session.\
                           query(label('date', func.min(TemperatureHourly.date)),
@@ -46,30 +51,43 @@ class Temperature(View):
 
         self.filter_query_by_date_range(TemperatureHourly)
 
-        totals = self.base_query.one()
+        self.set_totals_and_items(*self.query_totals_and_items(TemperatureHourly))
 
-        self.json_totals = {'min_temperature': str(totals.min_temperature),
-                            'max_temperature': str(totals.max_temperature),
-                            'avg_temperature': str(totals.avg_temperature),
-                            'sum_hdd': str(totals.sum_hdd),
-                            'min_humidity': str(totals.min_humidity),
-                            'max_humidity': str(totals.max_humidity)}
+    def get_totals_and_items_from_store(self, house):
+        """ Get and store totals and rows from the hourly column store. """
 
-    def get_items(self):
-        """ Get and store rows from database. """
+        rows = house.rows(house.devices('temperature', [self.args['location']]),
+                          *self.get_store_range())
 
-        items = self.group_query_by_interval(TemperatureHourly)
+        temperature = rows.get('temperature')
+        humidity = rows.get('humidity')
+        scale = scale_of('temperature', 'temperature')
 
-        self.json_items = []
-        for item in items:
-            data = {'date': self.format_date(item.date),
-                    'min_temperature': str(item.min_temperature),
-                    'max_temperature': str(item.max_temperature),
-                    'avg_temperature': str(item.avg_temperature),
-                    'sum_hdd': str(item.sum_hdd),
-                    'min_humidity': str(item.min_humidity),
-                    'max_humidity': str(item.max_humidity)}
-            self.json_items.append(data)
+        fields = {'min_temperature': Field('min', temperature, scale, 1),
+                  'max_temperature': Field('max', temperature, scale, 1),
+                  'avg_temperature': Field('avg', temperature, scale, 1),
+                  'min_humidity': Field('min', humidity, scale_of('temperature', 'humidity'), 1),
+                  'max_humidity': Field('max', humidity, scale_of('temperature', 'humidity'), 1),
+                  'sum_hdd': Field('sum', rows.join('hdd', 'hdd'), scale_of('hdd', 'hdd'), 1)}
+
+        self.set_totals_and_items(rows.aggregate(fields)[0],
+                                  rows.aggregate(fields, self.args['interval']))
+
+    def set_totals_and_items(self, totals, items):
+        """ Store totals and rows in json format. """
+
+        self.json_totals = {'min_temperature': self.format_number(totals.min_temperature),
+                            'max_temperature': self.format_number(totals.max_temperature),
+                            'avg_temperature': self.format_number(totals.avg_temperature),
+                            'sum_hdd': self.format_number(totals.sum_hdd),
+                            'min_humidity': self.format_number(totals.min_humidity),
+                            'max_humidity': self.format_number(totals.max_humidity)}
+
+        self.json_items = self.get_json_items(items,
+                                              ['date', 'min_temperature', 'max_temperature',
+                                               'avg_temperature', 'sum_hdd',
+                                               'min_humidity', 'max_humidity'],
+                                              self.format_date)
 
     def get_response(self):
         """ Return response in json format. """
@@ -77,8 +95,8 @@ class Temperature(View):
         if not self.success:
             return jsonify(self.error)
 
-        return jsonify(view='temperature',
-                       interval=self.args['interval'],
-                       location=self.args['location'],
-                       totals=self.json_totals,
-                       items=self.json_items)
+        return self.jsonify(view='temperature',
+                            interval=self.args['interval'],
+                            location=self.args['location'],
+                            totals=self.json_totals,
+                            items=self.json_items)
@@ -1,18 +1,30 @@
 """ ViewUsage class """
 # pylint: disable=no-member
+from collections import namedtuple
+
 from chartingperformance import db_session
+from chartingperformance import rollup
 from chartingperformance.views.view import View
-from chartingperformance.views.circuit import CircuitDict
+from chartingperformance.watermark import watermarks
+from chartingperformance.registry import circuit_registry
+from chartingperformance.store import Field
+from chartingperformance.store import scale_of
 
+from chartingperformance.models import CIRCUITS
 from chartingperformance.models import EnergyHourly
+from chartingperformance.models import EnergyDaily
 from chartingperformance.models import EnergyMonthly
 from chartingperformance.models import EstimatedMonthly
+from chartingperformance.models import CircuitDaily
+from chartingperformance.models import CircuitMonthly
 
-from flask import jsonify
+from flask import jsonify, current_app
 
 from sqlalchemy import func
 from sqlalchemy.sql import label, and_, or_, text
 
+Actual = namedtuple('Actual', ['date', 'actual'])
+
 class Usage(View):
     """ Usage view queries and response methods. """
 
@@ -22,7 +34,7 @@ class Usage(View):
 
         if self.success:
 
-            self.circuits = CircuitDict(house_id)
+            self.circuits = circuit_registry.get(house_id)
 
             if self.args['circuit'] == 'summary':
                 self.get_summary(house_id)
@@ -42,49 +54,16 @@ class Usage(View):
     def get_summary(self, house_id):
         """ Get and store summary usage values from database. """
 
-        self.base_query = db_session.query(label('used',
-                                                 func.sum(EnergyHourly.used)/1000),
-                                           label('water_heater',
-                                                 func.sum(EnergyHourly.water_heater)/1000),
-                                           label('ashp',
-                                                 func.sum(EnergyHourly.ashp)/1000),
-                                           label('water_pump',
-                                                 func.sum(EnergyHourly.water_pump)/1000),
-                                           label('dryer',
-                                                 func.sum(EnergyHourly.dryer)/1000),
-                                           label('washer',
-                                                 func.sum(EnergyHourly.washer)/1000),
-                                           label('dishwasher',
-                                                 func.sum(EnergyHourly.dishwasher)/1000),
-                                           label('stove',
-                                                 func.sum(EnergyHourly.stove)/1000),
-                                           label('refrigerator',
-                                                 func.sum(EnergyHourly.refrigerator)/1000),
-                                           label('living_room',
-                                                 func.sum(EnergyHourly.living_room)/1000),
-                                           label('aux_heat_bedrooms',
-                                                 func.sum(EnergyHourly.aux_heat_bedrooms)/1000),
-                                           label('aux_heat_living',
-                                                 func.sum(EnergyHourly.aux_heat_living)/1000),
-                                           label('study',
-                                                 func.sum(EnergyHourly.study)/1000),
-                                           label('barn',
-                                                 func.sum(EnergyHourly.barn)/1000),
-                                           label('basement_west',
-                                                 func.sum(EnergyHourly.basement_west)/1000),
-                                           label('basement_east',
-                                                 func.sum(EnergyHourly.basement_east)/1000),
-                                           label('ventilation',
-                                                 func.sum(EnergyHourly.ventilation)/1000),
-                                           label('ventilation_preheat',
-                                                 func.sum(EnergyHourly.ventilation_preheat)/1000),
-                                           label('kitchen_recept_rt',
-                                                 func.sum(EnergyHourly.kitchen_recept_rt)/1000)).\
-            filter(EnergyHourly.house_id == house_id).\
-            filter(or_(EnergyHourly.device_id == 5,
-                       EnergyHourly.device_id == 10))
-
-        self.filter_query_by_date_range(EnergyHourly)
+        # not grouped, so any rollup aligned with the date range will do
+        table = self.plan_table(self.circuit_tables(house_id), 'year')
+
+        self.base_query = db_session.query(*[label(circuit, self.sum_kwh(table, circuit))
+                                             for circuit in ['used'] + CIRCUITS]).\
+            filter(table.house_id == house_id)
+
+        self.filter_query_by_monitors(table)
+
+        self.filter_query_by_date_range(table)
 
         totals = self.base_query.one()
 
@@ -100,11 +79,11 @@ class Usage(View):
                 subtotal = subtotal - actual
 
             self.json_circuits.append({'circuit_id': column['name'],
-                                       'actual': str(actual),
+                                       'actual': self.format_number(actual),
                                        'name': self.get_circuit_info(column['name'])['name']
                                       })
         self.json_circuits.append({'circuit_id': 'all_other',
-                                   'actual': str(subtotal),
+                                   'actual': self.format_number(subtotal),
                                    'name': self.get_circuit_info('all_other')['name']
                                   })
         if 'year' in self.args['interval']:
@@ -141,19 +120,12 @@ class Usage(View):
 
         self.filter_query_by_date_range(EnergyMonthly)
 
-        totals = self.base_query.one()
-
-        self.json_totals = {'actual': str(totals.actual),
-                            'budget': str(totals.budget)}
+        totals, items = self.query_totals_and_items(EnergyMonthly)
 
-        items = self.group_query_by_interval(EnergyMonthly)
+        self.json_totals = {'actual': self.format_number(totals.actual),
+                            'budget': self.format_number(totals.budget)}
 
-        self.json_items = []
-        for item in items:
-            data = {'date': str(item.date),
-                    'actual': str(item.actual),
-                    'budget': str(item.budget)}
-            self.json_items.append(data)
+        self.json_items = self.get_json_items(items, ['date', 'actual', 'budget'])
 
         self.json_circuit = {'circuit_id': 'all',
                              'name':  self.get_circuit_info('all')['name'],
@@ -162,26 +134,27 @@ class Usage(View):
     def get_circuit_all_day_hour(self, house_id):
         """ Get and store all circuit usage total for daily or hourly. """
 
-        self.base_query = db_session.query(label('actual',
-                                                 func.sum(EnergyHourly.used)/1000)).\
-            filter(EnergyHourly.house_id == house_id)
+        house = self.get_store(house_id, ['day', 'hour'])
+        if house is not None:
+            totals, items = self.get_actual_from_store(house, house.devices('energy'), 'used')
 
-        self.base_query = self.base_query.\
-                    add_columns(label('date', func.min(EnergyHourly.date)))
+        else:
+            table = self.plan_table([EnergyHourly, EnergyDaily])
 
-        self.filter_query_by_date_range(EnergyHourly)
+            self.base_query = db_session.query(label('actual',
+                                                     self.sum_kwh(table, 'used'))).\
+                filter(table.house_id == house_id)
 
-        totals = self.base_query.one()
+            self.base_query = self.base_query.\
+                        add_columns(label('date', func.min(table.date)))
+
+            self.filter_query_by_date_range(table)
 
-        self.json_totals = {'actual': str(totals.actual)}
+            totals, items = self.query_totals_and_items(table)
 
-        items = self.group_query_by_interval(EnergyHourly)
+        self.json_totals = {'actual': self.format_number(totals.actual)}
 
-        self.json_items = []
-        for item in items:
-            data = {'date': self.format_date(item.date),
-                    'actual': str(item.actual)}
-            self.json_items.append(data)
+        self.json_items = self.get_json_items(items, ['date', 'actual'], self.format_date)
 
         self.json_circuit = {'circuit_id': 'all',
                              'name':  self.get_circuit_info('all')['name'],
@@ -202,6 +175,7 @@ class Usage(View):
         sql = """SELECT %s AS 'date', SUM(e.ashp)/1000.0 AS 'actual',
                   SUM( IF( ((:base - t.temperature) / 24) > 0,
                   ((:base - t.temperature) / 24), 0) ) AS 'hdd'
+                  %s
                  FROM temperature_hourly t, energy_hourly e
                  WHERE t.device_id = 0
                   AND t.house_id = :house_id
@@ -209,16 +183,49 @@ class Usage(View):
                   AND (e.device_id = 5 OR e.device_id = 10)
                   %s
                   AND e.date = t.date
-             """ % (date_column_format, date_range)
+             """
+
+        params = {'house_id': house_id,
+                  'start': self.args['start'],
+                  'end': self.args['end'],
+                  'base': self.args['base']}
 
-        totals = session.from_statement(text(sql))
-        totals = totals.params(house_id=house_id,
-                               start=self.args['start'],
-                               end=self.args['end'],
-                               base=self.args['base']).one()
+        if self.use_rollup():
+            bucket = self.get_bucket_sql(EnergyHourly, 'e')
+            rollup_sql = sql % (date_column_format, ", %s AS 'rollup_bucket'" % bucket,
+                                date_range)
 
-        self.json_totals = {'actual': str(totals.actual),
-                            'hdd': str(totals.hdd)}
+            rows = db_session.query("date", "actual", "hdd", "rollup_bucket").\
+                from_statement(text(rollup_sql + " GROUP BY %s WITH ROLLUP" % bucket)).\
+                params(**params).all()
+
+            totals, items = self.split_rollup(rows)
+
+        else:
+            totals = None
+            items = session.from_statement(text(sql % (date_column_format, "", date_range) +
+                                                self.get_ashp_group_by())).params(**params)
+
+        if totals is None:
+            totals = session.from_statement(text(sql % (date_column_format, "", date_range))).\
+                params(**params).one()
+
+        self.json_totals = {'actual': self.format_number(totals.actual),
+                            'hdd': self.format_number(totals.hdd)}
+
+        self.json_items = self.get_json_items(items, ['date', 'actual', 'hdd'],
+                                              self.format_date)
+
+        self.json_circuit = {'circuit_id': 'ashp',
+                             'name':  self.get_circuit_info('ashp')['name'],
+                             'description': self.get_circuit_info('ashp')['description']}
+
+    def get_ashp_group_by(self):
+        """ Return GROUP BY clause for ashp items by interval. """
+
+        if current_app.config['INTERVAL_BUCKETS'] and \
+           self.args['interval'] in self.valid_intervals:
+            return " GROUP BY %s" % self.get_bucket_sql(EnergyHourly, 'e')
 
         grp = ""
 
@@ -231,87 +238,41 @@ class Usage(View):
         elif 'hour' in self.args['interval']:
             grp = ", MONTH(e.date), DAY(e.date), HOUR(e.date) "
 
-        sql = sql + " GROUP BY YEAR(e.date)" + grp
+        return " GROUP BY YEAR(e.date)" + grp
 
-        items = session.from_statement(text(sql))
-        items = items.params(house_id=house_id,
-                             start=self.args['start'],
-                             end=self.args['end'],
-                             base=self.args['base']).all()
+    def get_circuit_all_other(self, house_id):
+        """ Get and store all other unmonitored circuits total and by interval from database. """
 
-        self.json_items = []
-        for item in items:
-            data = {'date': self.format_date(item.date),
-                    'actual': str(item.actual),
-                    'hdd': str(item.hdd)}
-            self.json_items.append(data)
+        house = self.get_store(house_id, ['month', 'day', 'hour'])
+        if house is not None:
+            totals, items = self.get_actual_from_store(house, house.devices('energy', [5, 10]),
+                                                       'used', CIRCUITS)
 
-        self.json_circuit = {'circuit_id': 'ashp',
-                             'name':  self.get_circuit_info('ashp')['name'],
-                             'description': self.get_circuit_info('ashp')['description']}
+        else:
+            table = self.plan_table(self.circuit_tables(house_id))
 
-    def get_circuit_all_other(self, house_id):
-        """ Get and store all other unmonitored circuits total and by interval from database. """
+            actual = self.sum_kwh(table, 'used')
+            for circuit in CIRCUITS:
+                column = getattr(table, circuit)
+                if table.divisor != 1:
+                    column = column/table.divisor
+                actual = actual - func.sum(func.IF(getattr(table, circuit) != None, column, 0))
 
-        self.base_query = db_session.\
-                          query(label('actual',
-                                      func.sum(EnergyHourly.used)/1000 -
-                                      func.sum(func.IF(EnergyHourly.water_heater != None,
-                                                       EnergyHourly.water_heater/1000, 0)) -
-                                      func.sum(func.IF(EnergyHourly.ashp != None,
-                                                       EnergyHourly.ashp/1000, 0)) -
-                                      func.sum(func.IF(EnergyHourly.water_pump != None,
-                                                       EnergyHourly.water_pump/1000, 0)) -
-                                      func.sum(func.IF(EnergyHourly.dryer != None,
-                                                       EnergyHourly.dryer/1000, 0)) -
-                                      func.sum(func.IF(EnergyHourly.washer != None,
-                                                       EnergyHourly.washer/1000, 0)) -
-                                      func.sum(func.IF(EnergyHourly.dishwasher != None,
-                                                       EnergyHourly.dishwasher/1000, 0)) -
-                                      func.sum(func.IF(EnergyHourly.stove != None,
-                                                       EnergyHourly.stove/1000, 0)) -
-                                      func.sum(func.IF(EnergyHourly.refrigerator != None,
-                                                       EnergyHourly.refrigerator/1000, 0)) -
-                                      func.sum(func.IF(EnergyHourly.living_room != None,
-                                                       EnergyHourly.living_room/1000, 0)) -
-                                      func.sum(func.IF(EnergyHourly.aux_heat_bedrooms != None,
-                                                       EnergyHourly.aux_heat_bedrooms/1000, 0)) -
-                                      func.sum(func.IF(EnergyHourly.aux_heat_living != None,
-                                                       EnergyHourly.aux_heat_living/1000, 0)) -
-                                      func.sum(func.IF(EnergyHourly.study != None,
-                                                       EnergyHourly.study/1000, 0)) -
-                                      func.sum(func.IF(EnergyHourly.barn != None,
-                                                       EnergyHourly.barn/1000, 0)) -
-                                      func.sum(func.IF(EnergyHourly.basement_west != None,
-                                                       EnergyHourly.basement_west/1000, 0)) -
-                                      func.sum(func.IF(EnergyHourly.basement_east != None,
-                                                       EnergyHourly.basement_east/1000, 0)) -
-                                      func.sum(func.IF(EnergyHourly.ventilation != None,
-                                                       EnergyHourly.ventilation/1000, 0)) -
-                                      func.sum(func.IF(EnergyHourly.ventilation_preheat != None,
-                                                       EnergyHourly.ventilation_preheat/1000, 0)) -
-                                      func.sum(func.IF(EnergyHourly.kitchen_recept_rt != None, \
-                                                       EnergyHourly.kitchen_recept_rt/1000, 0)))).\
-            filter(EnergyHourly.house_id == house_id).\
-            filter(or_(EnergyHourly.device_id == 5,
-                       EnergyHourly.device_id == 10))
-
-        self.base_query = self.base_query.\
-                    add_columns(label('date', func.min(EnergyHourly.date)))
-
-        self.filter_query_by_date_range(EnergyHourly)
+            self.base_query = db_session.query(label('actual', actual)).\
+                filter(table.house_id == house_id)
 
-        totals = self.base_query.one()
+            self.filter_query_by_monitors(table)
 
-        self.json_totals = {'actual': str(totals.actual)}
+            self.base_query = self.base_query.\
+                        add_columns(label('date', func.min(table.date)))
 
-        items = self.group_query_by_interval(EnergyHourly)
+            self.filter_query_by_date_range(table)
 
-        self.json_items = []
-        for item in items:
-            data = {'date': self.format_date(item.date),
-                    'actual': str(item.actual)}
-            self.json_items.append(data)
+            totals, items = self.query_totals_and_items(table)
+
+        self.json_totals = {'actual': self.format_number(totals.actual)}
+
+        self.json_items = self.get_json_items(items, ['date', 'actual'], self.format_date)
 
         self.json_circuit = {'circuit_id': 'all_other',
                              'name':  self.get_circuit_info('all_other')['name'],
@@ -320,44 +281,112 @@ class Usage(View):
     def get_circuit_x(self, house_id, circuit):
         """ Get and store circuit x total and by interval from database. """
 
-        self.base_query = db_session.\
-                          query(label('actual',
-                                      func.sum(getattr(EnergyHourly, circuit))/1000)
-                               ).\
-            filter(EnergyHourly.house_id == house_id).\
-            filter(or_(EnergyHourly.device_id == 5,
-                       EnergyHourly.device_id == 10))
+        house = None
+        if circuit in CIRCUITS:
+            house = self.get_store(house_id, ['month', 'day', 'hour'])
+
+        if house is not None:
+            totals, items = self.get_actual_from_store(house, house.devices('energy', [5, 10]),
+                                                       circuit)
 
-        self.base_query = self.base_query.\
-                    add_columns(label('date', func.min(EnergyHourly.date)))
+        else:
+            # rollups only hold used and the monitored circuits
+            tables = [EnergyHourly]
+            if circuit in ['used'] + CIRCUITS:
+                tables = self.circuit_tables(house_id)
+            table = self.plan_table(tables)
 
-        self.filter_query_by_date_range(EnergyHourly)
+            self.base_query = db_session.\
+                              query(label('actual', self.sum_kwh(table, circuit))).\
+                filter(table.house_id == house_id)
 
-        totals = self.base_query.one()
+            self.filter_query_by_monitors(table)
+
+            self.base_query = self.base_query.\
+                        add_columns(label('date', func.min(table.date)))
+
+            self.filter_query_by_date_range(table)
 
-        self.json_totals = {'actual': str(totals.actual)}
+            totals, items = self.query_totals_and_items(table)
 
-        items = self.group_query_by_interval(EnergyHourly)
+        self.json_totals = {'actual': self.format_number(totals.actual)}
 
-        self.json_items = []
-        for item in items:
-            data = {'date': self.format_date(item.date),
-                    'actual': str(item.actual)}
-            self.json_items.append(data)
+        self.json_items = self.get_json_items(items, ['date', 'actual'], self.format_date)
 
         self.json_circuit = {'circuit_id': circuit,
                              'name':  self.get_circuit_info(circuit)['name'],
                              'description': self.get_circuit_info(circuit)['description']}
 
-    def get_circuit_info(self, circuit_id):
-        """ Return circuit details as dict. """
+    def get_actual_from_store(self, house, series, circuit, subtracted=()):
+        """ Return totals row and rows by interval of circuit kWh from the hourly column store,
+        less the subtracted circuits where they have values. """
+
+        rows = house.rows(series, *self.get_store_range())
+
+        fields = dict((column, Field('sum', rows.get(column), scale_of('energy', column),
+                                     EnergyHourly.divisor))
+                      for column in [circuit] + list(subtracted))
 
-        for row in self.circuits.circuits:
+        results = []
+        for grouped in (rows.aggregate(fields), rows.aggregate(fields, self.args['interval'])):
+            results.append([Actual(row.date, self.subtract(row, circuit, subtracted))
+                            for row in grouped])
+
+        return results[0][0], results[1]
+
+    @classmethod
+    def subtract(cls, row, circuit, subtracted):
+        """ Return circuit value of row less subtracted circuit values, None as 0. """
+
+        actual = getattr(row, circuit)
+        if actual is None:
+            return None
+        for column in subtracted:
+            value = getattr(row, column)
+            if value is not None:
+                actual = actual - value
+
+        return actual
+
+    def circuit_tables(self, house_id):
+        """ Return tables holding per circuit usage of house X, finest grain first.
+        Rollups behind the watermark are only used for date ranges ending before
+        their end date. """
+
+        if not current_app.config['CIRCUIT_ROLLUPS']:
+            return [EnergyHourly]
+
+        end_date = rollup.get_end_date(house_id)
+        if end_date is None:
+            return [EnergyHourly]
+
+        watermark = watermarks.get(house_id)
+        end = self.is_date(self.args['end'])
+        if watermark is not None and end_date < watermark and (end is None or end > end_date):
+            return [EnergyHourly]
+
+        return [EnergyHourly, CircuitDaily, CircuitMonthly]
+
+    def filter_query_by_monitors(self, table):
+        """ Return original query limited to eMonitor and eGauge rows.
+        Circuit rollups are built from those devices only, so need no filter. """
+
+        if hasattr(table, 'device_id'):
+            self.base_query = self.base_query.\
+                              filter(or_(table.device_id == 5,
+                                         table.device_id == 10))
+
+        return self.base_query
+
+    def get_circuit_info(self, circuit_id):
+        """ Return circuit details as dict, None if house has no such circuit. """
 
-            if row.circuit_id == circuit_id:
+        circuit = self.circuits.get(circuit_id)
+        if circuit is None:
+            return None
 
-                return {'name': row.name,
-                        'description': row.description}
+        return {'name': circuit.name,
+                'description': circuit.description}
 
     def get_response(self):
         """ Return response in json format. """
@@ -366,12 +395,12 @@ class Usage(View):
             return jsonify(self.error)
 
         if self.args['circuit'] == 'summary':
-            return jsonify(view='usage.' + self.args['circuit'],
-                           circuits=self.json_circuits,
-                           circuit=self.json_circuit)
-
-        return jsonify(view='usage.' + self.args['circuit'],
-                       interval=self.args['interval'],
-                       circuit=self.json_circuit,
-                       totals=self.json_totals,
-                       items=self.json_items)
+            return self.jsonify(view='usage.' + self.args['circuit'],
+                                circuits=self.json_circuits,
+                                circuit=self.json_circuit)
+
+        return self.jsonify(view='usage.' + self.args['circuit'],
+                            interval=self.args['interval'],
+                            circuit=self.json_circuit,
+                            totals=self.json_totals,
+                            items=self.json_items)
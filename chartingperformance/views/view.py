@@ -1,18 +1,55 @@
 """ View parent class """
 # pylint: disable=no-member
 import re
+import datetime
 import moment
 
-from sqlalchemy import func
-from sqlalchemy.sql import or_, text
+from chartingperformance import encoding
+from chartingperformance import extremes
+from chartingperformance.models import BUCKET_DAY, BUCKET_MONTH, BUCKET_YEAR
+from chartingperformance.executor import query_executor
+from chartingperformance.store import column_store
+from chartingperformance.watermark import watermarks
+
+from flask import current_app, jsonify
+
+from sqlalchemy import func, Date
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import or_, text, label, literal_column
+from sqlalchemy.sql.expression import ColumnElement
+from sqlalchemy.sql.visitors import InternalTraversal
+
+# Expressions of the stored bucket columns, grouped by when INTERVAL_BUCKETS is off.
+BUCKETS = {'day': BUCKET_DAY, 'month': BUCKET_MONTH, 'year': BUCKET_YEAR}
+
+class WithRollup(ColumnElement):
+    """ GROUP BY column that also yields a grand total row, with NULL in column. """
+
+    inherit_cache = True
+    _traverse_internals = [('column', InternalTraversal.dp_clauseelement)]
+
+    def __init__(self, column):
+        self.column = column
+        self.type = column.type
+
+@compiles(WithRollup)
+def compile_with_rollup(element, compiler, **kw):
+    """ Render MySQL/MariaDB GROUP BY ... WITH ROLLUP. """
+
+    return '%s WITH ROLLUP' % compiler.process(element.column, **kw)
 
 class View(object):
     """ Parent View provides common methods. Never used directly. """
 
+    # GET parameters read by a subclass's own set_args, added to the response cache key
+    extra_args = []
+
     def __init__(self, args):
         self.success = True
         self.regex = re.compile("([0-9]+)([a-zA-Z]+)")
         self.valid_intervals = ['hour', 'day', 'month', 'year'] # also need to validate durations
+        self.valid_formats = ['rows', 'columnar']
+        self.valid_numbers = ['string', 'typed']
         if args:
             self.args = self.set_args(args)
         else:
@@ -27,21 +64,26 @@ class View(object):
         if var is not None:
             return var.date
 
-    def filter_query_by_date_range(self, table):
-        """ Return original query plus date range filters. """
+    def filter_query_by_date_range(self, table, query=None):
+        """ Return query plus date range filters. Without a query, filters and
+        stores the base query. """
+
+        stored = query is None
+        if stored:
+            query = self.base_query
 
         if self.args['start'] is not None and self.args['end'] is not None:
-            self.base_query = self.base_query.\
-                              filter(table.date.between(self.args['start'].date,
-                                                        self.args['end'].date))
+            query = query.filter(table.date.between(self.args['start'].date,
+                                                    self.args['end'].date))
         elif self.args['start'] is not None:
-            self.base_query = self.base_query.\
-                              filter(table.date >= self.args['start'].date)
+            query = query.filter(table.date >= self.args['start'].date)
         elif self.args['end'] is not None:
-            self.base_query = self.base_query.\
-                              filter(table.date < self.args['end'].date)
+            query = query.filter(table.date < self.args['end'].date)
 
-        return self.base_query
+        if stored:
+            self.base_query = query
+
+        return query
 
     def filter_query_by_date_range_sql(self):
         date_range = ""
@@ -60,51 +102,316 @@ class View(object):
 
         return date_range
 
-    def filter_query_remove_summer_months(self, table):
-        """ Return original query plus filters to remove summer months. """
+    def filter_query_remove_summer_months(self, table, query=None):
+        """ Return query plus filters to remove summer months. Without a query,
+        filters and stores the base query. """
+
+        stored = query is None
+        if stored:
+            query = self.base_query
+
+        query = query.filter(or_(func.month(table.date) < 5,
+                                 func.month(table.date) > 9))
 
-        self.base_query = self.base_query.\
-                          filter(or_(func.month(table.date) < 5,
-                                     func.month(table.date) > 9))
+        if stored:
+            self.base_query = query
 
-        return self.base_query
+        return query
 
-    def group_query_by_interval(self, table):
-        """ Return original query plus grouping for interval. """
+    def get_bucket(self, table, interval=None):
+        """ Return column grouping table rows by interval: the stored bucket column with
+        INTERVAL_BUCKETS, else the expression it stores. Rows of a table as coarse as
+        the interval, or coarser, are grouped by their own date. """
 
-        if 'year' in self.args['interval']:
-            self.base_query = self.base_query.\
-                              group_by(func.year(table.date))
-            self.base_query = self.base_query.order_by(func.year(table.date))
+        if interval is None:
+            interval = self.args['interval']
+
+        if self.valid_intervals.index(table.grain) >= self.valid_intervals.index(interval):
+            return table.date
+
+        if current_app.config['INTERVAL_BUCKETS']:
+            return getattr(table, 'bucket_' + interval)
+
+        return literal_column(get_bucket_sql(table.__tablename__, interval), Date)
+
+    def get_bucket_sql(self, table, alias, interval=None):
+        """ Return get_bucket as SQL text, for statements naming table alias. """
+
+        if interval is None:
+            interval = self.args['interval']
+
+        bucket = self.get_bucket(table, interval)
+        if bucket is table.date or current_app.config['INTERVAL_BUCKETS']:
+            return '%s.%s' % (alias, bucket.name)
+
+        return get_bucket_sql(alias, interval)
+
+    def group_query_by_interval(self, table, query=None):
+        """ Return query plus grouping for interval. Without a query, groups and
+        stores the base query. """
+
+        stored = query is None
+        if stored:
+            query = self.base_query
+
+        if current_app.config['INTERVAL_BUCKETS'] and \
+           self.args['interval'] in self.valid_intervals:
+            bucket = self.get_bucket(table)
+            query = query.group_by(bucket).order_by(bucket)
+
+        elif 'year' in self.args['interval']:
+            query = query.group_by(func.year(table.date))
+            query = query.order_by(func.year(table.date))
 
         elif 'month' in self.args['interval']:
-            self.base_query = self.base_query.\
-                              group_by(func.year(table.date),
-                                       func.month(table.date))
-            self.base_query = self.base_query.order_by(func.year(table.date),
-                                       func.month(table.date))
+            query = query.group_by(func.year(table.date),
+                                   func.month(table.date))
+            query = query.order_by(func.year(table.date),
+                                   func.month(table.date))
 
         elif 'day' in self.args['interval']:
-            self.base_query = self.base_query.\
-                              group_by(func.year(table.date),
-                                       func.month(table.date),
-                                       func.day(table.date))
-            self.base_query = self.base_query.order_by(func.year(table.date),
-                                       func.month(table.date),
-                                       func.day(table.date))
+            query = query.group_by(func.year(table.date),
+                                   func.month(table.date),
+                                   func.day(table.date))
+            query = query.order_by(func.year(table.date),
+                                   func.month(table.date),
+                                   func.day(table.date))
 
         elif 'hour' in self.args['interval']:
-            self.base_query = self.base_query.\
-                              group_by(func.year(table.date),
-                                       func.month(table.date),
-                                       func.day(table.date),
-                                       func.hour(table.date))
-            self.base_query = self.base_query.order_by(func.year(table.date),
-                                       func.month(table.date),
-                                       func.day(table.date),
-                                       func.hour(table.date))
-
-        return self.base_query
+            query = query.group_by(func.year(table.date),
+                                   func.month(table.date),
+                                   func.day(table.date),
+                                   func.hour(table.date))
+            query = query.order_by(func.year(table.date),
+                                   func.month(table.date),
+                                   func.day(table.date),
+                                   func.hour(table.date))
+
+        if stored:
+            self.base_query = query
+
+        return query
+
+    def get_extreme(self, house_id, metric, field):
+        """ Return dict of date and value of the metric's record in the date range. """
+
+        start = self.is_date(self.args['start'])
+        end = self.is_date(self.args['end'])
+
+        record = extremes.find(metric, house_id, start, end,
+                               start is not None and end is not None)
+        date, value = record if record is not None else (None, None)
+
+        return {'date': str(date), field: self.format_number(value)}
+
+    def get_store(self, house_id, intervals=None):
+        """ Return column store of house X when it holds data up to the current watermark
+        and can answer the interval (any if not given), or None to query the database. """
+
+        if self.args['stream'] or \
+           (intervals is not None and self.args['interval'] not in intervals):
+            return None
+
+        return column_store.get(house_id, watermarks.get(house_id))
+
+    def get_store_range(self):
+        """ Return (start, end, end_inclusive) as filter_query_by_date_range applies them. """
+
+        start = self.is_date(self.args['start'])
+        end = self.is_date(self.args['end'])
+
+        return start, end, start is not None and end is not None
+
+    def use_rollup(self):
+        """ Return True if totals can be the WITH ROLLUP row of the grouped query.
+        Needs a single grouping column, so rows are grouped by bucket. Streamed items
+        are written after totals, so they keep a separate totals query. """
+
+        return current_app.config['ROLLUP_TOTALS'] and \
+            self.args['interval'] in self.valid_intervals and \
+            not self.args['stream']
+
+    def query_totals_and_items(self, table, query=None):
+        """ Return totals row and rows grouped by interval for query (default base query).
+        With rollup, both come from one statement and items are a list. """
+
+        if query is None:
+            query = self.base_query
+
+        if not self.use_rollup():
+            return query.one(), self.group_query_by_interval(table, query)
+
+        # MariaDB sorts by the GROUP BY column and does not allow ORDER BY with ROLLUP
+        bucket = self.get_bucket(table)
+        rows = query.add_columns(label('rollup_bucket', bucket)).\
+            group_by(WithRollup(bucket)).all()
+
+        totals, items = self.split_rollup(rows)
+        if totals is None:
+            # no rows in range, so no rollup row either
+            totals = query.one()
+
+        return totals, items
+
+    @classmethod
+    def split_rollup(cls, rows):
+        """ Return rollup row and grouped rows. The rollup row is last, with no rollup_bucket. """
+
+        if rows and rows[-1].rollup_bucket is None:
+            return rows[-1], rows[:-1]
+
+        return None, rows
+
+    def plan_table(self, tables, interval=None):
+        """ Return the coarsest table that can answer the interval and date range.
+
+        Tables are listed finest grain first. The first table is always valid.
+        """
+
+        if interval is None:
+            interval = self.args['interval']
+
+        if interval not in self.valid_intervals:
+            return tables[0]
+
+        plan = tables[0]
+        for table in tables[1:]:
+            if self.valid_intervals.index(table.grain) > \
+               self.valid_intervals.index(interval):
+                break
+            if self.is_range_aligned(table.grain):
+                plan = table
+
+        return plan
+
+    def is_range_aligned(self, grain):
+        """ Return True if the date range covers whole buckets of grain. """
+
+        hour = datetime.timedelta(hours=1)
+
+        if self.args['start'] is not None:
+            if not self.is_bucket_start(self.args['start'].date, grain):
+                return False
+
+        if self.args['end'] is not None:
+            end = self.args['end'].date
+            if self.args['start'] is not None:
+                # BETWEEN includes the last hour before the end
+                end = (end + hour).replace(minute=0, second=0, microsecond=0)
+            elif end.minute or end.second or end.microsecond:
+                end = end.replace(minute=0, second=0, microsecond=0) + hour
+            if not self.is_bucket_start(end, grain):
+                return False
+
+        return True
+
+    @classmethod
+    def is_bucket_start(cls, date, grain):
+        """ Return True if date is the first instant of a grain bucket. """
+
+        if date.minute or date.second or date.microsecond:
+            return False
+        if grain == 'hour':
+            return True
+        if date.hour:
+            return False
+        if grain == 'day':
+            return True
+        if date.day != 1:
+            return False
+        if grain == 'month':
+            return True
+        return date.month == 1
+
+    @classmethod
+    def sum_kwh(cls, table, circuit):
+        """ Return sum of circuit in kWh, whatever unit table stores. """
+
+        total = func.sum(getattr(table, circuit))
+        if table.divisor != 1:
+            total = total / table.divisor
+
+        return total
+
+    def get_json_items(self, items, fields, date_format=str):
+        """ Return items as a list of dicts, or as one array per field if format is columnar.
+
+        Fields are column names, or (key, column) pairs where they differ.
+        The date field is formatted with date_format, everything else with format_number.
+        """
+
+        fields = [(field, field) if isinstance(field, str) else field for field in fields]
+
+        if self.args['format'] == 'columnar':
+            rows = list(items)
+            if not rows:
+                return {key: [] for key, column in fields}
+            columns = dict(zip(rows[0]._fields, zip(*rows)))
+            return {key: (list(map(date_format, columns[column])) if key == 'date'
+                          else self.format_numbers(columns[column]))
+                    for key, column in fields}
+
+        if self.args['stream']:
+            return self.stream_json_items(items, fields, date_format)
+
+        json_items = []
+        for item in items:
+            json_items.append({key: (date_format if key == 'date' else self.format_number)
+                                    (getattr(item, column))
+                               for key, column in fields})
+
+        return json_items
+
+    def run_queries(self, *calls):
+        """ Call independent query methods concurrently and wait for all of them.
+        Streamed items are read later by the request thread, so they run there. """
+
+        if self.args['stream']:
+            return [call() for call in calls]
+
+        return query_executor.run(*calls)
+
+    def stream_json_items(self, items, fields, date_format):
+        """ Yield item dicts while reading rows from a server-side cursor. """
+
+        if hasattr(items, 'yield_per'):
+            items = items.yield_per(current_app.config['STREAM_BATCH_ROWS'])
+
+        for item in items:
+            yield {key: (date_format if key == 'date' else self.format_number)
+                        (getattr(item, column))
+                   for key, column in fields}
+
+    def format_number(self, value):
+        """ Return value as string, or as a JSON number or null when numbers are typed. """
+
+        if self.args['numbers'] == 'typed':
+            return None if value is None else float(value)
+
+        return str(value)
+
+    def format_numbers(self, values):
+        """ Return list of values formatted as format_number would, converted in one pass. """
+
+        if self.args['numbers'] != 'typed':
+            return list(map(str, values))
+
+        if None not in values:
+            return list(map(float, values))
+
+        return [None if value is None else float(value) for value in values]
+
+    def jsonify(self, *args, **kwargs):
+        """ Return json response. Typed numbers go through the fast encoder.
+        Streamed items are written as they are read. """
+
+        if self.args['stream']:
+            return encoding.stream_jsonify(**kwargs)
+
+        if self.args['numbers'] == 'typed':
+            return encoding.jsonify(*args, **kwargs)
+
+        return jsonify(*args, **kwargs)
 
     def format_date(self, date):
         """ Return formatted date string based on interval. """
@@ -143,12 +450,38 @@ class View(object):
 
         location = args.get('location', '0')
 
+        output_format = args.get('format', 'rows')
+        if output_format not in self.valid_formats:
+            output_format = 'rows'
+
+        numbers = args.get('numbers', 'string')
+        if numbers not in self.valid_numbers:
+            numbers = 'string'
+
+        # columnar output needs every row before it can be written
+        stream = args.get('stream') in ('1', 'true') and output_format == 'rows'
+
         return {'interval': interval,
                 'start': start,
                 'end': end,
                 'circuit': circuit,
                 'base': base,
-                'location': location}
+                'location': location,
+                'format': output_format,
+                'numbers': numbers,
+                'stream': stream}
+
+    def get_cache_key(self):
+        """ Return normalized args as a hashable tuple. """
+
+        key = []
+        for name in sorted(self.args):
+            value = self.args[name]
+            if isinstance(value, moment.Moment):
+                value = value.date.isoformat()
+            key.append((name, value))
+
+        return tuple(key)
 
     @classmethod
     def validate_interval(cls, interval, valid_options):
@@ -188,3 +521,8 @@ class View(object):
             return start.clone().add(months=int(duration)).add(minutes=-1)
         elif 'year' in interval:
             return start.clone().add(years=int(duration)).add(minutes=-1)
+
+def get_bucket_sql(name, interval):
+    """ Return SQL expression of interval bucket of the date column of table name. """
+
+    return re.sub(r'\bdate\b', name + '.date', BUCKETS[interval])
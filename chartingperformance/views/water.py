@@ -3,104 +3,146 @@
 from chartingperformance import db_session
 from chartingperformance.views.view import View
 
-from flask import jsonify
+from chartingperformance.models import EnergyDaily
+from chartingperformance.models import EnergyMonthly
+from chartingperformance.models import WaterDaily
+from chartingperformance.models import WaterMonthly
+
+from flask import current_app, jsonify
 
 from sqlalchemy.sql import text, column
 
+# Water meters: main (device 6) and hot (device 7). Cold is main less hot.
+MAIN_DEVICE = 6
+HOT_DEVICE = 7
+
+FIELDS = ['date', 'cold', 'hot', 'main', 'water_heater', 'water_pump']
+
 class Water(View):
-    """ Water view query and response methods. """
+    """ Water view query and response methods. Each request reads the water table
+    once, pivoting main and hot gallons by device, joined to energy on date. """
 
     def __init__(self, args, house_id):
 
         super(Water, self).__init__(args)
 
-        if ('day' in self.args['interval']) or ('hour' in self.args['interval']):
+        if 'hour' in self.args['interval']:
             self.success = False
             self.error = {'error':'Interval not available.'}
         if self.success:
-            self.get_totals(house_id)
-            self.get_items(house_id)
+            if 'day' in self.args['interval']:
+                self.energy, self.water = EnergyDaily, WaterDaily
+            else:
+                self.energy, self.water = EnergyMonthly, WaterMonthly
 
-    def get_totals(self, house_id):
-        """ Get and store totals from database. """
+            if self.use_rollup():
+                self.get_totals_and_items(house_id)
+            else:
+                self.get_items(house_id)
+                self.get_totals()
 
-        totals = db_session.query(column("cold"), column("hot"), column("main"),
-                                  column("water_heater"), column("water_pump"))
+    def get_sql(self, group, rollup_bucket=None):
+        """ Return statement summing energy and pivoted water rows by group,
+        selecting rollup_bucket too if given. """
 
         date_range = self.filter_query_by_date_range_sql()
 
-        sql = """SELECT SUM(main.gallons) - SUM(hot.gallons) AS 'cold',
-                    SUM(hot.gallons) AS 'hot', SUM(main.gallons) AS 'main',
+        bucket = ""
+        if rollup_bucket is not None:
+            bucket = ", %s AS 'rollup_bucket'" % rollup_bucket
+
+        return """SELECT MIN(e.date) AS 'date', SUM(w.main) - SUM(w.hot) AS 'cold',
+                    SUM(w.hot) AS 'hot', SUM(w.main) AS 'main',
                     SUM(e.water_heater) AS 'water_heater',
-                    SUM(e.water_pump) AS 'water_pump'
-                 FROM energy_monthly e
-                 LEFT JOIN (SELECT house_id, date, gallons FROM water_monthly
-                    WHERE device_id = 6) main ON e.date = main.date
-                     AND main.house_id = e.house_id
-                 LEFT JOIN (SELECT house_id, date, gallons FROM water_monthly
-                    WHERE device_id = 7) hot ON e.date = hot.date
-                      AND hot.house_id = e.house_id
+                    SUM(e.water_pump) AS 'water_pump'%s
+                 FROM %s e
+                 LEFT JOIN (SELECT date,
+                        SUM(CASE WHEN device_id = %d THEN gallons END) AS main,
+                        SUM(CASE WHEN device_id = %d THEN gallons END) AS hot
+                    FROM %s
+                    WHERE house_id = :house_id
+                    %s
+                    GROUP BY date) w ON w.date = e.date
                  WHERE e.house_id = :house_id
                  %s
-             """ % date_range
+                 %s
+             """ % (bucket, self.energy.__tablename__, MAIN_DEVICE, HOT_DEVICE,
+                    self.water.__tablename__, date_range.replace('e.date', 'date'),
+                    date_range, group)
+
+    def query(self, house_id, sql, fields):
+        """ Return rows of statement with the date range and house bound. """
+
+        rows = db_session.query(*[column(field) for field in fields])
+        rows = rows.from_statement(text(sql))
+
+        return rows.params(house_id=house_id,
+                           start=self.is_date(self.args['start']),
+                           end=self.is_date(self.args['end'])).all()
+
+    def get_totals_and_items(self, house_id):
+        """ Get and store totals and rows from database in one rollup query. """
+
+        bucket = self.get_bucket_sql(self.energy, 'e')
+
+        # MariaDB sorts by the GROUP BY column and does not allow ORDER BY with ROLLUP
+        sql = self.get_sql("GROUP BY %s WITH ROLLUP" % bucket, bucket)
 
-        totals = totals.from_statement(text(sql))
-        totals = totals.params(house_id=house_id,
-                               start=self.is_date(self.args['start']),
-                               end=self.is_date(self.args['end'])).one()
+        rows = self.query(house_id, sql, FIELDS + ['rollup_bucket'])
 
-        self.json_totals = {'cold': str(totals.cold),
-                            'hot': str(totals.hot),
-                            'main': str(totals.main),
-                            'water_heater':  str(totals.water_heater),
-                            'water_pump': str(totals.water_pump)}
+        totals, items = self.split_rollup(rows)
+
+        self.json_items = self.get_json_items(items, FIELDS)
+
+        if totals is None:
+            self.get_totals(items)
+        else:
+            self.json_totals = self.format_totals(totals.cold, totals.hot, totals.main,
+                                                  totals.water_heater, totals.water_pump)
 
     def get_items(self, house_id):
         """ Get and store rows from database. """
 
-        items = db_session.query(column("date"), column("cold"), column("hot"), column("main"),
-                                 column("water_heater"), column("water_pump"))
+        if current_app.config['INTERVAL_BUCKETS'] and \
+           self.args['interval'] in self.valid_intervals:
+            grp = self.get_bucket_sql(self.energy, 'e')
+        elif 'month' in self.args['interval']:
+            grp = "YEAR(e.date), MONTH(e.date)"
+        elif 'day' in self.args['interval']:
+            grp = "e.date"
+        else:
+            grp = "YEAR(e.date)"
 
-        date_range = self.filter_query_by_date_range_sql()
+        self.items = self.query(house_id, self.get_sql("GROUP BY %s ORDER BY %s" % (grp, grp)),
+                                FIELDS)
 
-        sel = "MIN(e.date)"
-        grp = "YEAR(e.date)"
+        self.json_items = self.get_json_items(self.items, FIELDS)
 
-        if 'month' in self.args['interval']:
-            grp = "MONTH(e.date) "
+    def get_totals(self, items=None):
+        """ Store totals summed from rows, stored rows by default. Sums skip
+        missing values and are None when every value is missing, as in SQL. """
 
-        sql = """SELECT %s AS 'date', SUM(main.gallons) -
-                    SUM(hot.gallons) AS 'cold', SUM(hot.gallons) AS 'hot',
-                    SUM(main.gallons) AS 'main',
-                    SUM(e.water_heater) AS 'water_heater',
-                    SUM(e.water_pump) AS 'water_pump'
-                 FROM energy_monthly e
-                 LEFT JOIN (SELECT house_id, date, gallons FROM water_monthly
-                    WHERE device_id = 6) main ON e.date = main.date
-                        AND main.house_id = e.house_id
-                 LEFT JOIN (SELECT house_id, date, gallons FROM water_monthly
-                    WHERE device_id = 7) hot ON e.date = hot.date
-                        AND hot.house_id = e.house_id
-                 WHERE e.house_id = :house_id
-                 %s
-                 GROUP BY %s
-                 ORDER BY %s
-             """ % (sel, date_range, grp, grp)
-
-        items = items.from_statement(text(sql))
-        items = items.params(house_id=house_id,
-                               start=self.is_date(self.args['start']),
-                               end=self.is_date(self.args['end'])).all()
-
-        self.json_items = []
-        for item in items:
-            data = {'date': str(item.date),
-                    'cold': str(item.cold),
-                    'hot': str(item.hot),
-                    'main': str(item.main),
-                    'water_heater':  str(item.water_heater),
-                    'water_pump': str(item.water_pump)}
-            self.json_items.append(data)
+        if items is None:
+            items = self.items
+
+        def total(field):
+            values = [getattr(item, field) for item in items if getattr(item, field) is not None]
+            return sum(values) if values else None
+
+        main, hot = total('main'), total('hot')
+        cold = main - hot if main is not None and hot is not None else None
+
+        self.json_totals = self.format_totals(cold, hot, main,
+                                              total('water_heater'), total('water_pump'))
+
+    def format_totals(self, cold, hot, main, water_heater, water_pump):
+        """ Return totals formatted for the response. """
+
+        return {'cold': self.format_number(cold),
+                'hot': self.format_number(hot),
+                'main': self.format_number(main),
+                'water_heater':  self.format_number(water_heater),
+                'water_pump': self.format_number(water_pump)}
 
     def get_response(self):
         """ Return response in json format. """
@@ -108,7 +150,7 @@ class Water(View):
         if not self.success:
             return jsonify(self.error)
 
-        return jsonify(view='water',
-                       interval=self.args['interval'],
-                       totals=self.json_totals,
-                       items=self.json_items)
+        return self.jsonify(view='water',
+                            interval=self.args['interval'],
+                            totals=self.json_totals,
+                            items=self.json_items)
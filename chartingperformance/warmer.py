@@ -0,0 +1,202 @@
+""" Response cache warming after data loads """
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from chartingperformance import db_session
+from chartingperformance.watermark import watermarks
+from chartingperformance.metadata import metadata
+from chartingperformance.serving import serve_view
+
+from chartingperformance.views.circuit import CircuitDict
+from chartingperformance.views.summary import Summary
+from chartingperformance.views.generation import Generation
+from chartingperformance.views.usage import Usage
+from chartingperformance.views.hdd import Hdd
+from chartingperformance.views.water import Water
+from chartingperformance.views.heatmap import Heatmap
+
+from flask import current_app
+
+from sqlalchemy.exc import SQLAlchemyError
+
+VIEWS = {'summary': Summary,
+         'generation': Generation,
+         'usage': Usage,
+         'hdd': Hdd,
+         'water': Water,
+         'heatmap': Heatmap}
+
+# Views warmed by year and month for every year, and across all years.
+YEAR_VIEWS = ['summary', 'generation', 'hdd', 'water']
+
+class CacheWarmer(object):
+    """ Recomputes the standard dashboard views of a house after its watermark
+    advances, so the response caches are hot before users ask. A poller checks
+    every house's watermark each interval; warming runs on a small pool of low
+    priority threads, one request at a time with a pause in between. Data derived
+    from the hourly tables is brought up to the watermark first, by refreshers. """
+
+    def __init__(self):
+        self.app = None
+        self.workers = 0
+        self.interval = 60
+        self.pause = 0
+        self.nice = 0
+        self.pool = None
+        self.pending = {}
+        self.refreshers = []
+        self.warmed = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        """ Read settings from app config. Threads are started by start. """
+
+        self.app = app
+        self.workers = app.config['WARMER_WORKERS']
+        self.interval = app.config['WARMER_INTERVAL']
+        self.pause = app.config['WARMER_PAUSE']
+        self.nice = app.config['WARMER_NICE']
+
+    def subscribe(self, refresher):
+        """ Call refresher(house_id, watermark) at the start of every pass, before views
+        are warmed. """
+
+        self.refreshers.append(refresher)
+
+    def start(self):
+        """ Start the poller and warming threads of this process, if WARMER_WORKERS is set.
+        Called once per serving process, after any fork. """
+
+        if not self.workers:
+            return
+
+        self.pending = {}
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='warmer',
+                                       initializer=self.lower_priority)
+
+        poller = threading.Thread(target=self.poll, name='warmer-poll', daemon=True)
+        poller.start()
+
+    def lower_priority(self):
+        """ Raise this thread's nice value, where the platform allows it. """
+
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.nice)
+        except (AttributeError, OSError):
+            pass
+
+    def poll(self):
+        """ Read every house's watermark each interval. Changes reach on_watermark
+        through the watermark listeners. """
+
+        while True:
+            time.sleep(self.interval)
+            with self.app.app_context():
+                try:
+                    for house in metadata.get_houses():
+                        watermarks.get(house.house_id)
+                except SQLAlchemyError:
+                    current_app.logger.warning('Watermarks not polled', exc_info=True)
+
+    def on_watermark(self, house_id, watermark):
+        """ Queue warming of house X at watermark. A pass already queued or running
+        for the house picks up the new watermark instead. Used as a watermark listener. """
+
+        house_id = str(house_id)
+
+        with self.lock:
+            if self.pool is None:
+                return
+            queued = house_id in self.pending
+            self.pending[house_id] = watermark
+        if not queued:
+            self.pool.submit(self.warm, house_id)
+
+    def get_requests(self, house_id):
+        """ Return list of (view name, args) the dashboard asks for house X,
+        newest year first. """
+
+        circuits = ['summary'] + list(CircuitDict(house_id).circuits)
+
+        requests = [(name, {'interval': 'years'}) for name in YEAR_VIEWS]
+        requests.append(('usage', {'interval': 'years', 'circuit': 'summary'}))
+
+        for year in reversed(metadata.get(house_id).years):
+            span = {'start': '%s-01-01' % year, 'duration': '1year'}
+            for interval in ['years', 'months']:
+                for name in YEAR_VIEWS:
+                    requests.append((name, dict(span, interval=interval)))
+                for circuit in circuits:
+                    requests.append(('usage', dict(span, interval=interval, circuit=circuit)))
+            requests.append(('heatmap', span))
+
+        return requests
+
+    def warm(self, house_id):
+        """ Compute every dashboard view of house X into the response caches, starting
+        over whenever the watermark moves on, until a pass finishes at the latest one. """
+
+        while True:
+            with self.lock:
+                watermark = self.pending[house_id]
+
+            try:
+                with self.app.app_context():
+                    for refresher in self.refreshers:
+                        self.refresh(refresher, house_id, watermark)
+                    for name, args in self.get_requests(house_id):
+                        with self.lock:
+                            if self.pending[house_id] != watermark:
+                                break
+                        self.request(name, house_id, args)
+                        time.sleep(self.pause)
+            except SQLAlchemyError:
+                self.app.logger.warning('House %s not warmed', house_id, exc_info=True)
+
+            with self.lock:
+                if self.pending[house_id] == watermark:
+                    del self.pending[house_id]
+                    return
+
+    def refresh(self, refresher, house_id, watermark):
+        """ Call one refresher, logging a failure. Views are warmed either way, from
+        whatever the refresher left behind. """
+
+        try:
+            refresher(house_id, watermark)
+        except Exception: # pylint: disable=broad-except
+            current_app.logger.warning('%s of house %s not refreshed', refresher.__module__,
+                                       house_id, exc_info=True)
+            db_session.rollback()
+
+    def request(self, name, house_id, args):
+        """ Serve one view through the response caches, as a request would, but
+        computing it here rather than serving a stale copy. """
+
+        path = '/api/houses/%s/views/%s/' % (house_id, name)
+
+        with self.app.test_request_context(path, query_string=args):
+            try:
+                serve_view(name, VIEWS[name], house_id, stale=False)
+                with self.lock:
+                    self.warmed += 1
+            except Exception: # pylint: disable=broad-except
+                current_app.logger.warning('View %s of house %s not warmed with %s',
+                                           name, house_id, args, exc_info=True)
+                db_session.rollback()
+                with self.lock:
+                    self.failed += 1
+
+    def stats(self):
+        """ Return counters as dict. """
+
+        with self.lock:
+            return {'pending': len(self.pending),
+                    'warmed': self.warmed,
+                    'failed': self.failed}
+
+cache_warmer = CacheWarmer()
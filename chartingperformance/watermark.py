@@ -0,0 +1,73 @@
+""" Data watermark tracking """
+# pylint: disable=no-member
+import threading
+import time
+
+from chartingperformance import db_session
+from chartingperformance.models import LimitsHourly
+
+from flask import current_app
+
+from sqlalchemy.exc import SQLAlchemyError
+
+class Watermarks(object):
+    """ Latest data date per house, read from limits_hourly at most once per TTL.
+    Listeners are called with (house_id, watermark) when a house's watermark advances. """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.values = {}
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        """ Read settings from app config. """
+
+        self.ttl = app.config['WATERMARK_TTL']
+
+    def subscribe(self, listener):
+        """ Call listener(house_id, watermark) whenever a watermark changes. """
+
+        self.listeners.append(listener)
+
+    def get(self, house_id):
+        """ Return latest data date for house X. If the database cannot be read, the
+        last known date is returned and the read retried after another TTL. """
+
+        house_id = str(house_id)
+        now = time.monotonic()
+
+        with self.lock:
+            cached = self.values.get(house_id)
+        if cached is not None and now - cached[1] < self.ttl:
+            return cached[0]
+
+        try:
+            return self.refresh(house_id)
+        except SQLAlchemyError:
+            if cached is None:
+                raise
+            db_session.rollback()
+            current_app.logger.warning('Watermark of house %s not read', house_id, exc_info=True)
+            with self.lock:
+                self.values[house_id] = (cached[0], now)
+            return cached[0]
+
+    def refresh(self, house_id):
+        """ Reload watermark for house X from database and notify listeners of any change. """
+
+        house_id = str(house_id)
+        watermark = db_session.query(LimitsHourly.end_date).\
+            filter(LimitsHourly.house_id == house_id).scalar()
+
+        with self.lock:
+            previous = self.values.get(house_id)
+            self.values[house_id] = (watermark, time.monotonic())
+
+        if previous is not None and previous[0] != watermark:
+            for listener in self.listeners:
+                listener(house_id, watermark)
+
+        return watermark
+
+watermarks = Watermarks()
@@ -0,0 +1,4 @@
+""" WSGI entry point for production servers, e.g. `gunicorn chartingperformance.wsgi:app` """
+from chartingperformance import create_app
+
+app = create_app()
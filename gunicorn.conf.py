@@ -0,0 +1,33 @@
+""" Gunicorn settings, read from the app's settings. Run with `gunicorn chartingperformance.wsgi:app`
+from this directory. """
+import multiprocessing
+import os
+
+from flask import Config
+
+import chartingperformance
+
+config = Config(os.path.dirname(os.path.abspath(__file__)))
+config.from_object('chartingperformance.default_settings')
+config.from_envvar('HOMEPERFORMANCE_SETTINGS')
+
+bind = '%s:%s' % (config['HOST'], config['PORT'])
+workers = config['WORKERS'] or multiprocessing.cpu_count() * 2 + 1
+threads = config['WORKER_THREADS']
+worker_class = 'gthread'
+timeout = config['WORKER_TIMEOUT']
+
+# Import the app once in the master, loading metadata, circuits and column store
+# maps before forking, so workers start with them.
+preload_app = True
+
+def pre_fork(server, worker): # pylint: disable=unused-argument
+    """ Close the master's connections, so no worker inherits a socket. """
+
+    chartingperformance.dispose_engine()
+
+def post_fork(server, worker): # pylint: disable=unused-argument
+    """ Create the worker's own engine and query threads. """
+
+    from chartingperformance.wsgi import app
+    chartingperformance.init_worker(app)
@@ -1,5 +1,7 @@
-""" Start home performance app with env settings """
-from chartingperformance import app
+""" Start home performance development server with env settings """
+from chartingperformance import create_app
+from chartingperformance.warmer import cache_warmer
 
-app.config.from_envvar('HOMEPERFORMANCE_SETTINGS')
-app.run(host=app.config['HOST'], debug=app.config['DEBUG'])
+app = create_app()
+cache_warmer.start()
+app.run(host=app.config['HOST'], port=app.config['PORT'], debug=app.config['DEBUG'])
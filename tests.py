@@ -1,13 +1,64 @@
 import chartingperformance
 import unittest
 import json
+import datetime
+import fcntl
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import pyarrow.parquet
+
+from chartingperformance.views.view import View
+from chartingperformance import db_session
+from chartingperformance import rollup
+from chartingperformance.views.usage import Usage
+from chartingperformance.models import EnergyHourly, CircuitDaily, CircuitMonthly, RollupLimits
+from chartingperformance.models import Extremes, TemperatureHourly
+from chartingperformance.cache import ResponseCache, SharedCache, response_cache, shared_cache
+from chartingperformance.executor import QueryExecutor, query_executor
+from chartingperformance import extremes
+from chartingperformance.store import column_store, column_path, list_series
+from chartingperformance.registry import circuit_registry
+from chartingperformance.metadata import metadata
+from chartingperformance.pool import pool_monitor
+from chartingperformance.singleflight import SingleFlight
+from chartingperformance.warmer import cache_warmer
+from chartingperformance.revalidator import revalidator
+from chartingperformance.serving import serve_view
+from chartingperformance.watermark import watermarks
+from sqlalchemy import event, exc, func
+from sqlalchemy.sql import label
+
+app = chartingperformance.create_app()
+
+def round_numbers(value):
+    """ Return value with floats rounded, in dicts and lists too. """
+
+    if isinstance(value, dict):
+        return dict((key, round_numbers(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [round_numbers(item) for item in value]
+    if isinstance(value, float):
+        return round(value, 6)
+    return value
+
+def setUpModule():
+    """ Migrate the test database once: bucket columns and indexes, rollup tables
+    and water_daily. Created only if missing, so reruns leave it as is. """
+
+    result = app.test_cli_runner().invoke(args=['add-buckets'])
+    assert result.exit_code == 0, result.output
 
 class ChartingPerformanceTestCase(unittest.TestCase):
 
     def setUp(self):
         #self.db_fd, flaskr.app.config['DATABASE'] = tempfile.mkstemp()
-        chartingperformance.app.config['TESTING'] = True
-        self.app = chartingperformance.app.test_client()
+        app.config['TESTING'] = True
+        self.app = app.test_client()
         #flaskr.init_db()
 
     def tearDown(self):
@@ -37,6 +88,67 @@ class ChartingPerformanceTestCase(unittest.TestCase):
         assert json_rv['circuits'][0]['circuit_id'] == 'adjusted_load'
         assert json_rv['circuits'][0]['name'] == 'Net'
 
+    def test_circuit_registry(self):
+        with app.app_context():
+            circuits = circuit_registry.get(0)
+            assert circuit_registry.get('0') is circuits
+            assert circuits['adjusted_load'].name == 'Net'
+            circuit_registry.invalidate(0)
+            assert circuit_registry.get(0) is not circuits
+            assert list(circuit_registry.get(0)) == list(circuits)
+
+    def test_metadata_endpoints_without_sql(self):
+        with app.app_context():
+            metadata.load()
+            watermarks.get(0)
+        statements = []
+        def count(*args):
+            statements.append(args)
+        event.listen(chartingperformance.engine, 'before_cursor_execute', count)
+        try:
+            for url in ['/api/houses/', '/api/houses/0/', '/api/houses/0/devices/',
+                        '/api/houses/0/views/default/', '/api/houses/0/views/default/?interval=days']:
+                assert self.app.get(url).status_code == 200, url
+        finally:
+            event.remove(chartingperformance.engine, 'before_cursor_execute', count)
+        assert statements == []
+
+    def test_internal_stats_pool(self):
+        engine = chartingperformance.engine
+        with engine.connect() as connection:
+            connection.exec_driver_sql('SELECT 1')
+        pings = pool_monitor.stats.pings
+        with engine.connect() as connection:
+            connection.exec_driver_sql('SELECT 1')
+        assert pool_monitor.stats.pings == pings
+        connection = engine.connect()
+        connection.invalidate()
+        connection.close()
+        with engine.connect() as connection:
+            connection.exec_driver_sql('SELECT 1')
+        rv = self.app.get('/internal/stats/')
+        json_rv = json.loads(rv.data.decode('utf-8'))
+        assert json_rv['pool']['invalidations'] >= 1
+        assert json_rv['pool']['pings'] > pings
+        assert json_rv['pool']['checkouts'] > 0
+        assert json_rv['pool']['size'] == app.config['POOL_SIZE']
+
+    def test_init_worker(self):
+        engine, pool = chartingperformance.engine, query_executor.pool
+        with app.app_context():
+            houses = metadata.get_houses()
+        chartingperformance.dispose_engine()
+        assert engine.pool.checkedin() == 0
+        chartingperformance.init_worker(app)
+        assert chartingperformance.engine is not engine
+        assert chartingperformance.db_session.get_bind() is chartingperformance.engine
+        assert pool_monitor.engine is chartingperformance.engine
+        assert query_executor.pool is not pool or pool is None
+        with app.app_context():
+            assert metadata.get_houses() == houses
+        rv = self.app.get('/api/houses/0/views/summary/?interval=months')
+        assert rv.status_code == 200
+
     def test_defaults_months(self):
         rv = self.app.get('/api/houses/0/views/default/') # ensure default value is working
         json_rv = json.loads(rv.data.decode('utf-8'))
@@ -130,6 +242,16 @@ class ChartingPerformanceTestCase(unittest.TestCase):
         assert float(json_rv['coldest_hour']['temperature']) == -7.089
         assert float(json_rv['coldest_day']['temperature']) == 60.770
 
+    def test_views_hdd_days(self):
+        months = json.loads(self.app.get('/api/houses/0/views/hdd/?interval=months&start=2013-01-01&duration=4months').data.decode('utf-8'))
+        rv = self.app.get('/api/houses/0/views/hdd/?interval=days&start=2013-01-01&duration=4months')
+        assert rv.status_code == 200
+        json_rv = json.loads(rv.data.decode('utf-8'))
+        assert json_rv['interval'] == 'day'
+        # hdd is only stored by month
+        assert json_rv['items'] == months['items']
+        assert json_rv['totals'] == months['totals']
+
     def test_views_temperature_years(self):
         rv = self.app.get('/api/houses/0/views/temperature/?interval=years&location=0')
         json_rv = json.loads(rv.data.decode('utf-8'))
@@ -151,6 +273,50 @@ class ChartingPerformanceTestCase(unittest.TestCase):
         assert float(json_rv['totals']['water_heater']) == 2078.042
         assert float(json_rv['totals']['water_pump']) == 63.780
 
+    def test_views_water_days(self):
+        url = '/api/houses/0/views/water/?interval=days&start=2013-01-01&duration=1month'
+        with app.app_context():
+            day = func.date(EnergyHourly.date)
+            hourly = dict((str(row.day), row) for row in
+                          db_session.query(label('day', day),
+                                           label('water_heater', func.sum(EnergyHourly.water_heater)),
+                                           label('water_pump', func.sum(EnergyHourly.water_pump))).
+                          filter(EnergyHourly.house_id == 0).
+                          filter(EnergyHourly.date.between(datetime.datetime(2013, 1, 1),
+                                                           datetime.datetime(2013, 1, 31, 23, 59))).
+                          group_by(day))
+        buckets = app.config['INTERVAL_BUCKETS']
+        try:
+            for enabled in [False, True]:
+                app.config['INTERVAL_BUCKETS'] = enabled
+                response_cache.clear()
+                json_rv = json.loads(self.app.get(url).data.decode('utf-8'))
+                assert json_rv['interval'] == 'day'
+                assert len(json_rv['items']) == 31
+                for item in json_rv['items']:
+                    source = hourly[item['date']]
+                    assert abs(float(item['water_heater']) - float(source.water_heater) / 1000) < 0.001, item
+                    assert abs(float(item['water_pump']) - float(source.water_pump) / 1000) < 0.001, item
+                    if item['main'] != 'None' and item['hot'] != 'None':
+                        assert float(item['cold']) == float(item['main']) - float(item['hot'])
+        finally:
+            app.config['INTERVAL_BUCKETS'] = buckets
+            response_cache.clear()
+
+    def test_views_water_no_interval(self):
+        buckets = app.config['INTERVAL_BUCKETS']
+        try:
+            for enabled in [False, True]:
+                app.config['INTERVAL_BUCKETS'] = enabled
+                response_cache.clear()
+                rv = self.app.get('/api/houses/0/views/water/?start=2013-01-01&duration=12months')
+                assert rv.status_code == 200
+                json_rv = json.loads(rv.data.decode('utf-8'))
+                assert len(json_rv['items']) == 1
+                assert float(json_rv['totals']['main']) == 24122.3
+        finally:
+            app.config['INTERVAL_BUCKETS'] = buckets
+            response_cache.clear()
 
     def test_views_usage_months_summary(self):
         rv = self.app.get('/api/houses/0/views/usage/?interval=months&start=2013-01-01&duration=12months')
@@ -353,6 +519,67 @@ class ChartingPerformanceTestCase(unittest.TestCase):
         assert float(json_rv['points'][0]['temperature']) == 23.3554699
         assert float(json_rv['points'][0]['solar']) == -10.008
 
+    def test_views_basetemp_bases_sweep(self):
+        url = '/api/houses/0/views/basetemp/?interval=months&start=2013-01-01&duration=12months'
+        rv = self.app.get(url + '&bases=60..70')
+        json_rv = json.loads(rv.data.decode('utf-8'))
+        assert len(json_rv['series']) == 11
+        assert json_rv['series'][5]['base'] == '65'
+        single = json.loads(self.app.get(url + '&base=65').data.decode('utf-8'))
+        points = json_rv['series'][5]['points']
+        assert len(points) == len(single['points'])
+        for point, expected in zip(points, single['points']):
+            assert point['date'] == expected['date']
+            for field in ['ashp', 'temperature', 'solar']:
+                assert point[field] == expected[field]
+            assert round(float(point['hdd']), 6) == round(float(expected['hdd']), 6)
+
+    def test_views_basetemp_bases_not_valid(self):
+        url = '/api/houses/0/views/basetemp/?interval=months&start=2013-01-01&duration=12months'
+        for bases in ['70..60', '0..1000000000000', 'a..b']:
+            json_rv = json.loads(self.app.get(url + '&bases=' + bases).data.decode('utf-8'))
+            assert 'error' in json_rv
+
+    def test_views_chart_hours_follow_first_floor(self):
+        date = datetime.datetime(2013, 1, 1, 0, 30)
+        url = '/api/houses/0/views/chart/?interval=hours&start=2013-01-01&duration=1day'
+        with app.app_context():
+            db_session.add(TemperatureHourly(house_id=0, device_id=0, date=date, temperature=10))
+            db_session.commit()
+        try:
+            response_cache.clear()
+            json_rv = json.loads(self.app.get(url).data.decode('utf-8'))
+        finally:
+            with app.app_context():
+                db_session.query(TemperatureHourly).\
+                    filter(TemperatureHourly.house_id == 0, TemperatureHourly.date == date).delete()
+                db_session.commit()
+            response_cache.clear()
+        assert len(json_rv['hours']) == 24
+        assert '2013-01-01 00:30:00' not in [hour['date'] for hour in json_rv['hours']]
+
+    def test_views_balancepoint(self):
+        url = '/api/houses/0/views/balancepoint/?start=2013-01-01&duration=12months&bases=60..70'
+        rv = self.app.get(url + '&numbers=typed')
+        json_rv = json.loads(rv.data.decode('utf-8'))
+        assert json_rv['view'] == 'balancepoint'
+        assert json_rv['interval'] == 'hour'
+        assert len(json_rv['fits']) == 11
+        assert json_rv['fits'][5]['base'] == 65
+        fitted = [fit for fit in json_rv['fits'] if fit['r2'] is not None]
+        assert json_rv['best']['r2'] == max(fit['r2'] for fit in fitted)
+        sweep = json.loads(self.app.get(url.replace('balancepoint', 'basetemp') +
+                                        '&interval=hours').data.decode('utf-8'))
+        points = sweep['series'][5]['points']
+        assert json_rv['fits'][5]['points'] == len(points)
+        x = [float(point['hdd']) for point in points]
+        y = [float(point['ashp']) for point in points]
+        n, mean_x, mean_y = len(x), sum(x) / len(x), sum(y) / len(y)
+        slope = sum((a - mean_x) * (b - mean_y) for a, b in zip(x, y)) / \
+            sum((a - mean_x) ** 2 for a in x)
+        assert round(json_rv['fits'][5]['slope'], 4) == round(slope, 4)
+        assert round(json_rv['fits'][5]['intercept'], 4) == round(mean_y - slope * mean_x, 4)
+
     def test_views_chart(self):
         rv = self.app.get('/api/houses/0/views/chart/?interval=hours&start=2013-01-01&duration=1day')
         json_rv = json.loads(rv.data.decode('utf-8'))
@@ -375,5 +602,572 @@ class ChartingPerformanceTestCase(unittest.TestCase):
         assert float(json_rv['days'][0]['outdoor_deg_min']) == 10.179
         assert float(json_rv['days'][0]['hdd']) == 40.752
 
+    def test_plan_table(self):
+        tables = [EnergyHourly, CircuitDaily, CircuitMonthly]
+        view = View({'interval': 'months', 'start': '2013-01-01', 'duration': '12months'})
+        assert view.plan_table(tables) == CircuitMonthly
+        view = View({'interval': 'days', 'start': '2013-01-01', 'duration': '12months'})
+        assert view.plan_table(tables) == CircuitDaily
+        view = View({'interval': 'days', 'start': '2013-01-15', 'duration': '1month'})
+        assert view.plan_table(tables) == CircuitDaily
+        view = View({'interval': 'hours', 'start': '2013-01-01', 'duration': '3days'})
+        assert view.plan_table(tables) == EnergyHourly
+        view = View({'interval': 'months', 'end': '2013-01-01'})
+        assert view.plan_table(tables) == CircuitMonthly
+
+    def test_views_usage_days_water_heater_rollup_matches_hourly(self):
+        url = '/api/houses/0/views/usage/?interval=days&start=2013-05-01&duration=1month&circuit=water_heater'
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['build-rollups', '--house', '0', '--full'])
+        assert result.exit_code == 0, result.output
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        rollups = app.config['CIRCUIT_ROLLUPS']
+        try:
+            app.config['CIRCUIT_ROLLUPS'] = False
+            response_cache.clear()
+            hourly = json.loads(self.app.get(url).data.decode('utf-8'))
+            app.config['CIRCUIT_ROLLUPS'] = True
+            response_cache.clear()
+            event.listen(chartingperformance.engine, 'before_cursor_execute', record)
+            rollup = json.loads(self.app.get(url).data.decode('utf-8'))
+        finally:
+            event.remove(chartingperformance.engine, 'before_cursor_execute', record)
+            app.config['CIRCUIT_ROLLUPS'] = rollups
+            response_cache.clear()
+        assert any('circuit_daily' in statement for statement in statements)
+        assert float(rollup['totals']['actual']) == float(hourly['totals']['actual'])
+        assert [item['date'] for item in rollup['items']] == [item['date'] for item in hourly['items']]
+        assert [float(item['actual']) for item in rollup['items']] == \
+            [float(item['actual']) for item in hourly['items']]
+
+    def test_views_usage_days_adjusted_load_with_rollups(self):
+        url = '/api/houses/0/views/usage/?interval=days&start=2013-05-01&duration=1month&circuit=adjusted_load'
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['build-rollups', '--house', '0'])
+        assert result.exit_code == 0, result.output
+        rollups = app.config['CIRCUIT_ROLLUPS']
+        try:
+            app.config['CIRCUIT_ROLLUPS'] = False
+            response_cache.clear()
+            hourly = self.app.get(url)
+            app.config['CIRCUIT_ROLLUPS'] = True
+            response_cache.clear()
+            rv = self.app.get(url)
+        finally:
+            app.config['CIRCUIT_ROLLUPS'] = rollups
+            response_cache.clear()
+        assert rv.status_code == 200
+        assert rv.data == hourly.data
+
+    def test_rollups_refreshed_on_watermark(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['build-rollups', '--house', '0'])
+        assert result.exit_code == 0, result.output
+        rollups = app.config['CIRCUIT_ROLLUPS']
+        app.config['CIRCUIT_ROLLUPS'] = True
+        try:
+            with app.app_context():
+                watermark = watermarks.get(0)
+                db_session.query(RollupLimits).filter(RollupLimits.house_id == 0).\
+                    update({'end_date': watermark - datetime.timedelta(days=1)})
+                db_session.commit()
+                closed = Usage({'interval': 'years', 'start': '2013-01-01', 'duration': '1year'}, 0)
+                assert closed.circuit_tables(0) == [EnergyHourly, CircuitDaily, CircuitMonthly]
+                open_range = Usage({'interval': 'years'}, 0)
+                assert open_range.circuit_tables(0) == [EnergyHourly]
+                rollup.on_watermark(0, watermark)
+                assert rollup.get_end_date(0) == watermark
+                assert open_range.circuit_tables(0) == [EnergyHourly, CircuitDaily, CircuitMonthly]
+        finally:
+            app.config['CIRCUIT_ROLLUPS'] = rollups
+
+    def test_grouped_queries_avoid_temporary_tables(self):
+        runner = app.test_cli_runner()
+        buckets = app.config['INTERVAL_BUCKETS']
+        app.config['INTERVAL_BUCKETS'] = True
+        try:
+            result = runner.invoke(args=['explain-buckets', '--house', '0'])
+        finally:
+            app.config['INTERVAL_BUCKETS'] = buckets
+        assert result.exit_code == 0, result.output
+
+    def test_response_cache_hit(self):
+        response_cache.clear()
+        url = '/api/houses/0/views/summary/?interval=months&start=2012-01-01&duration=1year'
+        first = self.app.get(url)
+        second = self.app.get(url)
+        assert first.data == second.data
+        assert response_cache.stats()['misses'] == 1
+        assert response_cache.stats()['hits'] == 1
+
+    def test_response_cache_lru_eviction(self):
+        cache = ResponseCache(max_bytes=10)
+        cache.set(('summary', '0', 'a'), None, b'12345', 'application/json')
+        cache.set(('summary', '0', 'b'), None, b'12345', 'application/json')
+        assert cache.get(('summary', '0', 'a'), None) is not None
+        cache.set(('summary', '0', 'c'), None, b'12345', 'application/json')
+        assert cache.get(('summary', '0', 'b'), None) is None
+        assert cache.get(('summary', '0', 'a'), None) is not None
+        assert cache.stats()['evictions'] == 1
+        assert cache.get(('summary', '0', 'a'), 'newer') is None
+
+    def test_shared_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = SharedCache(directory + '/responses.db', max_bytes=5000, compress_bytes=1000)
+            cache.create_table()
+            cache.set(('summary', '0', 'a'), 'w1', b'1' * 2000, 'application/json')
+            cache.set(('summary', '1', 'a'), 'w1', b'12345', 'application/json')
+            assert cache.get(('summary', '0', 'a'), 'w1').body == b'1' * 2000
+            assert cache.stats()['bytes'] < 2000 + 5
+            assert cache.get(('summary', '0', 'a'), 'w2') is None
+            cache.invalidate('0', 'w2')
+            assert cache.stats()['entries'] == 1
+            assert cache.get(('summary', '1', 'a'), 'w1').body == b'12345'
+            cache.compress_bytes = None
+            cache.set(('summary', '1', 'b'), 'w1', b'2' * 4999, 'application/json')
+            assert cache.get(('summary', '1', 'a'), 'w1') is None
+        finally:
+            shutil.rmtree(directory)
+
+    def test_single_flight_coalesces(self):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'result'
+        threads = [threading.Thread(target=lambda: results.append(flight.run('key', compute)))
+                   for _ in range(4)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        while flight.stats()['followers'] < 3:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert results == ['result'] * 4
+        assert calls == [1]
+        assert flight.stats() == {'in_flight': 0, 'leaders': 1, 'followers': 3}
+
+    def test_single_flight_shares_error(self):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        errors = []
+        def compute():
+            started.set()
+            release.wait()
+            raise ValueError('failed')
+        def run():
+            try:
+                flight.run('key', compute)
+            except ValueError as error:
+                errors.append(str(error))
+        threads = [threading.Thread(target=run) for _ in range(2)]
+        threads[0].start()
+        started.wait()
+        threads[1].start()
+        while flight.stats()['followers'] < 1:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert errors == ['failed', 'failed']
+        assert flight.run('key', lambda: 'again') == 'again'
+
+    def test_cache_warmer_fills_cache(self):
+        with app.app_context():
+            requests = cache_warmer.get_requests(0)
+            watermark = watermarks.get(0)
+        assert ('heatmap', {'start': '2014-01-01', 'duration': '1year'}) in requests
+        assert ('usage', {'start': '2014-01-01', 'duration': '1year',
+                          'interval': 'months', 'circuit': 'ashp'}) in requests
+        response_cache.clear()
+        pause, cache_warmer.pause = cache_warmer.pause, 0
+        try:
+            cache_warmer.pending['0'] = watermark
+            cache_warmer.warm('0')
+        finally:
+            cache_warmer.pause = pause
+        assert '0' not in cache_warmer.pending
+        assert cache_warmer.stats()['failed'] == 0
+        hits = response_cache.stats()['hits']
+        self.app.get('/api/houses/0/views/summary/?interval=months&start=2014-01-01&duration=1year')
+        assert response_cache.stats()['hits'] == hits + 1
+
+    def test_views_usage_concurrent_requests_match(self):
+        url = '/api/houses/0/views/usage/?circuit=summary&interval=years'
+        response_cache.clear()
+        bodies = []
+        def get():
+            bodies.append(app.test_client().get(url).data)
+        threads = [threading.Thread(target=get) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(bodies) == 4
+        assert len(set(bodies)) == 1
+
+    def test_shared_cache_serves_other_workers(self):
+        directory = tempfile.mkdtemp()
+        path = app.config['SHARED_CACHE_PATH']
+        app.config['SHARED_CACHE_PATH'] = directory + '/responses.db'
+        shared_cache.init_app(app)
+        shared_cache.clear()
+        try:
+            url = '/api/houses/0/views/hdd/?interval=months&start=2013-01-01&duration=1year'
+            response_cache.clear()
+            first = self.app.get(url)
+            response_cache.clear()
+            second = self.app.get(url)
+            assert second.data == first.data
+            assert shared_cache.stats()['hits'] == 1
+            assert response_cache.stats()['entries'] == 1
+        finally:
+            app.config['SHARED_CACHE_PATH'] = path
+            shared_cache.init_app(app)
+            shutil.rmtree(directory)
+
+    def test_response_cache_stale(self):
+        cache = ResponseCache(max_bytes=100, keep_stale=60)
+        cache.set(('summary', '0', 'a'), 'w1', b'12345', 'application/json')
+        cache.invalidate('0', 'w2')
+        assert cache.get(('summary', '0', 'a'), 'w2') is None
+        assert cache.get_stale(('summary', '0', 'a'), 60).watermark == 'w1'
+        assert cache.get_stale(('summary', '0', 'a'), -1) is None
+        cache = ResponseCache(max_bytes=100)
+        cache.set(('summary', '0', 'a'), 'w1', b'12345', 'application/json')
+        cache.invalidate('0', 'w2')
+        assert cache.get_stale(('summary', '0', 'a'), 60) is None
+        assert cache.stats()['entries'] == 0
+
+    def advance_watermark(self):
+        with app.app_context():
+            later = watermarks.get(0) + datetime.timedelta(hours=1)
+        watermarks.values['0'] = (later, time.monotonic())
+        response_cache.invalidate('0', later)
+
+    def test_views_stale_while_revalidate(self):
+        url = '/api/houses/0/views/summary/?interval=months&start=2014-01-01&duration=1year'
+        response_cache.clear()
+        first = self.app.get(url)
+        self.advance_watermark()
+        try:
+            stale = self.app.get(url)
+            assert stale.data == first.data
+            assert stale.headers['ETag'] == first.headers['ETag']
+            while revalidator.stats()['pending']:
+                time.sleep(0.01)
+            hits = response_cache.stats()['hits']
+            fresh = self.app.get(url)
+            assert response_cache.stats()['hits'] == hits + 1
+            assert fresh.headers['ETag'] != first.headers['ETag']
+        finally:
+            with app.app_context():
+                watermarks.refresh(0)
+
+    def test_views_stale_if_error(self):
+        class Failing(object):
+            extra_args = []
+            def __init__(self, args, house_id):
+                raise exc.OperationalError('SELECT 1', {}, Exception('gone'))
+        url = '/api/houses/0/views/summary/?interval=months&start=2014-01-01&duration=1year'
+        response_cache.clear()
+        first = self.app.get(url)
+        self.advance_watermark()
+        window, revalidator.stale_while_revalidate = revalidator.stale_while_revalidate, 0
+        try:
+            with app.test_request_context(url):
+                response = serve_view('summary', Failing, 0)
+            assert response.get_data() == first.data
+        finally:
+            revalidator.stale_while_revalidate = window
+            with app.app_context():
+                watermarks.refresh(0)
+
+    def test_views_conditional_get(self):
+        url = '/api/houses/0/views/summary/?interval=months&start=2013-01-01&duration=1year'
+        rv = self.app.get(url)
+        assert rv.status_code == 200
+        assert rv.headers['ETag']
+        assert 'immutable' in rv.headers['Cache-Control']
+        rv = self.app.get(url, headers={'If-None-Match': rv.headers['ETag']})
+        assert rv.status_code == 304
+        assert rv.data == b''
+
+    def test_views_open_range_revalidates(self):
+        rv = self.app.get('/api/houses/0/views/summary/?interval=years')
+        assert 'no-cache' in rv.headers['Cache-Control']
+        assert rv.headers['Last-Modified']
+
+    def test_views_chart_multiple_days(self):
+        rv = self.app.get('/api/houses/0/views/chart/?interval=hours&start=2013-01-01&duration=3days')
+        json_rv = json.loads(rv.data.decode('utf-8'))
+        assert len(json_rv['hours']) == 72
+        assert json_rv['hours'][0]['date'] == '2013-01-01 00:00:00'
+        assert json_rv['hours'][71]['date'] == '2013-01-03 23:00:00'
+        assert float(json_rv['hours'][0]['first_floor_temp']) == 65.851
+
+    def test_views_heatmap_columnar(self):
+        rv = self.app.get('/api/houses/0/views/heatmap/?interval=hours&start=2013-01-01&duration=1month&format=columnar')
+        json_rv = json.loads(rv.data.decode('utf-8'))
+        assert len(json_rv['days']['date']) == 31
+        assert len(json_rv['days']['net']) == 31
+        assert json_rv['days']['date'][0] == '2013-01-01'
+        assert float(json_rv['days']['net'][0]) == 26.881
+        assert float(json_rv['days']['hdd'][0]) == 40.752
+
+    def test_views_summary_columnar(self):
+        rv = self.app.get('/api/houses/0/views/summary/?interval=days&start=2014-01-01&duration=31days&format=columnar')
+        json_rv = json.loads(rv.data.decode('utf-8'))
+        assert len(json_rv['items']['date']) == 31
+        assert float(json_rv['items']['net'][0]) == 22.0340000000
+        assert float(json_rv['totals']['net']) == 630.9560000000
+
+    def test_views_summary_typed_numbers(self):
+        rv = self.app.get('/api/houses/0/views/summary/?interval=days&start=2014-01-01&duration=31days&numbers=typed')
+        json_rv = json.loads(rv.data.decode('utf-8'))
+        assert json_rv['items'][0]['net'] == 22.034
+        assert json_rv['totals']['net'] == 630.956
+        assert json_rv['items'][0]['date'] == '2014-01-01'
+
+    def test_views_chart_typed_nulls(self):
+        rv = self.app.get('/api/houses/0/views/chart/?interval=hours&start=2013-01-01&duration=1day&numbers=typed&format=columnar')
+        json_rv = json.loads(rv.data.decode('utf-8'))
+        assert json_rv['hours']['net'][0] == 224
+        assert 'None' not in rv.data.decode('utf-8')
+
+    def test_views_usage_hours_streamed(self):
+        url = '/api/houses/0/views/usage/?interval=hours&start=2013-01-01&duration=3days&circuit=water_heater'
+        buffered = json.loads(self.app.get(url).data.decode('utf-8'))
+        rv = self.app.get(url + '&stream=true')
+        assert rv.is_streamed
+        streamed = json.loads(rv.data.decode('utf-8'))
+        assert len(streamed['items']) == 72
+        assert streamed['items'] == buffered['items']
+        assert streamed['totals'] == buffered['totals']
+
+    def test_views_batch(self):
+        args = 'start=2014-01-01&duration=1year&interval=months'
+        rv = self.app.get('/api/houses/0/views/batch/?views=default,summary,usage&usage.circuit=all&' + args)
+        json_rv = json.loads(rv.data.decode('utf-8'))
+        assert sorted(json_rv) == ['default', 'summary', 'usage']
+        assert json_rv['default']['asof'] is not None
+        summary = json.loads(self.app.get('/api/houses/0/views/summary/?' + args).data.decode('utf-8'))
+        assert json_rv['summary'] == summary
+        usage = json.loads(self.app.get('/api/houses/0/views/usage/?circuit=all&' + args).data.decode('utf-8'))
+        assert json_rv['usage'] == usage
+
+    def test_views_batch_view_args(self):
+        args = 'start=2013-01-01&duration=1month&interval=days'
+        rv = self.app.get('/api/houses/0/views/batch/?views=basetemp,balancepoint&basetemp.bases=60..62&' + args)
+        json_rv = json.loads(rv.data.decode('utf-8'))
+        basetemp = json.loads(self.app.get('/api/houses/0/views/basetemp/?bases=60..62&' + args).data.decode('utf-8'))
+        assert len(json_rv['basetemp']['series']) == 3
+        assert json_rv['basetemp'] == basetemp
+        balancepoint = json.loads(self.app.get('/api/houses/0/views/balancepoint/?' + args).data.decode('utf-8'))
+        assert json_rv['balancepoint'] == balancepoint
+
+    def test_views_batch_unknown_view(self):
+        rv = self.app.get('/api/houses/0/views/batch/?views=summary,nope&start=2014-01-01&duration=1year')
+        json_rv = json.loads(rv.data.decode('utf-8'))
+        assert 'error' in json_rv
+
+    def test_query_executor_order(self):
+        executor = QueryExecutor()
+        executor.init_app(app)
+        with app.app_context():
+            assert executor.run(lambda: 1, lambda: 2, lambda: 3) == [1, 2, 3]
+
+    def test_views_hdd_concurrent_matches_sequential(self):
+        url = '/api/houses/0/views/hdd/?interval=months&start=2013-01-01&duration=4months'
+        pool = query_executor.pool
+        try:
+            query_executor.pool = None
+            response_cache.clear()
+            sequential = json.loads(self.app.get(url).data.decode('utf-8'))
+        finally:
+            query_executor.pool = pool
+        response_cache.clear()
+        concurrent = json.loads(self.app.get(url).data.decode('utf-8'))
+        assert concurrent == sequential
+        assert float(concurrent['totals']['hdd_heating_season']) > 0
+
+    def test_views_rollup_totals_match_separate_queries(self):
+        urls = ['/api/houses/0/views/summary/?interval=months&start=2014-01-01&duration=1year',
+                '/api/houses/0/views/generation/?interval=days&start=2013-01-01&duration=1month',
+                '/api/houses/0/views/temperature/?interval=days&start=2014-01-01&duration=1month&location=0',
+                '/api/houses/0/views/usage/?interval=months&start=2014-01-01&duration=1year&circuit=ashp',
+                '/api/houses/0/views/water/?interval=months&start=2014-01-01&duration=1year']
+        settings = dict((name, app.config[name]) for name in ['INTERVAL_BUCKETS', 'ROLLUP_TOTALS'])
+        try:
+            for buckets in [False, True]:
+                app.config['INTERVAL_BUCKETS'] = buckets
+                for url in urls:
+                    app.config['ROLLUP_TOTALS'] = False
+                    response_cache.clear()
+                    separate = json.loads(self.app.get(url).data.decode('utf-8'))
+                    app.config['ROLLUP_TOTALS'] = True
+                    response_cache.clear()
+                    rollup = json.loads(self.app.get(url).data.decode('utf-8'))
+                    assert rollup['totals'] == separate['totals'], (url, buckets)
+                    assert rollup['items'] == separate['items'], (url, buckets)
+        finally:
+            app.config.update(settings)
+            response_cache.clear()
+
+    def test_views_rollup_totals_by_default(self):
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        response_cache.clear()
+        event.listen(chartingperformance.engine, 'before_cursor_execute', record)
+        try:
+            rv = self.app.get('/api/houses/0/views/summary/?interval=months&start=2014-01-01&duration=1year')
+        finally:
+            event.remove(chartingperformance.engine, 'before_cursor_execute', record)
+            response_cache.clear()
+        assert rv.status_code == 200
+        assert any('WITH ROLLUP' in statement for statement in statements)
+
+    def test_column_store_matches_database(self):
+        urls = ['/api/houses/0/views/summary/?interval=days&start=2014-01-01&duration=1month',
+                '/api/houses/0/views/temperature/?interval=months&start=2014-01-01&duration=1year&location=0',
+                '/api/houses/0/views/usage/?interval=days&start=2014-01-01&duration=1month&circuit=water_heater',
+                '/api/houses/0/views/usage/?interval=days&start=2014-01-01&duration=1month&circuit=dryer',
+                '/api/houses/0/views/usage/?interval=hours&start=2014-01-01&duration=1day&circuit=all_other',
+                '/api/houses/0/views/chart/?interval=hours&start=2013-01-01&duration=1day']
+        directory = tempfile.mkdtemp()
+        try:
+            with app.app_context():
+                column_store.directory = directory
+                column_store.sync(0)
+                for url in urls:
+                    column_store.directory = None
+                    response_cache.clear()
+                    database = json.loads(self.app.get(url + '&numbers=typed').data.decode('utf-8'))
+                    column_store.directory = directory
+                    response_cache.clear()
+                    store = json.loads(self.app.get(url + '&numbers=typed').data.decode('utf-8'))
+                    for key in ['totals', 'items', 'hours']:
+                        assert round_numbers(store.get(key)) == round_numbers(database.get(key)), url
+        finally:
+            column_store.directory = None
+            response_cache.clear()
+            shutil.rmtree(directory)
+
+    def test_column_store_recovers_interrupted_append(self):
+        directory = tempfile.mkdtemp()
+        before = column_store.directory
+        try:
+            with app.app_context():
+                column_store.directory = directory
+                watermark = watermarks.get(0)
+                column_store.sync(0, until=watermark - datetime.timedelta(days=30))
+                path = column_store.path(0)
+                # columns written, then a crash before the index was complete
+                series = list_series(path)[0]
+                with open(column_path(path, series, 'rows'), 'ab') as output:
+                    output.write(b'\1' * 5)
+                with open(os.path.join(path, 'date.i8'), 'ab') as output:
+                    output.write(b'\0' * 3)
+                column_store.sync(0, until=watermark)
+                length = os.path.getsize(os.path.join(path, 'date.i8')) // 8
+                for name in os.listdir(path):
+                    if name.endswith('.i8') or name.endswith('.u1'):
+                        size = length * (8 if name.endswith('.i8') else 1)
+                        assert os.path.getsize(os.path.join(path, name)) == size, name
+                assert column_store.get(0, watermark) is not None
+        finally:
+            column_store.directory = before
+            shutil.rmtree(directory)
+
+    def test_column_store_appended_by_one_process(self):
+        directory = tempfile.mkdtemp()
+        before = column_store.directory
+        try:
+            with app.app_context():
+                column_store.directory = directory
+                watermark = watermarks.get(0)
+                column_store.sync(0, until=watermark - datetime.timedelta(days=30))
+                filename = os.path.join(column_store.path(0), 'watermark')
+                built = os.stat(filename)
+                # another worker holds the lock while it appends
+                with open(column_store.path(0, '.lock'), 'w') as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    column_store.on_watermark(0, watermark)
+                assert os.stat(filename).st_mtime_ns == built.st_mtime_ns
+                column_store.on_watermark(0, watermark)
+                house = column_store.get(0, watermark)
+                assert house is not None
+                appended = os.stat(filename)
+                # already current, so nothing is rewritten and readers keep their maps
+                column_store.on_watermark(0, watermark)
+                current = os.stat(filename)
+                assert (current.st_ino, current.st_mtime_ns) == (appended.st_ino, appended.st_mtime_ns)
+                assert column_store.get(0, watermark) is house
+        finally:
+            column_store.directory = before
+            shutil.rmtree(directory)
+
+    def test_extremes_index_matches_scan(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['build-extremes', '--house', '0', '--full'])
+        assert result.exit_code == 0, result.output
+        with app.app_context():
+            for metric in ['solar_hour', 'solar_day', 'temperature_hour', 'hdd_day']:
+                for start, end in [(datetime.datetime(2013, 1, 15, 6), datetime.datetime(2014, 3, 2)),
+                                   (datetime.datetime(2013, 1, 1), datetime.datetime(2014, 1, 1)),
+                                   (None, None)]:
+                    indexed = extremes.find(metric, 0, start, end, end is not None)
+                    scanned = extremes.best(extremes.METRICS[metric],
+                                            [extremes.scan(extremes.METRICS[metric], 0,
+                                                           start, end, end is not None)])
+                    assert indexed == scanned, metric
+
+    def test_extremes_refreshed_on_watermark(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['build-extremes', '--house', '0', '--full'])
+        assert result.exit_code == 0, result.output
+        with app.app_context():
+            rows = db_session.query(Extremes).filter(Extremes.house_id == 0).\
+                filter(Extremes.metric == 'solar_hour').filter(Extremes.period == 'month')
+            latest = max(row.start_date for row in rows)
+            rows.filter(Extremes.start_date >= datetime.date(latest.year, 1, 1)).\
+                delete(synchronize_session=False)
+            db_session.commit()
+            extremes.on_watermark(0, watermarks.get(0))
+            assert max(row.start_date for row in rows) == latest
+
+    def test_export_energy_csv(self):
+        rv = self.app.get('/api/houses/0/export/?table=energy&start=2013-01-01&duration=1day')
+        assert rv.mimetype == 'text/csv'
+        assert 'attachment' in rv.headers['Content-Disposition']
+        lines = rv.data.decode('utf-8').splitlines()
+        assert lines[0].startswith('date,')
+        assert 'bucket_day' not in lines[0]
+        assert lines[1].startswith('2013-01-01 00:00:00,')
+
+    def test_export_energy_parquet_row_groups(self):
+        rows = app.config['PARQUET_ROW_GROUP_ROWS']
+        app.config['PARQUET_ROW_GROUP_ROWS'] = 5000
+        try:
+            rv = self.app.get('/api/houses/0/export/?table=energy&start=2013-01-01&duration=1year&format=parquet')
+        finally:
+            app.config['PARQUET_ROW_GROUP_ROWS'] = rows
+        assert rv.mimetype == 'application/vnd.apache.parquet'
+        parquet = pyarrow.parquet.ParquetFile(io.BytesIO(rv.data))
+        total = parquet.metadata.num_rows
+        assert total > 2 * app.config['STREAM_BATCH_ROWS']
+        assert parquet.num_row_groups == (total + 4999) // 5000
+        assert parquet.metadata.row_group(0).num_rows == min(total, 5000)
+
 if __name__ == '__main__':
     unittest.main()